@@ -0,0 +1,331 @@
+from __future__ import annotations
+
+import argparse
+import asyncio
+import datetime as dt
+import itertools
+import json
+import os
+import subprocess
+import sys
+import time
+from collections import defaultdict
+
+from aiogram.types import (
+    CallbackQuery,
+    Chat,
+    Message,
+    MessageEntity,
+    PreCheckoutQuery,
+    SuccessfulPayment,
+    Update,
+    User,
+)
+
+from .fakes import FakeOutlineServer, FakeTelegramSession
+
+BENCH_TOKEN = "123456789:BENCHbenchBENCHbenchBENCHbenchBENCHb"
+ADMIN_ID = 1
+USER_ID_OFFSET = 10_000
+
+
+class UpdateFactory:
+    def __init__(self, bot) -> None:
+        self._bot = bot
+        self._ids = itertools.count(1)
+
+    def _user(self, telegram_id: int) -> User:
+        return User(id=telegram_id, is_bot=False, first_name="Bench", username=f"bench{telegram_id}")
+
+    def _message(self, telegram_id: int, **fields) -> Message:
+        return Message(
+            message_id=next(self._ids),
+            date=dt.datetime.now(dt.timezone.utc),
+            chat=Chat(id=telegram_id, type="private"),
+            from_user=self._user(telegram_id),
+            **fields,
+        )
+
+    def _update(self, **fields) -> Update:
+        # Validating with the bot in context mounts it on every nested object, as aiogram does for real updates.
+        update = Update(update_id=next(self._ids), **fields)
+        return Update.model_validate(update.model_dump(exclude_none=True), context={"bot": self._bot})
+
+    def text(self, telegram_id: int, text: str) -> Update:
+        entities = None
+        if text.startswith("/"):
+            entities = [MessageEntity(type="bot_command", offset=0, length=len(text.split()[0]))]
+        return self._update(message=self._message(telegram_id, text=text, entities=entities))
+
+    def callback(self, telegram_id: int, data: str) -> Update:
+        return self._update(
+            callback_query=CallbackQuery(
+                id=str(next(self._ids)),
+                from_user=self._user(telegram_id),
+                chat_instance="bench",
+                message=self._message(telegram_id, text="menu"),
+                data=data,
+            )
+        )
+
+    def pre_checkout(self, telegram_id: int, payload: str, amount: int) -> Update:
+        return self._update(
+            pre_checkout_query=PreCheckoutQuery(
+                id=str(next(self._ids)),
+                from_user=self._user(telegram_id),
+                currency="XTR",
+                total_amount=amount,
+                invoice_payload=payload,
+            )
+        )
+
+    def successful_payment(self, telegram_id: int, payload: str, amount: int) -> Update:
+        return self._update(
+            message=self._message(
+                telegram_id,
+                successful_payment=SuccessfulPayment(
+                    currency="XTR",
+                    total_amount=amount,
+                    invoice_payload=payload,
+                    telegram_payment_charge_id=f"bench-{next(self._ids)}",
+                    provider_payment_charge_id="bench",
+                ),
+            )
+        )
+
+
+THROTTLED_STEP = "throttled"
+
+
+def _reply_target(update: Update) -> str:
+    if update.callback_query is not None:
+        return update.callback_query.id
+    return str(update.message.chat.id) if update.message is not None else ""
+
+
+class Recorder:
+    def __init__(self, session: FakeTelegramSession) -> None:
+        self.session = session
+        self.latencies: dict[str, list[float]] = defaultdict(list)
+        self.errors: dict[str, int] = defaultdict(int)
+
+    async def feed(self, dp, bot, step: str, update: Update) -> None:
+        # Each user's updates are fed one at a time, so a new anti-flood reply to its chat belongs to this one.
+        target = _reply_target(update)
+        throttled_before = self.session.throttled[target]
+        started = time.perf_counter()
+        try:
+            await dp.feed_update(bot, update)
+        except Exception:  # noqa: BLE001
+            self.errors[step] += 1
+        elapsed = time.perf_counter() - started
+        if self.session.throttled[target] > throttled_before:
+            # Throttled updates never reach their handler; timing them would flatter its latency.
+            step = THROTTLED_STEP
+        self.latencies[step].append(elapsed)
+
+    @property
+    def throttled(self) -> int:
+        return len(self.latencies.get(THROTTLED_STEP, ()))
+
+    def report(self) -> dict[str, dict]:
+        def quantile(samples: list[float], q: float) -> float:
+            return samples[min(len(samples) - 1, int(q * len(samples)))] * 1000
+
+        result = {}
+        for step, samples in self.latencies.items():
+            samples.sort()
+            result[step] = {
+                "count": len(samples),
+                "errors": self.errors.get(step, 0),
+                "p50_ms": round(quantile(samples, 0.5), 2),
+                "p95_ms": round(quantile(samples, 0.95), 2),
+                "p99_ms": round(quantile(samples, 0.99), 2),
+            }
+        return result
+
+
+async def _user_flow(
+    dp,
+    bot,
+    session: FakeTelegramSession,
+    factory: UpdateFactory,
+    recorder: Recorder,
+    telegram_id: int,
+    plan,
+) -> None:
+    await recorder.feed(dp, bot, "start", factory.text(telegram_id, "/start"))
+    await recorder.feed(dp, bot, "show_plans", factory.callback(telegram_id, "plans"))
+    # Users browse back and forth before paying.
+    await recorder.feed(dp, bot, "back_main", factory.callback(telegram_id, "back_main"))
+    await recorder.feed(dp, bot, "show_plans", factory.callback(telegram_id, "plans"))
+    await recorder.feed(dp, bot, "select_plan", factory.callback(telegram_id, f"plan:{plan.months}"))
+    payload = session.invoices.get(telegram_id)
+    if payload is not None:
+        await recorder.feed(dp, bot, "pre_checkout", factory.pre_checkout(telegram_id, payload, plan.price_stars))
+        await recorder.feed(
+            dp, bot, "successful_payment", factory.successful_payment(telegram_id, payload, plan.price_stars)
+        )
+    await recorder.feed(dp, bot, "my_subscription", factory.text(telegram_id, "/my_subscription"))
+
+
+async def run_benchmark(args: argparse.Namespace) -> dict:
+    outline = FakeOutlineServer(
+        latency=args.outline_latency_ms / 1000,
+        jitter=args.outline_jitter_ms / 1000,
+        error_rate=args.outline_error_rate,
+    )
+    outline_url = await outline.start()
+
+    # load_config() reads the environment once per process and caches it.
+    os.environ.update(
+        {
+            "DATABASE_URL": args.url,
+            "OUTLINE_API_URL": outline_url,
+            "OUTLINE_CERT_SHA256": "00" * 32,
+            "BOT_TOKEN": BENCH_TOKEN,
+            "ADMIN_ID": str(ADMIN_ID),
+        }
+    )
+    os.environ.pop("OUTLINE_SERVERS", None)
+    os.environ["RATE_LIMIT_PER_MINUTE"] = str(args.rate_limit)
+    os.environ["RATE_LIMIT_CALLBACKS_PER_MINUTE"] = str(args.callback_rate_limit)
+    os.environ.setdefault("BROADCAST_RATE_PER_SECOND", str(args.broadcast_rate))
+
+    from sqlalchemy import func, select
+
+    from bot.broadcast import broadcaster
+    from bot.config import load_config
+    from bot.database import Base, Payment, PaymentStatus, get_engine
+    from bot.deps import db_session
+    from bot.jobs import job_queue
+    from bot.main import create_application
+    from bot.middlewares import THROTTLED_TEXT
+    from bot.migrations import init_db
+    from bot.plans import plan_catalog
+    from bot.services import count_open_jobs
+
+    engine = get_engine()
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+    await init_db()
+
+    bot, dp = create_application(load_config())
+    session = FakeTelegramSession(latency=args.telegram_latency_ms / 1000, throttled_text=THROTTLED_TEXT)
+    bot.session = session
+    await dp.emit_startup(bot=bot, **dp.workflow_data)
+
+    factory = UpdateFactory(bot)
+    recorder = Recorder(session)
+    plan = plan_catalog().plans[0]
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def one(telegram_id: int) -> None:
+        async with semaphore:
+            await _user_flow(dp, bot, session, factory, recorder, telegram_id, plan)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(USER_ID_OFFSET + i) for i in range(args.users)))
+    await recorder.feed(dp, bot, "broadcast", factory.text(ADMIN_ID, "/broadcast"))
+    await recorder.feed(dp, bot, "broadcast", factory.text(ADMIN_ID, "Bench broadcast"))
+    elapsed = time.perf_counter() - started
+
+    drain_started = time.perf_counter()
+    await broadcaster.wait()
+    broadcast_seconds = time.perf_counter() - drain_started
+    while True:
+        async with db_session() as db:
+            if not await count_open_jobs(db):
+                break
+        job_queue.notify()
+        await asyncio.sleep(0.05)
+    jobs_seconds = time.perf_counter() - drain_started
+    async with db_session() as db:
+        # Every invoice in the flow is paid, so a payment still pending was dropped before its handler ran.
+        payments_lost = (
+            await db.execute(select(func.count()).select_from(Payment).where(Payment.status == PaymentStatus.PENDING))
+        ).scalar_one()
+
+    await dp.emit_shutdown(bot=bot, **dp.workflow_data)
+    await outline.stop()
+
+    updates = sum(len(samples) for samples in recorder.latencies.values())
+    return {
+        "backend": engine.url.get_backend_name(),
+        "url": engine.url.render_as_string(hide_password=True),
+        "users": args.users,
+        "concurrency": args.concurrency,
+        "updates": updates,
+        "seconds": round(elapsed, 3),
+        "updates_per_sec": round(updates / elapsed, 1),
+        "broadcast_drain_seconds": round(broadcast_seconds, 3),
+        "jobs_drain_seconds": round(jobs_seconds, 3),
+        "payments_lost": payments_lost,
+        "throttled": recorder.throttled,
+        "handlers": recorder.report(),
+        "telegram_calls": dict(session.calls),
+        "outline": outline.stats(),
+    }
+
+
+def _print_human(result: dict) -> None:
+    print(
+        f"{result['url']}: {result['updates']} updates in {result['seconds']}s "
+        f"({result['updates_per_sec']} updates/s), broadcast drained in {result['broadcast_drain_seconds']}s, "
+        f"jobs drained in {result['jobs_drain_seconds']}s, payments lost: {result['payments_lost']}, "
+        f"throttled: {result['throttled']}"
+    )
+    for step, stats in result["handlers"].items():
+        print(
+            f"  {step:<20} n={stats['count']:<6} err={stats['errors']:<4} "
+            f"p50={stats['p50_ms']:.1f}ms p95={stats['p95_ms']:.1f}ms p99={stats['p99_ms']:.1f}ms"
+        )
+    print(f"  outline: {result['outline']['requests']}, injected errors={result['outline']['injected_errors']}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Feed synthetic updates through the bot's real dispatcher.")
+    parser.add_argument(
+        "--url",
+        action="append",
+        dest="urls",
+        help="Database URL; repeat to compare backends (default: sqlite file in the working directory).",
+    )
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--telegram-latency-ms", type=float, default=0.0)
+    parser.add_argument("--outline-latency-ms", type=float, default=20.0)
+    parser.add_argument("--outline-jitter-ms", type=float, default=10.0)
+    parser.add_argument("--outline-error-rate", type=float, default=0.0)
+    parser.add_argument("--broadcast-rate", type=float, default=10_000.0)
+    # High enough that the scripted flow is never throttled; lower them to exercise the anti-flood path.
+    parser.add_argument("--rate-limit", type=int, default=1000, help="Anti-flood messages per user per minute.")
+    parser.add_argument(
+        "--callback-rate-limit", type=int, default=1000, help="Anti-flood button presses per user per minute."
+    )
+    parser.add_argument("--json", action="store_true", help="Print one JSON object per backend.")
+    args = parser.parse_args()
+
+    urls = args.urls or ["sqlite+aiosqlite:///./bench_dispatcher.db"]
+    if len(urls) > 1:
+        # Configuration is cached per process, so each backend gets a fresh interpreter.
+        passthrough = [arg for arg in sys.argv[1:] if arg not in urls and arg != "--url"]
+        for url in urls:
+            subprocess.run(
+                [sys.executable, "-m", "benchmarks.dispatcher_load", *passthrough, "--url", url],
+                check=True,
+            )
+        return
+
+    args.url = urls[0]
+    result = asyncio.run(run_benchmark(args))
+    if args.json:
+        print(json.dumps(result))
+    else:
+        _print_human(result)
+    if result["payments_lost"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+from __future__ import annotations
+
+import asyncio
+import datetime as dt
+import itertools
+import random
+import uuid
+from collections import Counter
+
+from aiogram import Bot
+from aiogram.client.session.base import BaseSession
+from aiogram.methods import SendInvoice, TelegramMethod
+from aiogram.types import Chat, Message
+from aiohttp import web
+
+
+class FakeTelegramSession(BaseSession):
+    def __init__(self, latency: float = 0.0, throttled_text: str | None = None) -> None:
+        super().__init__()
+        self.latency = latency
+        self.throttled_text = throttled_text
+        self.calls: Counter[str] = Counter()
+        self.invoices: dict[int, str] = {}
+        # Anti-flood replies per chat id or callback query id.
+        self.throttled: Counter[str] = Counter()
+        self._message_ids = itertools.count(1)
+
+    async def make_request(self, bot: Bot, method: TelegramMethod, timeout: int | None = None):
+        self.calls[type(method).__name__] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if isinstance(method, SendInvoice):
+            self.invoices[int(method.chat_id)] = method.payload
+        if self.throttled_text is not None and getattr(method, "text", None) == self.throttled_text:
+            target = getattr(method, "callback_query_id", None) or getattr(method, "chat_id", None)
+            self.throttled[str(target)] += 1
+        if "Message" in str(method.__returning__):
+            chat_id = getattr(method, "chat_id", None) or 0
+            return Message(
+                message_id=next(self._message_ids),
+                date=dt.datetime.now(dt.timezone.utc),
+                chat=Chat(id=int(chat_id), type="private"),
+            )
+        return True
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        yield b""
+
+    async def close(self) -> None:
+        pass
+
+
+class FakeOutlineServer:
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0) -> None:
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.keys: dict[str, dict] = {}
+        self.requests: Counter[str] = Counter()
+        self.injected_errors = 0
+        self._ids = itertools.count(1)
+        self._runner: web.AppRunner | None = None
+        self.url = ""
+
+        self.app = web.Application(middlewares=[self._chaos])
+        self.app.router.add_post("/access-keys", self._create_key)
+        self.app.router.add_get("/access-keys", self._list_keys)
+        self.app.router.add_put("/access-keys/{key_id}/name", self._rename_key)
+        self.app.router.add_put("/access-keys/{key_id}/data-limit", self._set_data_limit)
+        self.app.router.add_delete("/access-keys/{key_id}", self._delete_key)
+        self.app.router.add_get("/metrics/transfer", self._transfer)
+
+    @web.middleware
+    async def _chaos(self, request: web.Request, handler):
+        self.requests[f"{request.method} {request.match_info.route.resource.canonical}"] += 1
+        delay = self.latency + random.uniform(0, self.jitter)
+        if delay:
+            await asyncio.sleep(delay)
+        if self.error_rate and random.random() < self.error_rate:
+            self.injected_errors += 1
+            return web.json_response({"message": "injected failure"}, status=503)
+        return await handler(request)
+
+    async def _create_key(self, request: web.Request) -> web.Response:
+        body = await request.json() if request.can_read_body else {}
+        key_id = str(next(self._ids))
+        key = {
+            "id": key_id,
+            "name": body.get("name", ""),
+            "password": uuid.uuid4().hex,
+            "port": 443,
+            "method": "chacha20-ietf-poly1305",
+            "accessUrl": f"ss://{uuid.uuid4().hex}@127.0.0.1:443/?outline=1#{key_id}",
+        }
+        self.keys[key_id] = key
+        return web.json_response(key, status=201)
+
+    async def _list_keys(self, request: web.Request) -> web.Response:
+        return web.json_response({"accessKeys": list(self.keys.values())})
+
+    async def _rename_key(self, request: web.Request) -> web.Response:
+        key = self.keys.get(request.match_info["key_id"])
+        if key is None:
+            raise web.HTTPNotFound()
+        key["name"] = (await request.json()).get("name", "")
+        return web.Response(status=204)
+
+    async def _set_data_limit(self, request: web.Request) -> web.Response:
+        key = self.keys.get(request.match_info["key_id"])
+        if key is None:
+            raise web.HTTPNotFound()
+        key["dataLimit"] = (await request.json()).get("limit")
+        return web.Response(status=204)
+
+    async def _delete_key(self, request: web.Request) -> web.Response:
+        if self.keys.pop(request.match_info["key_id"], None) is None:
+            raise web.HTTPNotFound()
+        return web.Response(status=204)
+
+    async def _transfer(self, request: web.Request) -> web.Response:
+        return web.json_response({"bytesTransferredByUserId": {key_id: 0 for key_id in self.keys}})
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        self._runner = web.AppRunner(self.app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        bound_port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://{host}:{bound_port}"
+        return self.url
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    def stats(self) -> dict:
+        return {
+            "requests": dict(self.requests),
+            "injected_errors": self.injected_errors,
+            "keys": len(self.keys),
+        }
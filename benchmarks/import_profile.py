@@ -0,0 +1,92 @@
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+from collections import defaultdict
+
+DEFAULT_MODULES = ("bot.main", "bot.migrations", "bot.reconcile")
+
+_LINE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$")
+
+
+def profile_import(module: str) -> dict:
+    # Each module is imported in a fresh interpreter so nothing is already cached in sys.modules.
+    env = dict(os.environ)
+    env.pop("PYTHONPROFILEIMPORTTIME", None)
+    started = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        env=env,
+    )
+    if started.returncode:
+        raise RuntimeError(f"import {module} failed:\n{started.stderr[-2000:]}")
+
+    modules: list[tuple[str, int, int]] = []
+    total_us = 0
+    for line in started.stderr.splitlines():
+        match = _LINE.match(line)
+        if match is None:
+            continue
+        self_us, cumulative_us, indent, name = int(match[1]), int(match[2]), len(match[3]), match[4]
+        modules.append((name, self_us, cumulative_us))
+        if indent == 1:
+            total_us += cumulative_us
+
+    packages: dict[str, int] = defaultdict(int)
+    cumulative: dict[str, int] = {}
+    for name, self_us, cumulative_us in modules:
+        packages[name.split(".")[0]] += self_us
+        # Packages that import their own submodules mid-init are listed twice; keep the outer entry.
+        cumulative[name] = max(cumulative.get(name, 0), cumulative_us)
+    return {
+        "module": module,
+        "total_ms": round(total_us / 1000, 1),
+        "modules": len(modules),
+        "packages": {name: round(us / 1000, 1) for name, us in sorted(packages.items(), key=lambda item: -item[1])},
+        "cumulative": [
+            {"module": name, "ms": round(us / 1000, 1)}
+            for name, us in sorted(cumulative.items(), key=lambda item: -item[1])
+        ],
+    }
+
+
+def _print_human(result: dict, top: int) -> None:
+    print(f"import {result['module']}: {result['total_ms']}ms, {result['modules']} modules")
+    print("  by package (self time):")
+    for name, ms in list(result["packages"].items())[:top]:
+        print(f"    {name:<32} {ms:>8.1f}ms")
+    print("  slowest imports (cumulative):")
+    for entry in result["cumulative"][:top]:
+        print(f"    {entry['module']:<48} {entry['ms']:>8.1f}ms")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Measure how long the bot's entry points take to import.")
+    parser.add_argument("modules", nargs="*", default=list(DEFAULT_MODULES))
+    parser.add_argument("--top", type=int, default=10, help="How many packages and modules to list.")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per module; the fastest one is reported.")
+    parser.add_argument("--budget-ms", type=float, help="Exit with status 1 if any module imports slower than this.")
+    parser.add_argument("--json", action="store_true", help="Print one JSON object per module.")
+    args = parser.parse_args()
+
+    over_budget = False
+    for module in args.modules:
+        result = min((profile_import(module) for _ in range(max(1, args.repeat))), key=lambda run: run["total_ms"])
+        if args.json:
+            result["cumulative"] = result["cumulative"][: args.top]
+            print(json.dumps(result))
+        else:
+            _print_human(result, args.top)
+        if args.budget_ms is not None and result["total_ms"] > args.budget_ms:
+            print(f"import {module} took {result['total_ms']}ms, budget is {args.budget_ms}ms", file=sys.stderr)
+            over_budget = True
+    sys.exit(1 if over_budget else 0)
+
+
+if __name__ == "__main__":
+    main()
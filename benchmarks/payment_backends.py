@@ -0,0 +1,120 @@
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import statistics
+import time
+from types import SimpleNamespace
+
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from bot.config import load_config
+from bot.database import Base, create_engine
+from bot.migrations import init_db
+from bot.services import (
+    create_subscription,
+    ensure_user,
+    get_payment_by_payload,
+    mark_payment_success,
+    register_payment,
+)
+
+
+async def _payment_flow(factory: async_sessionmaker[AsyncSession], telegram_id: int) -> float:
+    started = time.perf_counter()
+    tg_user = SimpleNamespace(id=telegram_id, username=f"user{telegram_id}", full_name="Bench User")
+    async with factory() as session:
+        user = await ensure_user(session, tg_user)
+        payment = await register_payment(session, user, months=1, stars_amount=499, fiat_amount=499)
+        payload = payment.tg_invoice_payload
+        await session.commit()
+
+    async with factory() as session:
+        payment = await get_payment_by_payload(session, payload)
+        subscription = await create_subscription(
+            session,
+            user,
+            outline_key_id=f"bench-{telegram_id}",
+            outline_access_url=f"ss://bench-{telegram_id}",
+            months=1,
+        )
+        await mark_payment_success(session, payment, subscription)
+        await session.commit()
+    return time.perf_counter() - started
+
+
+async def run_backend(url: str, payments: int, concurrency: int, id_offset: int) -> dict:
+    engine = create_engine(url, load_config().database)
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+    await init_db(engine)
+    factory = async_sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
+
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies: list[float] = []
+    errors = 0
+
+    async def one(telegram_id: int) -> None:
+        nonlocal errors
+        async with semaphore:
+            try:
+                latencies.append(await _payment_flow(factory, telegram_id))
+            except Exception:  # noqa: BLE001
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(id_offset + i) for i in range(payments)))
+    elapsed = time.perf_counter() - started
+    await engine.dispose()
+
+    latencies.sort()
+
+    def quantile(q: float) -> float | None:
+        if not latencies:
+            return None
+        return latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1000
+
+    return {
+        "backend": engine.url.get_backend_name(),
+        "url": engine.url.render_as_string(hide_password=True),
+        "payments": payments,
+        "concurrency": concurrency,
+        "errors": errors,
+        "seconds": round(elapsed, 3),
+        "payments_per_sec": round(len(latencies) / elapsed, 1),
+        "p50_ms": quantile(0.5),
+        "p95_ms": quantile(0.95),
+        "p99_ms": quantile(0.99),
+        "mean_ms": statistics.fmean(latencies) * 1000 if latencies else None,
+    }
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description="Concurrent payment load against database backends.")
+    parser.add_argument(
+        "--url",
+        action="append",
+        dest="urls",
+        help="Database URL; repeat to compare backends (default: sqlite file in the working directory).",
+    )
+    parser.add_argument("--payments", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--json", action="store_true", help="Print one JSON object per backend.")
+    args = parser.parse_args()
+
+    urls = args.urls or ["sqlite+aiosqlite:///./bench_payments.db"]
+    for index, url in enumerate(urls):
+        result = await run_backend(url, args.payments, args.concurrency, id_offset=(index + 1) * 10**9)
+        if args.json:
+            print(json.dumps(result))
+        else:
+            print(
+                f"{result['url']}: {result['payments_per_sec']} payments/s, "
+                f"p50={result['p50_ms']:.1f}ms p95={result['p95_ms']:.1f}ms p99={result['p99_ms']:.1f}ms, "
+                f"errors={result['errors']}"
+            )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
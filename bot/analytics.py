@@ -0,0 +1,47 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+from functools import cached_property
+
+from .config import AnalyticsConfig, load_config
+from .deps import db_session
+from .services import rollup_revenue
+
+logger = logging.getLogger(__name__)
+
+
+class RevenueAggregator:
+    def __init__(self) -> None:
+        self._task: asyncio.Task | None = None
+
+    @cached_property
+    def config(self) -> AnalyticsConfig:
+        return load_config().analytics
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run(), name="revenue-aggregator")
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self.aggregate()
+            except Exception:
+                logger.exception("Revenue rollup failed")
+            await asyncio.sleep(self.config.interval)
+
+    async def aggregate(self) -> int:
+        async with db_session() as session:
+            days = await rollup_revenue(session, self.config.lag)
+        if days:
+            logger.debug("Rebuilt revenue rollup for %s days", days)
+        return days
+
+
+revenue_aggregator = RevenueAggregator()
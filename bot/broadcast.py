@@ -0,0 +1,201 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
+from functools import cached_property
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramAPIError, TelegramRetryAfter
+
+from .config import BotConfig, load_config
+from .database import BroadcastStatus
+from .deps import db_session
+from .services import fetch_user_chunk, get_broadcast, list_running_broadcasts, save_broadcast_checkpoint
+
+logger = logging.getLogger(__name__)
+
+MAX_SEND_ATTEMPTS = 3
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float | None = None) -> None:
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float) -> None:
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+async def send_with_backoff(bot: Bot, bucket: TokenBucket, chat_id: int, text: str, **kwargs) -> bool:
+    for _ in range(MAX_SEND_ATTEMPTS):
+        await bucket.acquire()
+        try:
+            await bot.send_message(chat_id, text, **kwargs)
+            return True
+        except TelegramRetryAfter as exc:
+            logger.warning("Flood control hit, pausing sends for %ss", exc.retry_after)
+            bucket.pause(exc.retry_after)
+        except TelegramAPIError as exc:
+            logger.debug("Send failed for chat %s: %s", chat_id, exc)
+            return False
+        except Exception as exc:  # noqa: BLE001
+            logger.warning("Send failed for chat %s: %s", chat_id, exc)
+            return False
+    return False
+
+
+@dataclass(slots=True)
+class _Progress:
+    total: int
+    sent: int
+    failed: int
+
+
+class BroadcastEngine:
+    def __init__(self) -> None:
+        self._tasks: dict[int, asyncio.Task] = {}
+
+    @cached_property
+    def config(self) -> BotConfig:
+        return load_config()
+
+    @cached_property
+    def bucket(self) -> TokenBucket:
+        return TokenBucket(self.config.broadcast_rate_per_second)
+
+    def start(self, bot: Bot, broadcast_id: int) -> None:
+        if broadcast_id in self._tasks:
+            return
+        task = asyncio.create_task(self._run(bot, broadcast_id), name=f"broadcast-{broadcast_id}")
+        self._tasks[broadcast_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(broadcast_id, None))
+
+    async def resume_pending(self, bot: Bot) -> None:
+        async with db_session() as session:
+            broadcast_ids = await list_running_broadcasts(session)
+        for broadcast_id in broadcast_ids:
+            logger.info("Resuming broadcast %s from checkpoint", broadcast_id)
+            self.start(bot, broadcast_id)
+
+    async def wait(self) -> None:
+        while self._tasks:
+            await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+
+    async def stop(self) -> None:
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _run(self, bot: Bot, broadcast_id: int) -> None:
+        async with db_session() as session:
+            broadcast = await get_broadcast(session, broadcast_id)
+        if broadcast is None or broadcast.status != BroadcastStatus.RUNNING:
+            return
+
+        progress = _Progress(total=broadcast.total, sent=broadcast.sent, failed=broadcast.failed)
+        queue: asyncio.Queue[int] = asyncio.Queue(maxsize=self.config.broadcast_chunk_size)
+        workers = [
+            asyncio.create_task(self._worker(bot, queue, broadcast.text, progress))
+            for _ in range(self.config.broadcast_workers)
+        ]
+        last_user_id = broadcast.last_user_id
+        last_report = time.monotonic()
+        try:
+            while True:
+                async with db_session() as session:
+                    chunk = await fetch_user_chunk(session, last_user_id, self.config.broadcast_chunk_size)
+                if not chunk:
+                    break
+                for _, telegram_id in chunk:
+                    await queue.put(telegram_id)
+                await queue.join()
+
+                last_user_id = chunk[-1][0]
+                async with db_session() as session:
+                    await save_broadcast_checkpoint(
+                        session, broadcast_id, last_user_id, progress.sent, progress.failed
+                    )
+                if time.monotonic() - last_report >= self.config.broadcast_progress_interval:
+                    last_report = time.monotonic()
+                    await self._report(bot, broadcast.admin_chat_id, broadcast.progress_message_id, progress)
+
+            async with db_session() as session:
+                await save_broadcast_checkpoint(
+                    session,
+                    broadcast_id,
+                    last_user_id,
+                    progress.sent,
+                    progress.failed,
+                    status=BroadcastStatus.DONE,
+                )
+        except Exception:
+            logger.exception("Broadcast %s crashed at user_id=%s", broadcast_id, last_user_id)
+            raise
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+
+        logger.info(
+            "Broadcast %s finished: sent=%s failed=%s", broadcast_id, progress.sent, progress.failed
+        )
+        await self._report(bot, broadcast.admin_chat_id, broadcast.progress_message_id, progress)
+        try:
+            await bot.send_message(
+                broadcast.admin_chat_id,
+                f"Готово. Отправлено: {progress.sent}, ошибок: {progress.failed}.",
+            )
+        except Exception as exc:  # noqa: BLE001
+            logger.warning("Failed to report broadcast %s result: %s", broadcast_id, exc)
+
+    async def _worker(self, bot: Bot, queue: asyncio.Queue[int], text: str, progress: _Progress) -> None:
+        while True:
+            telegram_id = await queue.get()
+            try:
+                if await send_with_backoff(bot, self.bucket, telegram_id, text):
+                    progress.sent += 1
+                else:
+                    progress.failed += 1
+            finally:
+                queue.task_done()
+
+    async def _report(
+        self, bot: Bot, chat_id: int, message_id: int | None, progress: _Progress
+    ) -> None:
+        if message_id is None:
+            return
+        done = progress.sent + progress.failed
+        percent = min(100, 100 * done // progress.total) if progress.total else 100
+        try:
+            await bot.edit_message_text(
+                f"Рассылка: {done}/{progress.total} ({percent}%)\n"
+                f"Отправлено: {progress.sent}, ошибок: {progress.failed}.",
+                chat_id=chat_id,
+                message_id=message_id,
+            )
+        except Exception as exc:  # noqa: BLE001
+            logger.debug("Failed to update broadcast progress: %s", exc)
+
+
+broadcaster = BroadcastEngine()
@@ -0,0 +1,62 @@
+from __future__ import annotations
+
+import asyncio
+import datetime as dt
+import logging
+from functools import cached_property
+
+from .config import load_config
+from .deps import db_session
+from .plans import reload_plan_catalog
+from .services import evict_changed_subscriptions, get_plan_catalog_version
+
+logger = logging.getLogger(__name__)
+
+# Slack for clock skew between processes and for rows committed after their updated_at.
+OVERLAP_SECONDS = 2.0
+
+
+class CacheSync:
+    def __init__(self) -> None:
+        self._task: asyncio.Task | None = None
+        self._checked_at = dt.datetime.now(dt.timezone.utc)
+        self._plan_version: int | None = None
+
+    @cached_property
+    def interval(self) -> float:
+        return load_config().cache_sync_interval
+
+    def start(self) -> None:
+        if self.interval <= 0:
+            return
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run(), name="cache-sync")
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.sync()
+            except Exception:
+                logger.exception("Cache sync failed")
+
+    async def sync(self) -> int:
+        started = dt.datetime.now(dt.timezone.utc)
+        since = self._checked_at - dt.timedelta(seconds=self.interval + OVERLAP_SECONDS)
+        async with db_session() as session:
+            evicted = await evict_changed_subscriptions(session, since)
+            version = await get_plan_catalog_version(session)
+            if version != self._plan_version:
+                # /reload_plans ran in some process; the first pass also covers a reload that raced startup.
+                await reload_plan_catalog(session)
+                self._plan_version = version
+        self._checked_at = started
+        return evicted
+
+
+cache_sync = CacheSync()
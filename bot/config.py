@@ -1,5 +1,6 @@
+import json
 import os
-from dataclasses import dataclass
+from dataclasses import dataclass, replace
 from functools import lru_cache
 
 
@@ -7,7 +8,104 @@ from functools import lru_cache
 class OutlineConfig:
     api_url: str
     cert_sha256: str
-    timeout: int = 10
+    server_id: str = "default"
+    connect_timeout: float = 3.0
+    read_timeout: float = 10.0
+    max_retries: int = 3
+    backoff_base: float = 0.2
+    backoff_max: float = 5.0
+    breaker_failure_threshold: int = 5
+    breaker_reset_timeout: float = 30.0
+    hedge_requests: bool = False
+    hedge_min_delay: float = 0.05
+
+
+@dataclass(frozen=True)
+class KeyPoolConfig:
+    low_water: int = 20
+    target: int = 50
+    concurrency: int = 4
+    refill_interval: float = 60.0
+
+
+@dataclass(frozen=True)
+class SweeperConfig:
+    interval: float = 300.0
+    batch_size: int = 500
+    concurrency: int = 8
+    grace_period: float = 0.0
+
+
+@dataclass(frozen=True)
+class DatabaseConfig:
+    pool_size: int = 10
+    max_overflow: int = 20
+    pool_timeout: float = 30.0
+    pool_recycle: int = 1800
+    statement_cache_size: int = 500
+    sqlite_busy_timeout_ms: int = 5000
+    sqlite_mmap_size: int = 256 * 1024 * 1024
+    slow_query_ms: float = 200.0
+    auto_migrate: bool = True
+
+
+@dataclass(frozen=True)
+class WebhookConfig:
+    base_url: str = ""
+    path: str = "/telegram/webhook"
+    secret: str = ""
+    host: str = "0.0.0.0"
+    port: int = 8080
+    workers: int = 1
+    max_connections: int = 100
+
+
+@dataclass(frozen=True)
+class UsageConfig:
+    interval: float = 300.0
+    raw_retention_hours: float = 48.0
+    quota_gb: float = 0.0
+    concurrency: int = 8
+
+
+@dataclass(frozen=True)
+class ReminderConfig:
+    offsets_days: tuple[int, ...] = (3, 1)
+    interval: float = 900.0
+    batch_size: int = 500
+    concurrency: int = 16
+
+
+@dataclass(frozen=True)
+class AnalyticsConfig:
+    interval: float = 60.0
+    lag: float = 300.0
+
+
+@dataclass(frozen=True)
+class JobsConfig:
+    workers: int = 4
+    poll_interval: float = 2.0
+    lease: float = 120.0
+    max_attempts: int = 8
+    backoff_base: float = 2.0
+    backoff_max: float = 300.0
+
+
+@dataclass(frozen=True)
+class MetricsConfig:
+    host: str = "127.0.0.1"
+    port: int = 9100
+
+
+@dataclass(frozen=True)
+class FsmConfig:
+    backend: str = "database"
+    cache_size: int = 10_000
+    cache_ttl: float = 5.0
+    flush_interval: float = 0.5
+    state_ttl: float = 86_400.0
+    cleanup_interval: float = 3600.0
 
 
 @dataclass(frozen=True)
@@ -18,22 +116,85 @@ class PaymentPlan:
     discount_hint: str | None = None
 
 
+DEFAULT_PLANS: tuple[PaymentPlan, ...] = (
+    PaymentPlan(months=1, price_rub=499, price_stars=499),
+    PaymentPlan(months=6, price_rub=2499, price_stars=2499, discount_hint="скидка 16%"),
+    PaymentPlan(months=12, price_rub=3999, price_stars=3999, discount_hint="скидка 33%"),
+)
+
+
 @dataclass(frozen=True)
 class BotConfig:
     bot_token: str
     admin_id: int
     provider_token: str
-    outline: OutlineConfig
+    outline_servers: tuple[OutlineConfig, ...]
+    outline_placement: str = "keys"
+    key_pool: KeyPoolConfig = KeyPoolConfig()
+    sweeper: SweeperConfig = SweeperConfig()
     database_url: str = "sqlite+aiosqlite:///./quazar.db"
+    database: DatabaseConfig = DatabaseConfig()
+    bot_mode: str = "polling"
+    webhook: WebhookConfig = WebhookConfig()
+    handler_concurrency: int = 100
+    fsm: FsmConfig = FsmConfig()
+    metrics: MetricsConfig = MetricsConfig()
+    jobs: JobsConfig = JobsConfig()
+    usage: UsageConfig = UsageConfig()
+    reminders: ReminderConfig = ReminderConfig()
+    analytics: AnalyticsConfig = AnalyticsConfig()
     rate_limit_per_minute: int = 5
+    rate_limit_callbacks_per_minute: int = 30
+    rate_limit_backend: str = "memory"
+    redis_url: str = "redis://localhost:6379/0"
+    broadcast_rate_per_second: float = 28.0
+    broadcast_workers: int = 16
+    broadcast_chunk_size: int = 500
+    export_chunk_size: int = 2000
+    broadcast_progress_interval: float = 15.0
+    stats_cache_ttl: float = 30.0
+    invoice_secret: str = ""
+    pending_invoice_cache_size: int = 10_000
+    user_cache_size: int = 50_000
+    subscription_cache_size: int = 50_000
+    subscription_cache_negative_ttl: float = 60.0
+    cache_sync_interval: float = 5.0
+
+
+def _get_bool(name: str, default: bool = False) -> bool:
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.strip().lower() in {"1", "true", "yes", "on"}
+
+
+def _get_int_list(name: str, default: str) -> list[int]:
+    return [int(item) for item in os.getenv(name, default).split(",") if item.strip()]
 
-    @property
-    def plans(self) -> list[PaymentPlan]:
-        return [
-            PaymentPlan(months=1, price_rub=499, price_stars=499),
-            PaymentPlan(months=6, price_rub=2499, price_stars=2499, discount_hint="скидка 16%"),
-            PaymentPlan(months=12, price_rub=3999, price_stars=3999, discount_hint="скидка 33%"),
-        ]
+
+def _load_outline_servers() -> tuple[OutlineConfig, ...]:
+    defaults = OutlineConfig(
+        api_url=os.getenv("OUTLINE_API_URL", "https://your-outline-server:PORT"),
+        cert_sha256=os.getenv("OUTLINE_CERT_SHA256", "your_cert_sha256"),
+        connect_timeout=float(os.getenv("OUTLINE_CONNECT_TIMEOUT", "3")),
+        read_timeout=float(os.getenv("OUTLINE_READ_TIMEOUT", "10")),
+        max_retries=int(os.getenv("OUTLINE_MAX_RETRIES", "3")),
+        breaker_failure_threshold=int(os.getenv("OUTLINE_BREAKER_THRESHOLD", "5")),
+        breaker_reset_timeout=float(os.getenv("OUTLINE_BREAKER_RESET", "30")),
+        hedge_requests=_get_bool("OUTLINE_HEDGE_REQUESTS"),
+    )
+    raw = os.getenv("OUTLINE_SERVERS")
+    if not raw:
+        return (defaults,)
+    return tuple(
+        replace(
+            defaults,
+            server_id=str(item["id"]),
+            api_url=item["api_url"],
+            cert_sha256=item["cert_sha256"],
+        )
+        for item in json.loads(raw)
+    )
 
 
 @lru_cache(maxsize=1)
@@ -42,8 +203,93 @@ def load_config() -> BotConfig:
         bot_token=os.getenv("BOT_TOKEN", "your_token"),
         admin_id=int(os.getenv("ADMIN_ID", "123456789")),
         provider_token=os.getenv("PROVIDER_TOKEN", "your_provider_token"),
-        outline=OutlineConfig(
-            api_url=os.getenv("OUTLINE_API_URL", "https://your-outline-server:PORT"),
-            cert_sha256=os.getenv("OUTLINE_CERT_SHA256", "your_cert_sha256"),
+        bot_mode=os.getenv("BOT_MODE", "polling"),
+        webhook=WebhookConfig(
+            base_url=os.getenv("WEBHOOK_BASE_URL", ""),
+            path=os.getenv("WEBHOOK_PATH", "/telegram/webhook"),
+            secret=os.getenv("WEBHOOK_SECRET", ""),
+            host=os.getenv("WEBHOOK_HOST", "0.0.0.0"),
+            port=int(os.getenv("WEBHOOK_PORT", "8080")),
+            workers=int(os.getenv("WEBHOOK_WORKERS", "1")),
+            max_connections=int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "100")),
+        ),
+        handler_concurrency=int(os.getenv("HANDLER_CONCURRENCY", "100")),
+        fsm=FsmConfig(
+            backend=os.getenv("FSM_STORAGE", "database"),
+            cache_size=int(os.getenv("FSM_CACHE_SIZE", "10000")),
+            cache_ttl=float(os.getenv("FSM_CACHE_TTL", "5")),
+            flush_interval=float(os.getenv("FSM_FLUSH_INTERVAL", "0.5")),
+            state_ttl=float(os.getenv("FSM_STATE_TTL", "86400")),
+            cleanup_interval=float(os.getenv("FSM_CLEANUP_INTERVAL", "3600")),
+        ),
+        metrics=MetricsConfig(
+            host=os.getenv("METRICS_HOST", "127.0.0.1"),
+            port=int(os.getenv("METRICS_PORT", "9100")),
+        ),
+        jobs=JobsConfig(
+            workers=int(os.getenv("JOB_WORKERS", "4")),
+            poll_interval=float(os.getenv("JOB_POLL_INTERVAL", "2")),
+            lease=float(os.getenv("JOB_LEASE", "120")),
+            max_attempts=int(os.getenv("JOB_MAX_ATTEMPTS", "8")),
+            backoff_base=float(os.getenv("JOB_BACKOFF_BASE", "2")),
+            backoff_max=float(os.getenv("JOB_BACKOFF_MAX", "300")),
+        ),
+        usage=UsageConfig(
+            interval=float(os.getenv("USAGE_INTERVAL", "300")),
+            raw_retention_hours=float(os.getenv("USAGE_RAW_RETENTION_HOURS", "48")),
+            quota_gb=float(os.getenv("USAGE_QUOTA_GB", "0")),
+            concurrency=int(os.getenv("USAGE_CONCURRENCY", "8")),
+        ),
+        reminders=ReminderConfig(
+            offsets_days=tuple(sorted(set(_get_int_list("REMINDER_OFFSETS_DAYS", "3,1")), reverse=True)),
+            interval=float(os.getenv("REMINDER_INTERVAL", "900")),
+            batch_size=int(os.getenv("REMINDER_BATCH_SIZE", "500")),
+            concurrency=int(os.getenv("REMINDER_CONCURRENCY", "16")),
+        ),
+        analytics=AnalyticsConfig(
+            interval=float(os.getenv("ANALYTICS_INTERVAL", "60")),
+            lag=float(os.getenv("ANALYTICS_LAG", "300")),
+        ),
+        rate_limit_per_minute=int(os.getenv("RATE_LIMIT_PER_MINUTE", "5")),
+        rate_limit_callbacks_per_minute=int(os.getenv("RATE_LIMIT_CALLBACKS_PER_MINUTE", "30")),
+        rate_limit_backend=os.getenv("RATE_LIMIT_BACKEND", "memory"),
+        redis_url=os.getenv("REDIS_URL", "redis://localhost:6379/0"),
+        database_url=os.getenv("DATABASE_URL", "sqlite+aiosqlite:///./quazar.db"),
+        database=DatabaseConfig(
+            pool_size=int(os.getenv("DB_POOL_SIZE", "10")),
+            max_overflow=int(os.getenv("DB_MAX_OVERFLOW", "20")),
+            pool_timeout=float(os.getenv("DB_POOL_TIMEOUT", "30")),
+            pool_recycle=int(os.getenv("DB_POOL_RECYCLE", "1800")),
+            statement_cache_size=int(os.getenv("DB_STATEMENT_CACHE_SIZE", "500")),
+            sqlite_busy_timeout_ms=int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000")),
+            sqlite_mmap_size=int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024))),
+            slow_query_ms=float(os.getenv("DB_SLOW_QUERY_MS", "200")),
+            auto_migrate=_get_bool("DB_AUTO_MIGRATE", True),
+        ),
+        outline_servers=_load_outline_servers(),
+        outline_placement=os.getenv("OUTLINE_PLACEMENT", "keys"),
+        key_pool=KeyPoolConfig(
+            low_water=int(os.getenv("KEY_POOL_LOW_WATER", "20")),
+            target=int(os.getenv("KEY_POOL_TARGET", "50")),
+            concurrency=int(os.getenv("KEY_POOL_CONCURRENCY", "4")),
+            refill_interval=float(os.getenv("KEY_POOL_REFILL_INTERVAL", "60")),
+        ),
+        sweeper=SweeperConfig(
+            interval=float(os.getenv("SWEEPER_INTERVAL", "300")),
+            batch_size=int(os.getenv("SWEEPER_BATCH_SIZE", "500")),
+            concurrency=int(os.getenv("SWEEPER_CONCURRENCY", "8")),
+            grace_period=float(os.getenv("SWEEPER_GRACE_PERIOD", "0")),
         ),
+        broadcast_rate_per_second=float(os.getenv("BROADCAST_RATE_PER_SECOND", "28")),
+        broadcast_workers=int(os.getenv("BROADCAST_WORKERS", "16")),
+        broadcast_chunk_size=int(os.getenv("BROADCAST_CHUNK_SIZE", "500")),
+        export_chunk_size=int(os.getenv("EXPORT_CHUNK_SIZE", "2000")),
+        broadcast_progress_interval=float(os.getenv("BROADCAST_PROGRESS_INTERVAL", "15")),
+        stats_cache_ttl=float(os.getenv("STATS_CACHE_TTL", "30")),
+        invoice_secret=os.getenv("INVOICE_SECRET", ""),
+        pending_invoice_cache_size=int(os.getenv("PENDING_INVOICE_CACHE_SIZE", "10000")),
+        user_cache_size=int(os.getenv("USER_CACHE_SIZE", "50000")),
+        subscription_cache_size=int(os.getenv("SUBSCRIPTION_CACHE_SIZE", "50000")),
+        subscription_cache_negative_ttl=float(os.getenv("SUBSCRIPTION_CACHE_NEGATIVE_TTL", "60")),
+        cache_sync_interval=float(os.getenv("CACHE_SYNC_INTERVAL", "5")),
     )
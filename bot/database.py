@@ -1,12 +1,33 @@
 from __future__ import annotations
 
 import datetime as dt
+import logging
+import time
 
-from sqlalchemy import BigInteger, DateTime, ForeignKey, Integer, Numeric, String, func
-from sqlalchemy.ext.asyncio import AsyncAttrs, AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy import (
+    BigInteger,
+    Boolean,
+    Date,
+    DateTime,
+    ForeignKey,
+    Index,
+    Integer,
+    JSON,
+    Numeric,
+    String,
+    Text,
+    UniqueConstraint,
+    event,
+    func,
+    make_url,
+)
+from sqlalchemy.ext.asyncio import AsyncAttrs, AsyncEngine, AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
 
-from .config import load_config
+from .config import DatabaseConfig, load_config
+from .metrics import db_query_duration, db_slow_queries
+
+logger = logging.getLogger(__name__)
 
 
 class Base(AsyncAttrs, DeclarativeBase):
@@ -30,16 +51,26 @@ class User(Base):
 
 class Subscription(Base):
     __tablename__ = "subscriptions"
+    __table_args__ = (
+        UniqueConstraint("server_id", "outline_key_id"),
+        Index("ix_subscriptions_user_expires", "user_id", "expires_at"),
+    )
 
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
     user_id: Mapped[int] = mapped_column(ForeignKey("users.id", ondelete="CASCADE"))
-    outline_key_id: Mapped[str] = mapped_column(String(128), unique=True, index=True)
+    server_id: Mapped[str] = mapped_column(String(32), default="default", server_default="default")
+    outline_key_id: Mapped[str] = mapped_column(String(128), index=True)
     outline_access_url: Mapped[str] = mapped_column(String(255))
     months: Mapped[int] = mapped_column(Integer)
-    expires_at: Mapped[dt.datetime] = mapped_column(DateTime(timezone=True))
+    expires_at: Mapped[dt.datetime] = mapped_column(DateTime(timezone=True), index=True)
+    revoked_at: Mapped[dt.datetime | None] = mapped_column(DateTime(timezone=True))
     created_at: Mapped[dt.datetime] = mapped_column(
         DateTime(timezone=True), server_default=func.now()
     )
+    # Set on every insert and Core UPDATE; other processes poll it to evict their cached copies.
+    updated_at: Mapped[dt.datetime | None] = mapped_column(
+        DateTime(timezone=True), default=func.now(), onupdate=func.now(), index=True
+    )
 
     user: Mapped[User] = relationship(back_populates="subscriptions")
     payments: Mapped[list[Payment]] = relationship(back_populates="subscription")
@@ -47,6 +78,7 @@ class Subscription(Base):
 
 class PaymentStatus(str):
     PENDING = "pending"
+    PAID = "paid"
     SUCCESS = "success"
     FAILED = "failed"
 
@@ -57,26 +89,270 @@ class Payment(Base):
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
     user_id: Mapped[int] = mapped_column(ForeignKey("users.id", ondelete="CASCADE"))
     subscription_id: Mapped[int | None] = mapped_column(ForeignKey("subscriptions.id", ondelete="SET NULL"))
-    tg_invoice_payload: Mapped[str] = mapped_column(String(255))
+    tg_invoice_payload: Mapped[str] = mapped_column(String(255), unique=True)
     stars_amount: Mapped[int] = mapped_column(Integer)
     fiat_amount: Mapped[float] = mapped_column(Numeric(10, 2))
+    plan_months: Mapped[int | None] = mapped_column(Integer)
     status: Mapped[str] = mapped_column(String(20), default=PaymentStatus.PENDING, index=True)
     created_at: Mapped[dt.datetime] = mapped_column(
-        DateTime(timezone=True), server_default=func.now()
+        DateTime(timezone=True), server_default=func.now(), index=True
     )
     updated_at: Mapped[dt.datetime] = mapped_column(
-        DateTime(timezone=True), server_default=func.now(), onupdate=func.now()
+        DateTime(timezone=True), server_default=func.now(), onupdate=func.now(), index=True
     )
 
     user: Mapped[User] = relationship(back_populates="payments")
     subscription: Mapped[Subscription | None] = relationship(back_populates="payments")
 
 
-config = load_config()
-engine = create_async_engine(config.database_url, echo=False, future=True)
-async_session_factory = async_sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
+class PooledKey(Base):
+    __tablename__ = "outline_key_pool"
+    __table_args__ = (
+        UniqueConstraint("server_id", "key_id"),
+        Index("ix_outline_key_pool_unclaimed", "server_id", "claimed_at", "id"),
+    )
+
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    server_id: Mapped[str] = mapped_column(String(32), default="default", server_default="default")
+    key_id: Mapped[str] = mapped_column(String(128))
+    access_url: Mapped[str] = mapped_column(String(255))
+    claimed_by_user_id: Mapped[int | None] = mapped_column(ForeignKey("users.id", ondelete="SET NULL"))
+    claimed_at: Mapped[dt.datetime | None] = mapped_column(DateTime(timezone=True))
+    created_at: Mapped[dt.datetime] = mapped_column(
+        DateTime(timezone=True), server_default=func.now()
+    )
+
+
+class BroadcastStatus(str):
+    RUNNING = "running"
+    DONE = "done"
+
+
+class Broadcast(Base):
+    __tablename__ = "broadcasts"
+
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    admin_chat_id: Mapped[int] = mapped_column(BigInteger)
+    progress_message_id: Mapped[int | None] = mapped_column(Integer)
+    text: Mapped[str] = mapped_column(Text)
+    status: Mapped[str] = mapped_column(String(20), default=BroadcastStatus.RUNNING, index=True)
+    last_user_id: Mapped[int] = mapped_column(Integer, default=0)
+    total: Mapped[int] = mapped_column(Integer, default=0)
+    sent: Mapped[int] = mapped_column(Integer, default=0)
+    failed: Mapped[int] = mapped_column(Integer, default=0)
+    created_at: Mapped[dt.datetime] = mapped_column(
+        DateTime(timezone=True), server_default=func.now()
+    )
+    updated_at: Mapped[dt.datetime] = mapped_column(
+        DateTime(timezone=True), server_default=func.now(), onupdate=func.now()
+    )
+
+
+class StatCounterName(str):
+    USERS = "users"
+    REVENUE_STARS = "revenue_stars"
+    REVENUE_ROLLUP_WATERMARK = "revenue_rollup_watermark"
+    PLAN_CATALOG_VERSION = "plan_catalog_version"
+
+
+class StatCounter(Base):
+    __tablename__ = "stat_counters"
+
+    name: Mapped[str] = mapped_column(String(64), primary_key=True)
+    value: Mapped[int] = mapped_column(BigInteger, default=0)
+
+
+class RevenueDaily(Base):
+    __tablename__ = "revenue_daily"
+
+    day: Mapped[dt.date] = mapped_column(Date, primary_key=True)
+    # 0 collects payments created before plan_months was recorded.
+    plan_months: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=False)
+    created: Mapped[int] = mapped_column(Integer, default=0)
+    paid: Mapped[int] = mapped_column(Integer, default=0)
+    failed: Mapped[int] = mapped_column(Integer, default=0)
+    revenue_stars: Mapped[int] = mapped_column(BigInteger, default=0)
+    revenue_rub: Mapped[float] = mapped_column(Numeric(12, 2), default=0)
+
+
+class Plan(Base):
+    __tablename__ = "plans"
+
+    months: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=False)
+    price_rub: Mapped[int] = mapped_column(Integer)
+    price_stars: Mapped[int] = mapped_column(Integer)
+    discount_hint: Mapped[str | None] = mapped_column(String(64))
+    position: Mapped[int] = mapped_column(Integer, default=0)
+    is_active: Mapped[bool] = mapped_column(Boolean, default=True)
+
+
+class SubscriptionUsage(Base):
+    __tablename__ = "subscription_usage"
+
+    subscription_id: Mapped[int] = mapped_column(
+        ForeignKey("subscriptions.id", ondelete="CASCADE"), primary_key=True
+    )
+    last_counter: Mapped[int | None] = mapped_column(BigInteger)
+    bytes_used: Mapped[int] = mapped_column(BigInteger, default=0)
+    limited: Mapped[bool] = mapped_column(Boolean, default=False)
+    updated_at: Mapped[dt.datetime] = mapped_column(DateTime(timezone=True))
+
+
+class UsageSample(Base):
+    __tablename__ = "usage_samples"
+
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    subscription_id: Mapped[int] = mapped_column(Integer)
+    collected_at: Mapped[dt.datetime] = mapped_column(DateTime(timezone=True), index=True)
+    bytes: Mapped[int] = mapped_column(BigInteger)
+
+
+class UsageDaily(Base):
+    __tablename__ = "usage_daily"
+
+    subscription_id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    day: Mapped[dt.date] = mapped_column(Date, primary_key=True)
+    bytes: Mapped[int] = mapped_column(BigInteger, default=0)
+
+
+class SubscriptionReminder(Base):
+    __tablename__ = "subscription_reminders"
+
+    subscription_id: Mapped[int] = mapped_column(
+        ForeignKey("subscriptions.id", ondelete="CASCADE"), primary_key=True
+    )
+    offset_days: Mapped[int] = mapped_column(Integer, primary_key=True)
+    # The expiry this reminder was sent for; an in-place renewal moves expires_at and re-arms it.
+    expires_at: Mapped[dt.datetime] = mapped_column(DateTime(timezone=True))
+    sent_at: Mapped[dt.datetime] = mapped_column(DateTime(timezone=True), server_default=func.now())
+
+
+class JobStatus(str):
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
+
+class Job(Base):
+    __tablename__ = "jobs"
+    __table_args__ = (Index("ix_jobs_status_run_at", "status", "run_at"),)
+
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    kind: Mapped[str] = mapped_column(String(64))
+    payload: Mapped[dict] = mapped_column(JSON, default=dict)
+    dedupe_key: Mapped[str | None] = mapped_column(String(128), unique=True)
+    status: Mapped[str] = mapped_column(String(20), default=JobStatus.PENDING)
+    attempts: Mapped[int] = mapped_column(Integer, default=0)
+    max_attempts: Mapped[int] = mapped_column(Integer)
+    run_at: Mapped[dt.datetime] = mapped_column(DateTime(timezone=True))
+    locked_until: Mapped[dt.datetime | None] = mapped_column(DateTime(timezone=True))
+    last_error: Mapped[str | None] = mapped_column(Text)
+    created_at: Mapped[dt.datetime] = mapped_column(
+        DateTime(timezone=True), server_default=func.now()
+    )
+    updated_at: Mapped[dt.datetime] = mapped_column(
+        DateTime(timezone=True), server_default=func.now(), onupdate=func.now()
+    )
+
+
+class SchemaMigration(Base):
+    __tablename__ = "schema_migrations"
+
+    version: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=False)
+    name: Mapped[str] = mapped_column(String(255))
+    applied_at: Mapped[dt.datetime] = mapped_column(DateTime(timezone=True), server_default=func.now())
+
+
+class FsmRecord(Base):
+    __tablename__ = "fsm_states"
+
+    key: Mapped[str] = mapped_column(String(255), primary_key=True)
+    state: Mapped[str | None] = mapped_column(String(255))
+    data: Mapped[dict] = mapped_column(JSON, default=dict)
+    expires_at: Mapped[dt.datetime] = mapped_column(DateTime(timezone=True), index=True)
+    updated_at: Mapped[dt.datetime | None] = mapped_column(DateTime(timezone=True), index=True)
+
+
+def _sqlite_pragmas(db_config: DatabaseConfig):
+    def set_pragmas(dbapi_connection, connection_record) -> None:
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute(f"PRAGMA busy_timeout={int(db_config.sqlite_busy_timeout_ms)}")
+        cursor.execute(f"PRAGMA mmap_size={int(db_config.sqlite_mmap_size)}")
+        cursor.close()
+
+    return set_pragmas
+
+
+def _instrument_queries(engine: AsyncEngine, db_config: DatabaseConfig) -> None:
+    slow_threshold = db_config.slow_query_ms / 1000
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany) -> None:
+        conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany) -> None:
+        elapsed = time.perf_counter() - conn.info["query_started"].pop()
+        operation = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else "OTHER"
+        db_query_duration.observe(elapsed, operation)
+        if elapsed >= slow_threshold:
+            db_slow_queries.inc(operation)
+            logger.warning("Slow query (%.0f ms): %s", elapsed * 1000, " ".join(statement.split())[:500])
+
+    def handle_error(exception_context) -> None:
+        connection = exception_context.connection
+        if connection is not None and connection.info.get("query_started"):
+            connection.info["query_started"].pop()
+
+    event.listen(engine.sync_engine, "before_cursor_execute", before_cursor_execute)
+    event.listen(engine.sync_engine, "after_cursor_execute", after_cursor_execute)
+    event.listen(engine.sync_engine, "handle_error", handle_error)
+
+
+def create_engine(database_url: str, db_config: DatabaseConfig) -> AsyncEngine:
+    url = make_url(database_url)
+    if url.get_backend_name() == "sqlite":
+        engine = create_async_engine(url, echo=False)
+        event.listen(engine.sync_engine, "connect", _sqlite_pragmas(db_config))
+    else:
+        if url.get_driver_name() == "asyncpg" and "prepared_statement_cache_size" not in url.query:
+            url = url.update_query_dict(
+                {"prepared_statement_cache_size": str(db_config.statement_cache_size)}
+            )
+        engine = create_async_engine(
+            url,
+            echo=False,
+            pool_size=db_config.pool_size,
+            max_overflow=db_config.max_overflow,
+            pool_timeout=db_config.pool_timeout,
+            pool_recycle=db_config.pool_recycle,
+            pool_pre_ping=True,
+        )
+    _instrument_queries(engine, db_config)
+    return engine
+
+
+_engine: AsyncEngine | None = None
+_session_factory: async_sessionmaker[AsyncSession] | None = None
+
+
+def get_engine() -> AsyncEngine:
+    global _engine, _session_factory
+    if _engine is None:
+        config = load_config()
+        _engine = create_engine(config.database_url, config.database)
+        _session_factory = async_sessionmaker(_engine, expire_on_commit=False, class_=AsyncSession)
+    return _engine
+
+
+def get_session_factory() -> async_sessionmaker[AsyncSession]:
+    get_engine()
+    return _session_factory
 
 
-async def init_db() -> None:
-    async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
+async def dispose_engine() -> None:
+    global _engine, _session_factory
+    if _engine is not None:
+        await _engine.dispose()
+    _engine = _session_factory = None
@@ -2,12 +2,12 @@ from contextlib import asynccontextmanager
 
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from .database import async_session_factory
+from .database import get_session_factory
 
 
 @asynccontextmanager
 async def db_session() -> AsyncSession:
-    async with async_session_factory() as session:
+    async with get_session_factory()() as session:
         try:
             yield session
             await session.commit()
@@ -0,0 +1,109 @@
+from __future__ import annotations
+
+import asyncio
+import csv
+import datetime as dt
+import gzip
+import json
+import logging
+import tempfile
+from functools import cached_property
+from pathlib import Path
+from typing import IO
+
+from aiogram import Bot
+from aiogram.types import FSInputFile
+from sqlalchemy import select
+
+from .config import load_config
+from .database import Payment, Subscription, User
+from .deps import db_session
+
+logger = logging.getLogger(__name__)
+
+EXPORT_TABLES = {"users": User, "payments": Payment, "subscriptions": Subscription}
+EXPORT_FORMATS = ("csv", "jsonl")
+TELEGRAM_DOCUMENT_LIMIT = 50 * 1024 * 1024
+
+
+def _plain(value):
+    if isinstance(value, (dt.datetime, dt.date)):
+        return value.isoformat()
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    return str(value)
+
+
+def _write_rows(stream: IO[str], fmt: str, names: list[str], rows) -> None:
+    if fmt == "csv":
+        csv.writer(stream).writerows([_plain(value) for value in row] for row in rows)
+        return
+    for row in rows:
+        stream.write(json.dumps(dict(zip(names, map(_plain, row))), ensure_ascii=False))
+        stream.write("\n")
+
+
+async def export_table(name: str, fmt: str, directory: Path, chunk_size: int) -> tuple[Path, int]:
+    table = EXPORT_TABLES[name].__table__
+    names = [column.name for column in table.columns]
+    stamp = dt.datetime.now(dt.timezone.utc).strftime("%Y%m%d-%H%M%S")
+    path = directory / f"{name}-{stamp}.{fmt}.gz"
+    count = 0
+    stream = gzip.open(path, "wt", encoding="utf-8", newline="")
+    try:
+        if fmt == "csv":
+            csv.writer(stream).writerow(names)
+        # A plain read on a server-side cursor: no write lock, and only one chunk of rows in memory.
+        stmt = select(*table.columns).order_by(*table.primary_key.columns).execution_options(yield_per=chunk_size)
+        async with db_session() as session:
+            result = await session.stream(stmt)
+            async for rows in result.partitions():
+                # Compression runs off the event loop so handlers keep answering during big exports.
+                await asyncio.to_thread(_write_rows, stream, fmt, names, rows)
+                count += len(rows)
+    finally:
+        await asyncio.to_thread(stream.close)
+    return path, count
+
+
+class DataExporter:
+    def __init__(self) -> None:
+        self._task: asyncio.Task | None = None
+
+    @cached_property
+    def chunk_size(self) -> int:
+        return load_config().export_chunk_size
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self, bot: Bot, chat_id: int, tables: list[str], fmt: str) -> bool:
+        if self.running:
+            return False
+        self._task = asyncio.create_task(self._run(bot, chat_id, tables, fmt), name="data-export")
+        return True
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    async def _run(self, bot: Bot, chat_id: int, tables: list[str], fmt: str) -> None:
+        with tempfile.TemporaryDirectory(prefix="quazar-export-") as directory:
+            for name in tables:
+                try:
+                    path, count = await export_table(name, fmt, Path(directory), self.chunk_size)
+                    if path.stat().st_size > TELEGRAM_DOCUMENT_LIMIT:
+                        await bot.send_message(chat_id, f"Выгрузка {name} больше 50 МБ, Telegram её не примет.")
+                        continue
+                    await bot.send_document(chat_id, FSInputFile(path), caption=f"{name}: {count} строк")
+                except Exception as exc:  # noqa: BLE001
+                    logger.exception("Export of %s failed", name)
+                    await bot.send_message(chat_id, f"Не удалось выгрузить {name}: {exc}")
+                finally:
+                    for leftover in Path(directory).iterdir():
+                        leftover.unlink(missing_ok=True)
+
+
+data_exporter = DataExporter()
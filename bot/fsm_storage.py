@@ -0,0 +1,247 @@
+from __future__ import annotations
+
+import asyncio
+import datetime as dt
+import json
+import logging
+import time
+from abc import abstractmethod
+from collections.abc import Mapping
+from copy import copy
+from dataclasses import dataclass, field
+from typing import Any
+
+from aiogram.exceptions import DataNotDictLikeError
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, StateType, StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+
+from .cache import LRUCache
+from .config import BotConfig, FsmConfig
+from .deps import db_session
+from .services import fsm_keys_changed_since, load_fsm_record, purge_expired_fsm_records, save_fsm_records
+
+logger = logging.getLogger(__name__)
+
+# Slack for clock skew between processes and for rows committed after their updated_at.
+CHANGE_FEED_OVERLAP = 2.0
+
+
+@dataclass(frozen=True, slots=True)
+class _Record:
+    state: str | None = None
+    data: dict[str, Any] = field(default_factory=dict)
+
+
+class WriteBehindStorage(BaseStorage):
+    # Cached entries (misses included) are kept until this process writes them or another process's
+    # write shows up in the backend's change feed.
+    def __init__(self, config: FsmConfig) -> None:
+        self._config = config
+        self._key_builder = DefaultKeyBuilder(
+            prefix="fsm", with_bot_id=True, with_business_connection_id=True, with_destiny=True
+        )
+        self._cache: LRUCache[str, _Record] = LRUCache(config.cache_size, ttl=config.state_ttl)
+        self._feed_checked_at = dt.datetime.now(dt.timezone.utc)
+        self._feed_generation = 0
+        self._dirty: dict[str, _Record] = {}
+        self._flushing: dict[str, _Record] = {}
+        self._flusher: asyncio.Task | None = None
+
+    @abstractmethod
+    async def _load(self, name: str) -> _Record | None: ...
+
+    @abstractmethod
+    async def _store(self, records: dict[str, _Record]) -> None: ...
+
+    @abstractmethod
+    async def _changed_since(self, since: dt.datetime) -> list[str]: ...
+
+    async def _cleanup(self) -> None:
+        pass
+
+    async def _close_backend(self) -> None:
+        pass
+
+    def _pending(self, name: str) -> _Record | None:
+        record = self._dirty.get(name)
+        return record if record is not None else self._flushing.get(name)
+
+    async def _get(self, name: str) -> _Record:
+        self._ensure_flusher()
+        record = self._pending(name)
+        if record is None:
+            record = self._cache.get(name)
+        if record is not None:
+            return record
+
+        generation = self._feed_generation
+        loaded = await self._load(name) or _Record()
+        # A write may have landed while the backend was being read.
+        record = self._pending(name) or self._cache.get(name)
+        if record is not None:
+            return record
+        # If the feed was read meanwhile, this row may predate an eviction; keep it only briefly.
+        self._cache.set(name, loaded, ttl=self._config.cache_ttl if generation != self._feed_generation else None)
+        return loaded
+
+    def _put(self, name: str, record: _Record) -> None:
+        self._dirty[name] = record
+        self._cache.set(name, record)
+        self._ensure_flusher()
+
+    def _ensure_flusher(self) -> None:
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.create_task(self._run(), name="fsm-flush")
+
+    async def _run(self) -> None:
+        last_cleanup = last_feed = time.monotonic()
+        while True:
+            await asyncio.sleep(self._config.flush_interval)
+            await self.flush()
+            if time.monotonic() - last_feed >= self._config.cache_ttl:
+                last_feed = time.monotonic()
+                try:
+                    await self.evict_changed()
+                except Exception:
+                    logger.exception("Failed to read the FSM change feed")
+            if time.monotonic() - last_cleanup >= self._config.cleanup_interval:
+                last_cleanup = time.monotonic()
+                try:
+                    await self._cleanup()
+                except Exception:
+                    logger.exception("FSM storage cleanup failed")
+
+    async def evict_changed(self) -> int:
+        started = dt.datetime.now(dt.timezone.utc)
+        since = self._feed_checked_at - dt.timedelta(seconds=self._config.cache_ttl + CHANGE_FEED_OVERLAP)
+        names = await self._changed_since(since)
+        self._feed_generation += 1
+        evicted = 0
+        for name in names:
+            if self._pending(name) is None and self._cache.pop(name) is not None:
+                evicted += 1
+        self._feed_checked_at = started
+        return evicted
+
+    async def flush(self) -> None:
+        if not self._dirty:
+            return
+        self._flushing, self._dirty = self._dirty, {}
+        try:
+            await self._store(self._flushing)
+        except Exception:
+            logger.exception("Failed to persist %s FSM records, will retry", len(self._flushing))
+            for name, record in self._flushing.items():
+                self._dirty.setdefault(name, record)
+        finally:
+            self._flushing = {}
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        name = self._key_builder.build(key)
+        value = state.state if isinstance(state, State) else state
+        record = await self._get(name)
+        if record.state != value:
+            self._put(name, _Record(value, record.data))
+
+    async def get_state(self, key: StorageKey) -> str | None:
+        return (await self._get(self._key_builder.build(key))).state
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        if not isinstance(data, dict):
+            msg = f"Data must be a dict or dict-like object, got {type(data).__name__}"
+            raise DataNotDictLikeError(msg)
+        name = self._key_builder.build(key)
+        record = await self._get(name)
+        if record.data != data:
+            self._put(name, _Record(record.state, data.copy()))
+
+    async def get_data(self, key: StorageKey) -> dict[str, Any]:
+        return (await self._get(self._key_builder.build(key))).data.copy()
+
+    async def get_value(self, storage_key: StorageKey, dict_key: str, default: Any | None = None) -> Any | None:
+        data = (await self._get(self._key_builder.build(storage_key))).data
+        return copy(data.get(dict_key, default))
+
+    async def close(self) -> None:
+        if self._flusher is not None:
+            self._flusher.cancel()
+            await asyncio.gather(self._flusher, return_exceptions=True)
+            self._flusher = None
+        await self.flush()
+        await self._close_backend()
+
+
+class SQLAlchemyStorage(WriteBehindStorage):
+    async def _load(self, name: str) -> _Record | None:
+        async with db_session() as session:
+            row = await load_fsm_record(session, name)
+        return None if row is None else _Record(*row)
+
+    async def _store(self, records: dict[str, _Record]) -> None:
+        expires_at = dt.datetime.now(dt.timezone.utc) + dt.timedelta(seconds=self._config.state_ttl)
+        async with db_session() as session:
+            await save_fsm_records(
+                session,
+                {name: (record.state, record.data) for name, record in records.items()},
+                expires_at,
+            )
+
+    async def _changed_since(self, since: dt.datetime) -> list[str]:
+        async with db_session() as session:
+            return await fsm_keys_changed_since(session, since)
+
+    async def _cleanup(self) -> None:
+        async with db_session() as session:
+            purged = await purge_expired_fsm_records(session)
+        if purged:
+            logger.info("Purged %s expired FSM records", purged)
+
+
+class RedisStorage(WriteBehindStorage):
+    # Sorted set of written names scored by write time; other processes read it as their change feed.
+    FEED_KEY = "quazar:fsm:changes"
+
+    def __init__(self, config: FsmConfig, url: str) -> None:
+        super().__init__(config)
+        try:
+            from redis.asyncio import Redis
+        except ImportError as exc:
+            raise RuntimeError("FSM_STORAGE=redis requires the 'redis' package") from exc
+        self._redis = Redis.from_url(url)
+
+    async def _load(self, name: str) -> _Record | None:
+        raw = await self._redis.get(name)
+        if raw is None:
+            return None
+        state, data = json.loads(raw)
+        return _Record(state, data)
+
+    async def _store(self, records: dict[str, _Record]) -> None:
+        ttl_ms = int(self._config.state_ttl * 1000)
+        now = time.time()
+        async with self._redis.pipeline(transaction=False) as pipe:
+            for name, record in records.items():
+                if record.state is None and not record.data:
+                    pipe.delete(name)
+                else:
+                    pipe.set(name, json.dumps([record.state, record.data]), px=ttl_ms)
+            pipe.zadd(self.FEED_KEY, {name: now for name in records})
+            # Cached entries live at most state_ttl, so older feed entries can no longer evict anything.
+            pipe.zremrangebyscore(self.FEED_KEY, "-inf", now - self._config.state_ttl)
+            await pipe.execute()
+
+    async def _changed_since(self, since: dt.datetime) -> list[str]:
+        names = await self._redis.zrangebyscore(self.FEED_KEY, since.timestamp(), "+inf")
+        return [name.decode() for name in names]
+
+    async def _close_backend(self) -> None:
+        await self._redis.aclose()
+
+
+def build_fsm_storage(config: BotConfig) -> BaseStorage:
+    if config.fsm.backend == "redis":
+        return RedisStorage(config.fsm, config.redis_url)
+    if config.fsm.backend == "database":
+        return SQLAlchemyStorage(config.fsm)
+    return MemoryStorage()
@@ -1,47 +1,145 @@
 from __future__ import annotations
 
-import asyncio
+import datetime as dt
 import logging
 
-from aiogram import F, Router
-from aiogram.filters import Command
+from aiogram import Router
+from aiogram.filters import Command, CommandObject
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.types import Message
 
+from ..broadcast import broadcaster
 from ..config import load_config
-from ..services import compute_stats, list_users
+from ..export import EXPORT_FORMATS, EXPORT_TABLES, data_exporter
+from ..middlewares import db_usage
+from ..outline_client import outline_servers
+from ..plans import months_label, reload_plan_catalog
+from ..services import (
+    bump_plan_catalog_version,
+    compute_stats,
+    count_open_jobs,
+    count_users,
+    create_broadcast,
+    revenue_report,
+)
 
 logger = logging.getLogger(__name__)
-router = Router()
-config = load_config()
 
 
-def is_admin(user_id: int) -> bool:
-    return user_id == config.admin_id
+REPORT_PERIODS = {
+    "today": ("сегодня", 0),
+    "7d": ("7 дней", 6),
+    "30d": ("30 дней", 29),
+    "all": ("всё время", None),
+}
 
 
-@router.message(Command("admin"))
-async def admin_dashboard(message: Message, session):
+def is_admin(user_id: int) -> bool:
+    return user_id == load_config().admin_id
+
+
+async def _revenue_lines(session, period: str) -> list[str]:
+    title, days_back = REPORT_PERIODS[period]
+    since = None
+    if days_back is not None:
+        since = dt.datetime.now(dt.timezone.utc).date() - dt.timedelta(days=days_back)
+    rows = await revenue_report(session, since)
+    created = sum(row[1] for row in rows)
+    paid = sum(row[2] for row in rows)
+    failed = sum(row[3] for row in rows)
+    stars = sum(row[4] for row in rows)
+    rub = sum(row[5] for row in rows)
+    conversion = f"{100 * paid / created:.1f}%" if created else "—"
+    lines = [
+        f"💰 Выручка за {title} (UTC)",
+        f"Счетов: {created}, оплачено: {paid} (конверсия {conversion}), ошибок выдачи: {failed}",
+        f"Stars: {stars}, ₽: {rub:.0f}",
+    ]
+    for plan_months, _, plan_paid, _, plan_stars, _ in rows:
+        if plan_paid:
+            label = months_label(plan_months) if plan_months else "Без тарифа"
+            lines.append(f"  {label}: {plan_paid} оплат, {plan_stars} ⭐")
+    return lines
+
+
+async def admin_dashboard(message: Message, session, command: CommandObject):
     if not is_admin(message.from_user.id):
         await message.answer("Нет доступа. Это приватная комната боссов.")
         return
 
+    period = (command.args or "today").strip().lower()
+    if period not in REPORT_PERIODS:
+        await message.answer("Период: /admin today | 7d | 30d | all")
+        return
+
     stats = await compute_stats(session)
+    server_lines = []
+    for server_id, server_stats in outline_servers.stats().items():
+        create_p95 = server_stats["calls"].get("create_key", {}).get("p95")
+        create_p95_text = f"{create_p95 * 1000:.0f} мс" if create_p95 is not None else "—"
+        server_lines.append(
+            f"Outline {server_id}: {server_stats['breaker']}, ключей: {server_stats['active_keys']}, "
+            f"p95 create_key: {create_p95_text}\n"
+        )
     text = (
         "📊 Статистика Quazar VPN\n"
         f"Пользователей: {stats['total_users']}\n"
         f"Доход (Stars): {stats['total_revenue_stars']}\n"
-        "Держим уровень."
+        f"Задач в очереди: {await count_open_jobs(session)}\n"
+        + "".join(server_lines)
+        + "\n"
+        + "\n".join(await _revenue_lines(session, period))
+        + "\n\nДержим уровень."
     )
     await message.answer(text)
 
 
+async def db_stats(message: Message):
+    if not is_admin(message.from_user.id):
+        await message.answer("Нет доступа.")
+        return
+
+    lines = ["🗄 Обращения к БД по хендлерам (апдейтов / с БД):"]
+    for name, usage in sorted(db_usage.items(), key=lambda item: -item[1].updates):
+        lines.append(f"{name}: {usage.updates} / {usage.db_hits}")
+    await message.answer("\n".join(lines))
+
+
+async def reload_plans(message: Message, session):
+    if not is_admin(message.from_user.id):
+        await message.answer("Нет доступа.")
+        return
+
+    catalog = await reload_plan_catalog(session)
+    await bump_plan_catalog_version(session)
+    await session.commit()
+    await message.answer(f"Тарифы перезагружены ({len(catalog.plans)}):\n\n{catalog.price_text}")
+
+
+async def export_data(message: Message, command: CommandObject):
+    if not is_admin(message.from_user.id):
+        await message.answer("Нет доступа.")
+        return
+
+    args = (command.args or "").lower().split()
+    tables = [arg for arg in args if arg in EXPORT_TABLES] or list(EXPORT_TABLES)
+    formats = [arg for arg in args if arg in EXPORT_FORMATS]
+    unknown = set(args) - set(EXPORT_TABLES) - set(EXPORT_FORMATS)
+    if unknown or len(formats) > 1:
+        await message.answer("Формат: /export [users] [payments] [subscriptions] [csv|jsonl]")
+        return
+
+    if not data_exporter.start(message.bot, message.chat.id, tables, formats[0] if formats else "csv"):
+        await message.answer("Выгрузка уже идёт, дождись файлов.")
+        return
+    await message.answer(f"Готовлю выгрузку: {', '.join(tables)}. Пришлю файлы, когда будут готовы.")
+
+
 class BroadcastStates(StatesGroup):
     waiting_for_message = State()
 
 
-@router.message(Command("broadcast"))
 async def start_broadcast(message: Message, state: FSMContext):
     if not is_admin(message.from_user.id):
         await message.answer("Нет доступа.")
@@ -51,32 +149,37 @@ async def start_broadcast(message: Message, state: FSMContext):
     await state.set_state(BroadcastStates.waiting_for_message)
 
 
-@router.message(Command("cancel"), BroadcastStates.waiting_for_message)
 async def cancel_broadcast(message: Message, state: FSMContext):
     await state.clear()
     await message.answer("Рассылка отменена.")
 
 
-@router.message(BroadcastStates.waiting_for_message)
 async def process_broadcast(message: Message, state: FSMContext, session):
     if not is_admin(message.from_user.id):
         await message.answer("Нет доступа.")
         return
 
     await state.clear()
-    text = message.text
-    users = await list_users(session)
-    await message.answer(f"Рассылаю по {len(users)} аккаунтам...")
-
-    sent = 0
-    failed = 0
-    for user in users:
-        try:
-            await message.bot.send_message(user.telegram_id, text)
-            sent += 1
-            await asyncio.sleep(0.05)
-        except Exception as exc:  # noqa: BLE001
-            failed += 1
-            logger.warning("Broadcast failed for user %s: %s", user.telegram_id, exc)
-
-    await message.answer(f"Готово. Отправлено: {sent}, ошибок: {failed}.")
+    total = await count_users(session)
+    progress_message = await message.answer(f"Рассылаю по {total} аккаунтам...")
+    broadcast = await create_broadcast(
+        session,
+        admin_chat_id=message.chat.id,
+        text=message.text,
+        total=total,
+        progress_message_id=progress_message.message_id,
+    )
+    await session.commit()
+    broadcaster.start(message.bot, broadcast.id)
+
+
+def create_router() -> Router:
+    router = Router(name="admin")
+    router.message.register(admin_dashboard, Command("admin"))
+    router.message.register(db_stats, Command("dbstats"))
+    router.message.register(reload_plans, Command("reload_plans"))
+    router.message.register(export_data, Command("export"))
+    router.message.register(start_broadcast, Command("broadcast"))
+    router.message.register(cancel_broadcast, Command("cancel"), BroadcastStates.waiting_for_message)
+    router.message.register(process_broadcast, BroadcastStates.waiting_for_message)
+    return router
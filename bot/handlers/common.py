@@ -1,26 +1,22 @@
 from __future__ import annotations
 
-import time
-
 from aiogram import F, Router
 from aiogram.filters import Command, CommandStart
 from aiogram.types import CallbackQuery, LabeledPrice, Message
 
 from ..config import load_config
+from ..invoices import PendingInvoice, pending_invoices
 from ..keyboards import main_menu_keyboard, plans_keyboard, renew_keyboard
+from ..plans import plan_catalog
 from ..services import (
     ensure_user,
     format_subscription_message,
     get_active_subscription,
+    get_subscription_usage,
     register_payment,
-    resolve_plan_by_payload,
 )
 
-router = Router()
-config = load_config()
-
 
-@router.message(CommandStart())
 async def cmd_start(message: Message) -> None:
     await message.answer(
         "Добро пожаловать в Quazar VPN 🚀\nАнонимность на скорости света. Полная свобода интернета.",
@@ -28,12 +24,10 @@ async def cmd_start(message: Message) -> None:
     )
 
 
-@router.message(Command("start"))
 async def fallback_start(message: Message) -> None:
     await cmd_start(message)
 
 
-@router.callback_query(F.data == "back_main")
 async def back_to_main(call: CallbackQuery) -> None:
     await call.message.edit_text(
         "Выбери свой ход, босс.",
@@ -42,50 +36,51 @@ async def back_to_main(call: CallbackQuery) -> None:
     await call.answer()
 
 
-@router.callback_query(F.data == "plans")
 async def show_plans(call: CallbackQuery) -> None:
-    text_lines = [
-        "🔥 Тарифы Quazar VPN:",
-        "1 месяц — 499₽",
-        "6 месяцев — 2499₽ (скидка 16%)",
-        "12 месяцев — 3999₽ (скидка 33%)",
-        "",
-        "Оплата Stars. Мгновенный доступ после оплаты.",
-    ]
-    await call.message.edit_text("\n".join(text_lines), reply_markup=plans_keyboard())
+    catalog = plan_catalog()
+    await call.message.edit_text(catalog.price_text, reply_markup=catalog.keyboard)
     await call.answer("Босс, выбирай мощность.")
 
 
-@router.callback_query(F.data.startswith("plan:"))
 async def select_plan(call: CallbackQuery, session):
-    plan_months = int(call.data.split(":")[1])
-    plan = next((p for p in config.plans if p.months == plan_months), None)
+    plan = plan_catalog().by_callback(call.data)
     if not plan:
         await call.answer("Тариф не найден. Попробуй ещё раз.", show_alert=True)
         return
 
     user = await ensure_user(session, call.from_user)
-    payload = f"plan-{plan.months}m-{user.telegram_id}-{int(time.time())}"
-    await register_payment(
+    payment = await register_payment(
         session=session,
         user=user,
-        payload=payload,
+        months=plan.months,
         stars_amount=plan.price_stars,
         fiat_amount=plan.price_rub,
     )
+    payload = payment.tg_invoice_payload
+    # The invoice and its cache entry must not be seen before the payment row is visible to other workers.
+    await session.commit()
 
     prices = [LabeledPrice(label=f"{plan.months} мес Quazar VPN", amount=plan.price_stars)]
     await call.message.answer_invoice(
         title=f"Quazar VPN — {plan.months} мес",
         description="Босс, ты в деле. Анонимный доступ без компромиссов.",
         payload=payload,
-        provider_token=config.provider_token,
+        provider_token=load_config().provider_token,
         currency="XTR",
         prices=prices,
         need_email=False,
         need_name=False,
         start_parameter="quazarvpn",
     )
+    pending_invoices.set(
+        payload,
+        PendingInvoice(
+            payment_id=payment.id,
+            telegram_id=user.telegram_id,
+            months=plan.months,
+            stars_amount=plan.price_stars,
+        ),
+    )
     await call.answer("Счёт выставлен. Оплачивай и зажигай!")
 
 
@@ -97,19 +92,30 @@ async def _reply_subscription(user, target, session):
         )
         return
 
-    message_text = format_subscription_message(subscription)
+    used_bytes = await get_subscription_usage(session, subscription.id)
+    message_text = format_subscription_message(subscription, used_bytes)
     await target.answer(message_text, reply_markup=renew_keyboard())
 
 
-@router.message(Command("my_subscription"))
 async def my_subscription_cmd(message: Message, session):
     user = await ensure_user(session, message.from_user)
     await _reply_subscription(user, message, session)
 
 
-@router.callback_query(F.data == "my_subscription")
 async def my_subscription_cb(call: CallbackQuery, session):
     user = await ensure_user(session, call.from_user)
     await call.answer()
     await call.message.answer("Проверяю твою броню...")
     await _reply_subscription(user, call.message, session)
+
+
+def create_router() -> Router:
+    router = Router(name="common")
+    router.message.register(cmd_start, CommandStart())
+    router.message.register(fallback_start, Command("start"))
+    router.callback_query.register(back_to_main, F.data == "back_main")
+    router.callback_query.register(show_plans, F.data == "plans")
+    router.callback_query.register(select_plan, F.data.startswith("plan:"))
+    router.message.register(my_subscription_cmd, Command("my_subscription"))
+    router.callback_query.register(my_subscription_cb, F.data == "my_subscription")
+    return router
@@ -2,35 +2,49 @@ from __future__ import annotations
 
 import logging
 
-from aiogram import F, Router
+from aiogram import Bot, F, Router
+from aiogram.exceptions import TelegramForbiddenError
 from aiogram.types import Message, PreCheckoutQuery
 
-from ..outline_client import outline_client
+from ..config import load_config
+from ..database import PaymentStatus
+from ..deps import db_session
+from ..invoices import pending_invoices
+from ..jobs import job_queue
+from ..key_pool import issue_key
+from ..outline_client import outline_servers
 from ..services import (
+    UserRef,
     create_subscription,
     ensure_user,
+    format_subscription_message,
+    get_payment,
     get_payment_by_payload,
     mark_payment_failed,
+    mark_payment_paid,
     mark_payment_success,
+    renew_subscription,
+    reset_usage,
     resolve_plan_by_payload,
 )
 
 logger = logging.getLogger(__name__)
-router = Router()
+
+PROVISION_JOB = "provision_payment"
 
 
-@router.pre_checkout_query()
 async def process_pre_checkout(query: PreCheckoutQuery, session):
-    plan = resolve_plan_by_payload(query.invoice_payload)
-    if not plan:
-        await query.answer(
-            ok=False,
-            error_message="Тариф не найден. Напиши в поддержку @your_support_username",
-        )
+    cached = pending_invoices.get(query.invoice_payload)
+    if cached is not None:
+        if cached.telegram_id == query.from_user.id and cached.stars_amount == query.total_amount:
+            await query.answer(ok=True)
+            return
+        await query.answer(ok=False, error_message="Счёт не совпадает. Оформи тариф заново.")
+        logger.warning("Pre-checkout mismatch for payload %s", query.invoice_payload)
         return
 
     payment = await get_payment_by_payload(session, query.invoice_payload)
-    if not payment:
+    if not payment or payment.status != PaymentStatus.PENDING:
         await query.answer(
             ok=False,
             error_message="Счёт не найден. Попробуй ещё раз оформить тариф.",
@@ -38,19 +52,27 @@ async def process_pre_checkout(query: PreCheckoutQuery, session):
         logger.warning("Missing payment record for payload %s", query.invoice_payload)
         return
 
+    if _payment_months(payment) is None:
+        await query.answer(
+            ok=False,
+            error_message="Тариф не найден. Напиши в поддержку @your_support_username",
+        )
+        return
+
     await query.answer(ok=True)
 
 
-@router.message(F.successful_payment)
+def _payment_months(payment) -> int | None:
+    # The invoice carries its own term; the live catalog is only consulted for rows created before plan_months.
+    if payment.plan_months:
+        return payment.plan_months
+    plan = resolve_plan_by_payload(payment.tg_invoice_payload)
+    return plan.months if plan else None
+
+
 async def handle_successful_payment(message: Message, session):
     successful_payment = message.successful_payment
     payload = successful_payment.invoice_payload
-    plan = resolve_plan_by_payload(payload)
-    if not plan:
-        await message.answer("Не смог определить тариф. Отпиши в поддержку.")
-        logger.error("Unknown plan payload: %s", payload)
-        return
-
     user = await ensure_user(session, message.from_user)
     payment = await get_payment_by_payload(session, payload)
     if not payment:
@@ -58,31 +80,127 @@ async def handle_successful_payment(message: Message, session):
         logger.error("Payment not found for payload %s", payload)
         return
 
-    try:
-        outline_key = await outline_client.create_key(label=f"tg-{user.telegram_id}")
-        subscription = await create_subscription(
-            session=session,
-            user=user,
-            outline_key_id=outline_key.key_id,
-            outline_access_url=outline_key.access_url,
-            months=plan.months,
-        )
-        await mark_payment_success(session, payment, subscription)
-    except Exception as exc:
-        await mark_payment_failed(session, payment)
-        logger.exception("Failed to create Outline key: payload=%s error=%s", payload, exc)
-        await message.answer(
-            "Ошибка при выдаче ключа. Сообщил технарям, скоро всё решим."
-        )
+    months = _payment_months(payment)
+    if months is None:
+        await message.answer("Не смог определить тариф. Отпиши в поддержку.")
+        logger.error("Unknown plan payload: %s", payload)
+        return
+
+    if not await mark_payment_paid(session, payment):
+        # Telegram redelivers updates; a payment is applied once, by whoever marked it paid first.
+        logger.warning("Duplicate successful_payment for payment %s (%s)", payment.id, payment.status)
+        await message.answer("Эта оплата уже учтена ✅")
         return
+    subscription = await _renew(session, payment, user.id, months)
+    if subscription is not None:
+        await message.answer("Подписка продлена, ключ остаётся прежним ✅\n\n" + format_subscription_message(subscription))
+        return
+
+    await job_queue.enqueue(
+        session,
+        PROVISION_JOB,
+        {
+            "payment_id": payment.id,
+            "user_id": user.id,
+            "telegram_id": user.telegram_id,
+            "chat_id": message.chat.id,
+            "months": months,
+        },
+        dedupe_key=f"{PROVISION_JOB}:{payment.id}",
+    )
+    await session.commit()
+    job_queue.notify()
+    await message.answer("Оплата получена 💫 Готовлю ключ, пришлю его через пару секунд.")
+
+
+async def _renew(session, payment, user_id: int, months: int):
+    subscription = await renew_subscription(session, user_id, months)
+    if subscription is None:
+        return None
+    if not await mark_payment_success(session, payment, subscription):
+        return await _already_applied(session, payment)
+    lift_limit = await reset_usage(session, subscription.id)
+    await session.commit()
+    if lift_limit:
+        try:
+            await outline_servers.get(subscription.server_id).remove_data_limit(subscription.outline_key_id)
+        except Exception as exc:  # noqa: BLE001
+            logger.warning("Failed to lift data limit for subscription %s: %s", subscription.id, exc)
+    return subscription
+
+
+async def _already_applied(session, payment):
+    # Another worker applied this payment first: undo this transaction and report its subscription.
+    await session.rollback()
+    await session.refresh(payment)
+    return await payment.awaitable_attrs.subscription
+
 
+async def provision_payment(bot: Bot, job: dict) -> None:
+    user = UserRef(id=job["user_id"], telegram_id=job["telegram_id"], username=None, full_name=None)
+    async with db_session() as session:
+        payment = await get_payment(session, job["payment_id"])
+        if payment is None:
+            raise LookupError(f"Payment {job['payment_id']} not found")
+        if payment.status == PaymentStatus.SUCCESS:
+            # Already provisioned by an earlier attempt; only the message is left to deliver.
+            subscription = await payment.awaitable_attrs.subscription
+        elif payment.status != PaymentStatus.PAID:
+            logger.warning("Skipping provisioning of payment %s in status %s", payment.id, payment.status)
+            return
+        elif (subscription := await _renew(session, payment, user.id, job["months"])) is None:
+            outline_key = await issue_key(session, user)
+            subscription = await create_subscription(
+                session=session,
+                user=user,
+                outline_key_id=outline_key.key_id,
+                outline_access_url=outline_key.access_url,
+                months=job["months"],
+                server_id=outline_key.server_id,
+            )
+            if not await mark_payment_success(session, payment, subscription):
+                subscription = await _already_applied(session, payment)
+
+    if subscription is None:
+        # payments.subscription_id is SET NULL when the subscription is deleted; a replayed job has
+        # nothing left to deliver, and retrying would not change that.
+        logger.warning("Subscription of payment %s no longer exists, nothing to deliver", job["payment_id"])
+        return
+    access_url = subscription.outline_access_url
     text = (
         "Босс, подписка активирована! 🚀\n"
-        f"Вот твой ключ:\n{outline_key.access_url}\n\n"
+        f"Вот твой ключ:\n{access_url}\n\n"
         "Инструкция по подключению:\n"
         "1. Скачай Outline (iOS, Android, Windows, macOS, Linux).\n"
         "2. Открой приложение и вставь ключ выше.\n"
         "3. Включай и лети без ограничений.\n\n"
         "Полная анонимность на скорости света. Если нужна помощь — @your_support_username."
     )
-    await message.answer(text)
+    try:
+        await bot.send_message(job["chat_id"], text)
+    except TelegramForbiddenError:
+        logger.warning("User %s blocked the bot before receiving key", job["telegram_id"])
+
+
+async def provision_failed(bot: Bot, job: dict, error: str) -> None:
+    async with db_session() as session:
+        payment = await get_payment(session, job["payment_id"])
+        if payment is not None and payment.status != PaymentStatus.SUCCESS:
+            await mark_payment_failed(session, payment)
+    logger.error("Gave up provisioning payment %s: %s", job["payment_id"], error)
+    await bot.send_message(job["chat_id"], "Ошибка при выдаче ключа. Сообщил технарям, скоро всё решим.")
+    await bot.send_message(
+        load_config().admin_id,
+        f"⚠️ Не удалось выдать ключ по платежу #{job['payment_id']} "
+        f"(пользователь {job['telegram_id']}): {error}",
+    )
+
+
+def create_router() -> Router:
+    router = Router(name="payments")
+    router.pre_checkout_query.register(process_pre_checkout)
+    router.message.register(handle_successful_payment, F.successful_payment)
+    return router
+
+
+job_queue.register(PROVISION_JOB, provision_payment, on_failure=provision_failed)
@@ -0,0 +1,56 @@
+from __future__ import annotations
+
+import hashlib
+import hmac
+from dataclasses import dataclass
+from functools import lru_cache
+
+from .cache import LRUCache
+from .config import BotConfig, load_config
+
+PAYLOAD_VERSION = "q1"
+SIGNATURE_LENGTH = 16
+
+
+@dataclass(frozen=True, slots=True)
+class InvoicePayload:
+    payment_id: int
+    months: int
+
+
+@dataclass(frozen=True, slots=True)
+class PendingInvoice:
+    payment_id: int
+    telegram_id: int
+    months: int
+    stars_amount: int
+
+
+@lru_cache(maxsize=1)
+def _secret() -> bytes:
+    config = load_config()
+    return (config.invoice_secret or config.bot_token).encode()
+
+
+def _sign(payment_id: int, months: int) -> str:
+    message = f"{payment_id}:{months}".encode()
+    return hmac.new(_secret(), message, hashlib.sha256).hexdigest()[:SIGNATURE_LENGTH]
+
+
+def build_invoice_payload(payment_id: int, months: int) -> str:
+    return f"{PAYLOAD_VERSION}:{payment_id}:{months}:{_sign(payment_id, months)}"
+
+
+def parse_invoice_payload(payload: str) -> InvoicePayload | None:
+    parts = payload.split(":")
+    if len(parts) != 4 or parts[0] != PAYLOAD_VERSION:
+        return None
+    _, payment_id, months, signature = parts
+    if not (payment_id.isdigit() and months.isdigit()):
+        return None
+    if not hmac.compare_digest(signature, _sign(int(payment_id), int(months))):
+        return None
+    return InvoicePayload(payment_id=int(payment_id), months=int(months))
+
+
+pending_invoices: LRUCache[str, PendingInvoice] = LRUCache(BotConfig.pending_invoice_cache_size)
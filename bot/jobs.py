@@ -0,0 +1,110 @@
+from __future__ import annotations
+
+import asyncio
+import datetime as dt
+import logging
+import random
+from functools import cached_property
+from collections.abc import Awaitable, Callable
+
+from aiogram import Bot
+
+from .config import JobsConfig, load_config
+from .deps import db_session
+from .metrics import Counter, registry
+from .services import claim_jobs, complete_job, enqueue_job, fail_job
+
+logger = logging.getLogger(__name__)
+
+JobHandler = Callable[[Bot, dict], Awaitable[None]]
+FailureHandler = Callable[[Bot, dict, str], Awaitable[None]]
+
+jobs_total = registry.register(
+    Counter("quazar_jobs_total", "Background jobs finished, by outcome.", ("kind", "outcome"))
+)
+
+
+class JobQueue:
+    def __init__(self) -> None:
+        self._handlers: dict[str, tuple[JobHandler, FailureHandler | None]] = {}
+        self._wakeup = asyncio.Event()
+        self._tasks: list[asyncio.Task] = []
+
+    @cached_property
+    def config(self) -> JobsConfig:
+        return load_config().jobs
+
+    def register(self, kind: str, handler: JobHandler, on_failure: FailureHandler | None = None) -> None:
+        self._handlers[kind] = (handler, on_failure)
+
+    async def enqueue(self, session, kind: str, payload: dict, dedupe_key: str | None = None) -> None:
+        await enqueue_job(session, kind, payload, self.config.max_attempts, dedupe_key)
+
+    def notify(self) -> None:
+        self._wakeup.set()
+
+    def start(self, bot: Bot) -> None:
+        self._tasks = [t for t in self._tasks if not t.done()]
+        for index in range(len(self._tasks), self.config.workers):
+            self._tasks.append(asyncio.create_task(self._worker(bot), name=f"job-worker-{index}"))
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def _backoff(self, attempt: int) -> float:
+        ceiling = min(self.config.backoff_max, self.config.backoff_base * 2**attempt)
+        return random.uniform(ceiling / 2, ceiling)
+
+    async def _worker(self, bot: Bot) -> None:
+        while True:
+            try:
+                async with db_session() as session:
+                    jobs = await claim_jobs(session, 1, self.config.lease)
+            except Exception:
+                logger.exception("Failed to claim jobs")
+                jobs = []
+            if not jobs:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.config.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            for job in jobs:
+                await self._execute(bot, job.id, job.kind, job.payload, job.attempts, job.max_attempts)
+
+    async def _execute(self, bot: Bot, job_id: int, kind: str, payload: dict, attempts: int, max_attempts: int) -> None:
+        handler, on_failure = self._handlers.get(kind, (None, None))
+        try:
+            if handler is None:
+                raise LookupError(f"No handler registered for job kind {kind!r}")
+            if attempts > max_attempts:
+                raise RuntimeError("Job lease expired during its last attempt")
+            await handler(bot, payload)
+        except Exception as exc:  # noqa: BLE001
+            retry_at = None
+            if handler is not None and attempts < max_attempts:
+                retry_at = dt.datetime.now(dt.timezone.utc) + dt.timedelta(seconds=self._backoff(attempts))
+            logger.warning(
+                "Job %s (%s) attempt %s/%s failed: %s",
+                job_id, kind, attempts, max_attempts, exc,
+                exc_info=retry_at is None,
+            )
+            async with db_session() as session:
+                await fail_job(session, job_id, repr(exc), retry_at)
+            jobs_total.inc(kind, "retry" if retry_at is not None else "failed")
+            if retry_at is None and on_failure is not None:
+                try:
+                    await on_failure(bot, payload, repr(exc))
+                except Exception:
+                    logger.exception("Failure hook for job %s (%s) failed", job_id, kind)
+            return
+        async with db_session() as session:
+            await complete_job(session, job_id)
+        jobs_total.inc(kind, "done")
+
+
+job_queue = JobQueue()
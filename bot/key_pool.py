@@ -0,0 +1,126 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+from functools import cached_property
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .config import KeyPoolConfig, load_config
+from .deps import db_session
+from .outline_client import OutlineClient, OutlineKey, outline_servers
+from .services import (
+    UserRef,
+    add_pooled_keys,
+    claim_pooled_key,
+    count_active_keys_by_server,
+    count_pooled_keys,
+)
+
+logger = logging.getLogger(__name__)
+
+POOL_KEY_LABEL = "quazar-pool"
+
+
+class KeyPoolRefiller:
+    def __init__(self) -> None:
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self._background: set[asyncio.Task] = set()
+
+    @cached_property
+    def config(self) -> KeyPoolConfig:
+        return load_config().key_pool
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run(), name="key-pool-refiller")
+
+    async def stop(self) -> None:
+        tasks = [*self._background]
+        if self._task is not None:
+            self._task.cancel()
+            tasks.append(self._task)
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def notify(self) -> None:
+        self._wakeup.set()
+
+    def spawn(self, coro) -> None:
+        task = asyncio.create_task(coro)
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                async with db_session() as session:
+                    outline_servers.set_active_keys(await count_active_keys_by_server(session))
+                for client in outline_servers:
+                    await self.refill(client)
+            except Exception:
+                logger.exception("Outline key pool refill failed")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.config.refill_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    async def refill(self, client: OutlineClient) -> int:
+        async with db_session() as session:
+            available = await count_pooled_keys(session, client.server_id)
+        if available >= self.config.low_water:
+            return 0
+
+        semaphore = asyncio.Semaphore(self.config.concurrency)
+
+        async def create_one() -> OutlineKey | None:
+            async with semaphore:
+                try:
+                    return await client.create_key(label=POOL_KEY_LABEL)
+                except Exception as exc:  # noqa: BLE001
+                    logger.warning("Failed to pre-create Outline key on %s: %s", client.server_id, exc)
+                    return None
+
+        results = await asyncio.gather(*(create_one() for _ in range(max(self.config.target, self.config.low_water) - available)))
+        keys = [key for key in results if key is not None]
+        if keys:
+            async with db_session() as session:
+                await add_pooled_keys(session, keys)
+        logger.info(
+            "Outline key pool %s refilled: %s -> %s", client.server_id, available, available + len(keys)
+        )
+        return len(keys)
+
+
+async def _rename_key(client: OutlineClient, key_id: str, label: str) -> None:
+    try:
+        await client.rename_key(key_id, label)
+    except Exception as exc:  # noqa: BLE001
+        logger.warning("Failed to rename pooled Outline key %s: %s", key_id, exc)
+
+
+async def issue_key(session: AsyncSession, user: UserRef) -> OutlineKey:
+    label = f"tg-{user.telegram_id}"
+    client = outline_servers.pick()
+    pooled = await claim_pooled_key(session, user, client.server_id)
+    key_pool.notify()
+    if pooled is None:
+        # End the caller's transaction before going to Outline: on SQLite even an UPDATE that matched
+        # nothing (the renewal attempt, the pool claim) holds the write lock, and creating a key can
+        # take the whole read timeout plus retries. The subscription insert starts a new transaction.
+        await session.commit()
+        logger.warning(
+            "Outline key pool %s is empty, creating key for user %s inline",
+            client.server_id,
+            user.telegram_id,
+        )
+        key = await client.create_key(label=label)
+    else:
+        key_pool.spawn(_rename_key(client, pooled.key_id, label))
+        key = OutlineKey(key_id=pooled.key_id, access_url=pooled.access_url, server_id=pooled.server_id)
+    outline_servers.record_placement(client.server_id)
+    return key
+
+
+key_pool = KeyPoolRefiller()
@@ -2,7 +2,7 @@ from __future__ import annotations
 
 from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
 
-from .config import load_config
+from .plans import plan_catalog
 
 
 def main_menu_keyboard() -> InlineKeyboardMarkup:
@@ -25,15 +25,7 @@ def main_menu_keyboard() -> InlineKeyboardMarkup:
 
 
 def plans_keyboard() -> InlineKeyboardMarkup:
-    config = load_config()
-    buttons = []
-    for plan in config.plans:
-        discount = f" ({plan.discount_hint})" if plan.discount_hint else ""
-        text = f"{plan.months} мес — {plan.price_rub}₽{discount}"
-        callback_data = f"plan:{plan.months}"
-        buttons.append([InlineKeyboardButton(text=text, callback_data=callback_data)])
-    buttons.append([InlineKeyboardButton(text="Назад ⬅️", callback_data="back_main")])
-    return InlineKeyboardMarkup(inline_keyboard=buttons)
+    return plan_catalog().keyboard
 
 
 def renew_keyboard() -> InlineKeyboardMarkup:
@@ -4,47 +4,149 @@ import logging
 from aiogram import Bot, Dispatcher
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
-from aiogram.fsm.storage.memory import MemoryStorage
 
-from .config import load_config
-from .database import init_db
+from .analytics import revenue_aggregator
+from .broadcast import broadcaster
+from .cache_sync import cache_sync
+from .config import BotConfig, load_config
+from .database import dispose_engine
+from .deps import db_session
+from .export import data_exporter
+from .fsm_storage import build_fsm_storage
 from .handlers import admin, common, payments
-from .middlewares import DatabaseSessionMiddleware, RateLimitMiddleware
-from .outline_client import outline_client
+from .jobs import job_queue
+from .key_pool import key_pool
+from .metrics import TraceIdFilter, start_metrics_server
+from .migrations import init_db
+from .middlewares import (
+    ConcurrencyLimitMiddleware,
+    DatabaseSessionMiddleware,
+    InstrumentationMiddleware,
+    RateLimitMiddleware,
+    TracingMiddleware,
+)
+from .outline_client import outline_servers
+from .plans import reload_plan_catalog
+from .reminders import expiry_reminder
+from .services import configure_caches, list_key_server_ids
+from .sweeper import sweeper
+from .usage import usage_collector
+
+
+async def on_startup(bot: Bot, is_leader: bool = True) -> None:
+    async with db_session() as session:
+        await reload_plan_catalog(session)
+        unknown = await list_key_server_ids(session) - set(outline_servers.clients)
+    if unknown:
+        # These keys could not be swept, metered or reconciled; renaming a server orphans its keys.
+        raise RuntimeError(
+            f"Database has keys on Outline servers missing from the configuration: {', '.join(sorted(unknown))}. "
+            "Keep their ids in OUTLINE_SERVERS (a single-server setup uses id 'default')."
+        )
+    job_queue.start(bot)
+    cache_sync.start()
+    if not is_leader:
+        return
+    key_pool.start()
+    sweeper.start()
+    usage_collector.start()
+    expiry_reminder.start(bot)
+    revenue_aggregator.start()
+    await broadcaster.resume_pending(bot)
 
 
 async def on_shutdown(bot: Bot) -> None:
-    await outline_client.close()
+    await job_queue.stop()
+    await cache_sync.stop()
+    await broadcaster.stop()
+    await data_exporter.stop()
+    await key_pool.stop()
+    await sweeper.stop()
+    await usage_collector.stop()
+    await expiry_reminder.stop()
+    await revenue_aggregator.stop()
+    await outline_servers.close()
     await bot.session.close()
+    await dispose_engine()
 
 
-async def run() -> None:
+def setup_logging() -> None:
     logging.basicConfig(
         level=logging.INFO,
-        format="%(asctime)s | %(levelname)s | %(name)s | %(message)s",
+        format="%(asctime)s | %(levelname)s | %(trace_id)s | %(name)s | %(message)s",
     )
-    config = load_config()
+    for handler in logging.getLogger().handlers:
+        handler.addFilter(TraceIdFilter())
 
-    bot = Bot(
+
+def create_bot(config: BotConfig) -> Bot:
+    return Bot(
         token=config.bot_token,
         default=DefaultBotProperties(parse_mode=ParseMode.HTML),
     )
-    dp = Dispatcher(storage=MemoryStorage())
-    dp.include_router(common.router)
-    dp.include_router(payments.router)
-    dp.include_router(admin.router)
 
-    dp.update.middleware(DatabaseSessionMiddleware())
-    dp.message.middleware(RateLimitMiddleware())
 
+def create_dispatcher(config: BotConfig, is_leader: bool = True) -> Dispatcher:
+    dp = Dispatcher(storage=build_fsm_storage(config), is_leader=is_leader)
+    dp.include_router(common.create_router())
+    dp.include_router(payments.create_router())
+    dp.include_router(admin.create_router())
+
+    dp.update.outer_middleware(TracingMiddleware())
+    dp.update.outer_middleware(ConcurrencyLimitMiddleware(config.handler_concurrency))
+    instrumentation = InstrumentationMiddleware()
+    dp.message.middleware(instrumentation)
+    dp.callback_query.middleware(instrumentation)
+    dp.pre_checkout_query.middleware(instrumentation)
+    message_rate_limit = RateLimitMiddleware(config.rate_limit_per_minute, "message")
+    callback_rate_limit = RateLimitMiddleware(config.rate_limit_callbacks_per_minute, "callback")
+    dp.message.middleware(message_rate_limit)
+    dp.callback_query.middleware(callback_rate_limit)
+    session_middleware = DatabaseSessionMiddleware()
+    dp.message.middleware(session_middleware)
+    dp.callback_query.middleware(session_middleware)
+    dp.pre_checkout_query.middleware(session_middleware)
+
+    dp.startup.register(on_startup)
     dp.shutdown.register(on_shutdown)
+    dp.shutdown.register(message_rate_limit.close)
+    dp.shutdown.register(callback_rate_limit.close)
+    return dp
+
+
+def create_application(config: BotConfig | None = None, is_leader: bool = True) -> tuple[Bot, Dispatcher]:
+    # Nothing is built at import time: caches are sized, and the bot, dispatcher and routers are
+    # created here. The engine and Outline sessions open on first use inside the running loop.
+    config = config or load_config()
+    configure_caches(config)
+    return create_bot(config), create_dispatcher(config, is_leader=is_leader)
+
+
+async def run() -> None:
+    setup_logging()
+    config = load_config()
 
     await init_db()
-    await bot.delete_webhook(drop_pending_updates=True)
-    await dp.start_polling(bot)
+    bot, dp = create_application(config)
+    metrics_runner = None
+    if config.metrics.port:
+        metrics_runner = await start_metrics_server(config.metrics.host, config.metrics.port)
+    # Keep updates that arrived while the bot was down: a successful_payment must not be lost.
+    await bot.delete_webhook(drop_pending_updates=False)
+    try:
+        await dp.start_polling(bot)
+    finally:
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
 
 
 def main() -> None:
+    config = load_config()
+    if config.bot_mode == "webhook":
+        from .webhook import run_webhook
+
+        run_webhook()
+        return
     asyncio.run(run())
 
 
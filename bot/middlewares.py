@@ -2,23 +2,53 @@ from __future__ import annotations
 
 import asyncio
 import time
-from collections import defaultdict
+from dataclasses import dataclass
 
 from aiogram import BaseMiddleware
-from aiogram.types import Message, TelegramObject
+from aiogram.types import CallbackQuery, Message, TelegramObject, Update
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
 
 from .config import load_config
-from .database import async_session_factory
+from .database import get_session_factory
+from .metrics import handler_duration, handler_errors, trace_id_var, updates_total
+from .ratelimit import RateLimitBackend, build_rate_limit_backend
+
+THROTTLED_TEXT = "🛑 Притормози, босс. Дай секунду отдышаться."
+
+
+class ConcurrencyLimitMiddleware(BaseMiddleware):
+    def __init__(self, limit: int) -> None:
+        super().__init__()
+        self._semaphore = asyncio.Semaphore(limit)
+
+    async def __call__(self, handler, event: TelegramObject, data: dict):
+        async with self._semaphore:
+            return await handler(event, data)
+
+
+class TracingMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event: Update, data: dict):
+        updates_total.inc(event.event_type)
+        token = trace_id_var.set(f"u{event.update_id}")
+        try:
+            return await handler(event, data)
+        finally:
+            trace_id_var.reset(token)
 
 
 class RateLimitMiddleware(BaseMiddleware):
-    def __init__(self) -> None:
+    def __init__(
+        self, limit: int | None = None, scope: str = "message", backend: RateLimitBackend | None = None
+    ) -> None:
         super().__init__()
         config = load_config()
-        self.limit = config.rate_limit_per_minute
+        self.limit = config.rate_limit_per_minute if limit is None else limit
         self.window = 60
-        self._storage: dict[int, list[float]] = defaultdict(list)
-        self._lock = asyncio.Lock()
+        # Each scope counts separately, so menu taps do not eat into the message budget.
+        self.backend = backend or build_rate_limit_backend(config, scope)
+
+    async def close(self) -> None:
+        await self.backend.close()
 
     async def __call__(
         self,
@@ -26,28 +56,88 @@ class RateLimitMiddleware(BaseMiddleware):
         event: TelegramObject,
         data: dict,
     ):
-        if isinstance(event, Message):
-            user_id = event.from_user.id if event.from_user else None
-            if user_id:
-                async with self._lock:
-                    timestamps = self._storage[user_id]
-                    now = time.monotonic()
-                    timestamps[:] = [t for t in timestamps if now - t <= self.window]
-                    if len(timestamps) >= self.limit:
-                        await event.answer("🛑 Притормози, босс. Дай секунду отдышаться.")
-                        return
-                    timestamps.append(now)
+        if isinstance(event, Message) and event.successful_payment is not None:
+            # The user has already been charged; throttling this would drop the payment.
+            return await handler(event, data)
+        user = getattr(event, "from_user", None)
+        if user is not None and not await self.backend.hit(user.id, self.limit, self.window):
+            if isinstance(event, (CallbackQuery, Message)):
+                await event.answer(THROTTLED_TEXT)
+            return None
         return await handler(event, data)
 
 
+@dataclass(slots=True)
+class DbUsage:
+    updates: int = 0
+    db_hits: int = 0
+
+
+db_usage: dict[str, DbUsage] = {}
+
+
+class LazySession:
+    def __init__(self, factory: async_sessionmaker[AsyncSession] | None = None) -> None:
+        self._factory = factory
+        self._session: AsyncSession | None = None
+
+    @property
+    def opened(self) -> bool:
+        return self._session is not None
+
+    @property
+    def dirty(self) -> bool:
+        return self._session is not None and self._session.in_transaction()
+
+    def __getattr__(self, name: str):
+        if self._session is None:
+            self._session = (self._factory or get_session_factory())()
+        return getattr(self._session, name)
+
+    async def close(self) -> None:
+        if self._session is not None:
+            await self._session.close()
+
+
+def _handler_name(data: dict) -> str:
+    handler = data.get("handler")
+    callback = getattr(handler, "callback", None)
+    if callback is None:
+        return "unknown"
+    return f"{callback.__module__.rsplit('.', 1)[-1]}.{callback.__name__}"
+
+
+def _router_name(data: dict) -> str:
+    return getattr(data.get("event_router"), "name", "unknown")
+
+
+class InstrumentationMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event: TelegramObject, data: dict):
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception as exc:
+            handler_errors.inc(_router_name(data), _handler_name(data), type(exc).__name__)
+            raise
+        finally:
+            handler_duration.observe(time.perf_counter() - started, _router_name(data), _handler_name(data))
+
+
 class DatabaseSessionMiddleware(BaseMiddleware):
     async def __call__(self, handler, event: TelegramObject, data: dict):
-        async with async_session_factory() as session:
-            try:
-                data["session"] = session
-                result = await handler(event, data)
+        session = LazySession()
+        data["session"] = session
+        try:
+            result = await handler(event, data)
+            if session.dirty:
                 await session.commit()
-                return result
-            except Exception:
+            return result
+        except Exception:
+            if session.dirty:
                 await session.rollback()
-                raise
+            raise
+        finally:
+            usage = db_usage.setdefault(_handler_name(data), DbUsage())
+            usage.updates += 1
+            usage.db_hits += session.opened
+            await session.close()
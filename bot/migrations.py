@@ -0,0 +1,272 @@
+from __future__ import annotations
+
+import argparse
+import asyncio
+import logging
+import sys
+from collections.abc import Awaitable, Callable
+from dataclasses import dataclass
+
+from sqlalchemy import Index, MetaData, Table, UniqueConstraint, func, inspect, insert, literal, select, text
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine
+from sqlalchemy.schema import AddConstraint, CreateColumn, CreateTable
+
+from .config import DEFAULT_PLANS, load_config
+from .database import (
+    Base,
+    Payment,
+    PaymentStatus,
+    Plan,
+    SchemaMigration,
+    StatCounter,
+    StatCounterName,
+    User,
+    dispose_engine,
+    get_engine,
+)
+
+logger = logging.getLogger(__name__)
+
+# Arbitrary key for pg_advisory_xact_lock, so concurrent boots migrate one at a time.
+MIGRATION_LOCK_ID = 7_301_452
+
+
+@dataclass(frozen=True)
+class Migration:
+    version: int
+    name: str
+    apply: Callable[[AsyncConnection], Awaitable[None]]
+
+
+async def _seed_stat_counters(conn: AsyncConnection) -> None:
+    existing = set((await conn.execute(select(StatCounter.name))).scalars())
+    seeds = {
+        StatCounterName.USERS: select(func.count()).select_from(User),
+        StatCounterName.REVENUE_STARS: select(func.coalesce(func.sum(Payment.stars_amount), 0)).where(
+            Payment.status == PaymentStatus.SUCCESS
+        ),
+        # Epoch seconds; 0 makes the first rollup pass backfill the whole history.
+        StatCounterName.REVENUE_ROLLUP_WATERMARK: select(literal(0)),
+        # Bumped by /reload_plans; every process reloads its catalog when it changes.
+        StatCounterName.PLAN_CATALOG_VERSION: select(literal(0)),
+    }
+    for name, query in seeds.items():
+        if name not in existing:
+            value = (await conn.execute(query)).scalar_one()
+            await conn.execute(insert(StatCounter).values(name=name, value=value))
+
+
+async def _seed_plans(conn: AsyncConnection) -> None:
+    if (await conn.execute(select(func.count()).select_from(Plan))).scalar_one():
+        return
+    await conn.execute(
+        insert(Plan),
+        [
+            {
+                "months": plan.months,
+                "price_rub": plan.price_rub,
+                "price_stars": plan.price_stars,
+                "discount_hint": plan.discount_hint,
+                "position": position,
+            }
+            for position, plan in enumerate(DEFAULT_PLANS)
+        ],
+    )
+
+
+async def _initial_schema(conn: AsyncConnection) -> None:
+    await conn.run_sync(Base.metadata.create_all)
+    await _seed_stat_counters(conn)
+    await _seed_plans(conn)
+
+
+def _add_missing_columns(sync_conn) -> None:
+    inspector = inspect(sync_conn)
+    preparer = sync_conn.dialect.identifier_preparer
+    for table in Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            if not column.nullable and column.server_default is None:
+                raise RuntimeError(f"Cannot add NOT NULL column {table.name}.{column.name} without a server default")
+            spec = CreateColumn(column).compile(dialect=sync_conn.dialect)
+            sync_conn.execute(text(f"ALTER TABLE {preparer.format_table(table)} ADD COLUMN {spec}"))
+            logger.info("Added column %s.%s", table.name, column.name)
+        indexes = {index["name"] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in indexes:
+                index.create(sync_conn)
+                logger.info("Created index %s", index.name)
+
+
+async def _pre_versioning_columns(conn: AsyncConnection) -> None:
+    # Databases created before schema versioning only ever ran create_all, which never alters
+    # existing tables; bring their columns and indexes up to the current models.
+    await conn.run_sync(_add_missing_columns)
+
+
+def _model_uniques(table: Table) -> dict[frozenset[str], UniqueConstraint | Index]:
+    uniques: dict[frozenset[str], UniqueConstraint | Index] = {}
+    for constraint in table.constraints:
+        if isinstance(constraint, UniqueConstraint):
+            uniques[frozenset(column.name for column in constraint.columns)] = constraint
+    for index in table.indexes:
+        if index.unique:
+            uniques[frozenset(column.name for column in index.columns)] = index
+    return uniques
+
+
+def _db_uniques(inspector, table_name: str) -> tuple[dict[frozenset[str], str | None], dict[frozenset[str], str]]:
+    constraints = {
+        frozenset(constraint["column_names"]): constraint["name"]
+        for constraint in inspector.get_unique_constraints(table_name)
+    }
+    indexes = {
+        frozenset(index["column_names"]): index["name"]
+        for index in inspector.get_indexes(table_name)
+        if index["unique"] and "duplicates_constraint" not in index
+    }
+    return constraints, indexes
+
+
+def _rebuild_sqlite_table(sync_conn, table: Table) -> None:
+    # SQLite cannot drop or add a constraint in place: copy the rows into a table created from the
+    # model, then swap it in (https://www.sqlite.org/lang_altertable.html#otheralter).
+    if sync_conn.exec_driver_sql("PRAGMA foreign_keys").scalar():
+        raise RuntimeError(f"Rebuilding {table.name} with foreign_keys=ON would cascade deletes; turn it off first")
+    metadata = MetaData()
+    for other in Base.metadata.sorted_tables:
+        # Foreign keys of the staging copy resolve against copies of the tables they reference.
+        other.to_metadata(metadata)
+    staging = table.to_metadata(metadata, name=f"_migrate_{table.name}")
+    preparer = sync_conn.dialect.identifier_preparer
+    columns = ", ".join(preparer.quote(column.name) for column in table.columns)
+    sync_conn.execute(text(f"DROP TABLE IF EXISTS {preparer.format_table(staging)}"))
+    sync_conn.execute(CreateTable(staging))
+    sync_conn.execute(
+        text(
+            f"INSERT INTO {preparer.format_table(staging)} ({columns}) "
+            f"SELECT {columns} FROM {preparer.format_table(table)}"
+        )
+    )
+    sync_conn.execute(text(f"DROP TABLE {preparer.format_table(table)}"))
+    sync_conn.execute(
+        text(f"ALTER TABLE {preparer.format_table(staging)} RENAME TO {preparer.format_table(table)}")
+    )
+    for index in table.indexes:
+        index.create(sync_conn)
+
+
+def _sync_unique_constraints(sync_conn) -> None:
+    inspector = inspect(sync_conn)
+    preparer = sync_conn.dialect.identifier_preparer
+    for table in Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        wanted = _model_uniques(table)
+        constraints, indexes = _db_uniques(inspector, table.name)
+        if wanted.keys() == constraints.keys() | indexes.keys():
+            continue
+        logger.info("Rebuilding unique constraints on %s", table.name)
+        if sync_conn.dialect.name == "sqlite":
+            _rebuild_sqlite_table(sync_conn, table)
+            continue
+        for columns, name in constraints.items():
+            if columns not in wanted:
+                sync_conn.execute(
+                    text(f"ALTER TABLE {preparer.format_table(table)} DROP CONSTRAINT {preparer.quote(name)}")
+                )
+        for columns, name in indexes.items():
+            if columns not in wanted:
+                sync_conn.execute(text(f"DROP INDEX {preparer.quote(name)}"))
+        for columns, unique in wanted.items():
+            if columns in constraints or columns in indexes:
+                continue
+            if isinstance(unique, Index):
+                unique.create(sync_conn)
+            else:
+                sync_conn.execute(AddConstraint(unique))
+    # Plain indexes that shared a name with a dropped unique index are created again.
+    _add_missing_columns(sync_conn)
+
+
+async def _pre_versioning_unique_constraints(conn: AsyncConnection) -> None:
+    # Before multi-server support a key id was unique on its own and invoice payloads were not
+    # unique at all; create_all left those tables as they were.
+    await conn.run_sync(_sync_unique_constraints)
+
+
+MIGRATIONS: tuple[Migration, ...] = (
+    Migration(1, "initial schema and seed data", _initial_schema),
+    Migration(2, "columns and indexes added before schema versioning", _pre_versioning_columns),
+    Migration(3, "unique constraints changed before schema versioning", _pre_versioning_unique_constraints),
+)
+HEAD = MIGRATIONS[-1].version
+
+
+async def current_version(conn: AsyncConnection) -> int:
+    has_table = await conn.run_sync(lambda sync_conn: inspect(sync_conn).has_table(SchemaMigration.__tablename__))
+    if not has_table:
+        return 0
+    return (await conn.execute(select(func.coalesce(func.max(SchemaMigration.version), 0)))).scalar_one()
+
+
+async def migrate(engine: AsyncEngine) -> list[int]:
+    async with engine.begin() as conn:
+        if conn.dialect.name == "postgresql":
+            await conn.execute(select(func.pg_advisory_xact_lock(MIGRATION_LOCK_ID)))
+        version = await current_version(conn)
+        if version > HEAD:
+            raise RuntimeError(f"Database schema version {version} is newer than this code ({HEAD})")
+        pending = [migration for migration in MIGRATIONS if migration.version > version]
+        if not pending:
+            return []
+        await conn.run_sync(SchemaMigration.__table__.create, checkfirst=True)
+        for migration in pending:
+            logger.info("Applying schema migration %s: %s", migration.version, migration.name)
+            await migration.apply(conn)
+            await conn.execute(insert(SchemaMigration).values(version=migration.version, name=migration.name))
+    return [migration.version for migration in pending]
+
+
+async def init_db(engine: AsyncEngine | None = None) -> None:
+    engine = engine or get_engine()
+    if load_config().database.auto_migrate:
+        await migrate(engine)
+        return
+    async with engine.connect() as conn:
+        version = await current_version(conn)
+    if version != HEAD:
+        raise RuntimeError(
+            f"Database schema is at version {version}, this code expects {HEAD}; run python -m bot.migrations"
+        )
+
+
+async def _main(check: bool) -> int:
+    try:
+        engine = get_engine()
+        if check:
+            async with engine.connect() as conn:
+                version = await current_version(conn)
+            print(f"schema version {version}, head {HEAD}")
+            return 0 if version == HEAD else 1
+        applied = await migrate(engine)
+        print(f"applied {applied}" if applied else f"already at version {HEAD}")
+        return 0
+    finally:
+        await dispose_engine()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Apply or check database schema migrations.")
+    parser.add_argument("--check", action="store_true", help="Exit with status 1 if migrations are pending.")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(asyncio.run(_main(args.check)))
+
+
+if __name__ == "__main__":
+    main()
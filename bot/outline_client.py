@@ -1,12 +1,22 @@
 from __future__ import annotations
 
 import asyncio
-import ssl
+import logging
+import math
+import random
+import time
+from collections import deque
 from dataclasses import dataclass
 
 import aiohttp
 
-from .config import load_config
+from .config import OutlineConfig, load_config
+from .metrics import Gauge, outline_request_duration, registry
+
+logger = logging.getLogger(__name__)
+
+LATENCY_WINDOW = 256
+HEDGE_MIN_SAMPLES = 20
 
 
 def _fingerprint_from_hex(hex_value: str) -> bytes:
@@ -19,24 +29,104 @@ class OutlineKey:
     key_id: str
     access_url: str
     port: int | None = None
+    server_id: str = "default"
+
+
+class OutlineError(Exception):
+    pass
+
+
+class CircuitOpenError(OutlineError):
+    pass
+
+
+class CircuitBreaker:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int, reset_timeout: float) -> None:
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self._opened_at = 0.0
+        self._probe_started = 0.0
+        self._probe_in_flight = False
+
+    def before_call(self) -> None:
+        if self.state == self.OPEN:
+            if time.monotonic() - self._opened_at < self.reset_timeout:
+                raise CircuitOpenError("Outline circuit breaker is open")
+            self._set_state(self.HALF_OPEN)
+        if self.state == self.HALF_OPEN:
+            now = time.monotonic()
+            if self._probe_in_flight and now - self._probe_started < self.reset_timeout:
+                raise CircuitOpenError("Outline circuit breaker is probing")
+            self._probe_in_flight = True
+            self._probe_started = now
+
+    def record_success(self) -> None:
+        self.failures = 0
+        self._probe_in_flight = False
+        if self.state != self.CLOSED:
+            self._set_state(self.CLOSED)
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        self._probe_in_flight = False
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            self._opened_at = time.monotonic()
+            if self.state != self.OPEN:
+                self._set_state(self.OPEN)
+
+    def _set_state(self, state: str) -> None:
+        logger.warning("Outline circuit breaker %s -> %s", self.state, state)
+        self.state = state
+
+
+class LatencyTracker:
+    def __init__(self, window: int = LATENCY_WINDOW) -> None:
+        self.samples: deque[float] = deque(maxlen=window)
+        self.calls = 0
+        self.errors = 0
+
+    def observe(self, seconds: float) -> None:
+        self.calls += 1
+        self.samples.append(seconds)
+
+    def percentile(self, q: float) -> float | None:
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def _is_retryable(exc: BaseException) -> bool:
+    if isinstance(exc, aiohttp.ClientResponseError):
+        return exc.status >= 500 or exc.status == 429
+    return isinstance(exc, (aiohttp.ClientConnectionError, asyncio.TimeoutError))
 
 
 class OutlineClient:
-    def __init__(self) -> None:
-        config = load_config().outline
-        fingerprint = _fingerprint_from_hex(config.cert_sha256)
-        ssl_context = ssl.create_default_context()
-        self._connector = aiohttp.TCPConnector(ssl=aiohttp.Fingerprint(fingerprint))
+    def __init__(self, config: OutlineConfig) -> None:
+        self._config = config
+        self.server_id = config.server_id
+        self._fingerprint = _fingerprint_from_hex(config.cert_sha256)
         self._base_url = config.api_url.rstrip("/")
-        self._timeout = aiohttp.ClientTimeout(total=config.timeout)
+        self._timeout = aiohttp.ClientTimeout(
+            total=None, connect=config.connect_timeout, sock_read=config.read_timeout
+        )
         self._session: aiohttp.ClientSession | None = None
         self._lock = asyncio.Lock()
+        self.breaker = CircuitBreaker(config.breaker_failure_threshold, config.breaker_reset_timeout)
+        self.latency: dict[str, LatencyTracker] = {}
 
     async def _get_session(self) -> aiohttp.ClientSession:
         async with self._lock:
             if self._session is None or self._session.closed:
                 self._session = aiohttp.ClientSession(
-                    connector=self._connector,
+                    connector=aiohttp.TCPConnector(ssl=aiohttp.Fingerprint(self._fingerprint)),
                     timeout=self._timeout,
                     raise_for_status=True,
                 )
@@ -47,16 +137,216 @@ class OutlineClient:
             if self._session and not self._session.closed:
                 await self._session.close()
 
-    async def create_key(self, label: str | None = None) -> OutlineKey:
+    def stats(self) -> dict:
+        return {
+            "breaker": self.breaker.state,
+            "calls": {
+                name: {
+                    "count": tracker.calls,
+                    "errors": tracker.errors,
+                    "p50": tracker.percentile(0.5),
+                    "p95": tracker.percentile(0.95),
+                    "p99": tracker.percentile(0.99),
+                }
+                for name, tracker in self.latency.items()
+            },
+        }
+
+    def _backoff(self, attempt: int) -> float:
+        ceiling = min(self._config.backoff_max, self._config.backoff_base * 2**attempt)
+        return random.uniform(0, ceiling)
+
+    async def _send(self, method: str, path: str, payload: dict | None) -> dict | None:
         session = await self._get_session()
+        async with session.request(method, f"{self._base_url}{path}", json=payload) as response:
+            if response.status == 204 or response.content_length == 0:
+                return None
+            return await response.json()
+
+    async def _send_hedged(self, tracker: LatencyTracker, method: str, path: str, payload: dict | None):
+        p95 = tracker.percentile(0.95)
+        if len(tracker.samples) < HEDGE_MIN_SAMPLES or p95 is None:
+            return await self._send(method, path, payload)
+
+        primary = asyncio.ensure_future(self._send(method, path, payload))
+        pending = {primary}
+        error: BaseException | None = None
+        # Everything from here on is covered, so a cancelled caller never leaves a request running detached.
+        try:
+            done, _ = await asyncio.wait(pending, timeout=max(p95, self._config.hedge_min_delay))
+            if done:
+                return primary.result()
+
+            pending.add(asyncio.ensure_future(self._send(method, path, payload)))
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def _request(
+        self,
+        call: str,
+        method: str,
+        path: str,
+        payload: dict | None = None,
+        idempotent: bool = True,
+    ) -> dict | None:
+        tracker = self.latency.setdefault(call, LatencyTracker())
+        attempts = self._config.max_retries + 1
+        for attempt in range(attempts):
+            self.breaker.before_call()
+            started = time.monotonic()
+            try:
+                if idempotent and self._config.hedge_requests:
+                    data = await self._send_hedged(tracker, method, path, payload)
+                else:
+                    data = await self._send(method, path, payload)
+            except Exception as exc:
+                outline_request_duration.observe(time.monotonic() - started, self.server_id, call, "error")
+                tracker.errors += 1
+                retryable = _is_retryable(exc)
+                if retryable:
+                    self.breaker.record_failure()
+                else:
+                    self.breaker.record_success()
+                # A non-idempotent request may only be repeated if it never reached the server.
+                if not idempotent and not isinstance(exc, aiohttp.ClientConnectorError):
+                    retryable = False
+                if not retryable or attempt == attempts - 1:
+                    raise
+                delay = self._backoff(attempt)
+                logger.warning(
+                    "Outline %s failed (%s), retry %s/%s in %.2fs",
+                    call, exc, attempt + 1, attempts - 1, delay,
+                )
+                await asyncio.sleep(delay)
+                continue
+            elapsed = time.monotonic() - started
+            outline_request_duration.observe(elapsed, self.server_id, call, "ok")
+            tracker.observe(elapsed)
+            self.breaker.record_success()
+            return data
+        raise OutlineError(f"Outline {call} exhausted retries")
+
+    async def create_key(self, label: str | None = None) -> OutlineKey:
         payload = {"name": label} if label else {}
-        async with session.post(f"{self._base_url}/access-keys", json=payload) as response:
-            data = await response.json()
+        data = await self._request("create_key", "POST", "/access-keys", payload, idempotent=False)
         return OutlineKey(
             key_id=data["id"],
             access_url=data["accessUrl"],
             port=data.get("port"),
+            server_id=self.server_id,
+        )
+
+    async def rename_key(self, key_id: str, name: str) -> None:
+        await self._request("rename_key", "PUT", f"/access-keys/{key_id}/name", {"name": name})
+
+    async def list_key_ids(self) -> list[str]:
+        data = await self._request("list_keys", "GET", "/access-keys")
+        return [str(key["id"]) for key in (data or {}).get("accessKeys", [])]
+
+    async def get_transfer_metrics(self) -> dict[str, int]:
+        data = await self._request("transfer_metrics", "GET", "/metrics/transfer")
+        return {str(key_id): int(value) for key_id, value in (data or {}).get("bytesTransferredByUserId", {}).items()}
+
+    async def set_data_limit(self, key_id: str, limit_bytes: int) -> None:
+        await self._request(
+            "set_data_limit", "PUT", f"/access-keys/{key_id}/data-limit", {"limit": {"bytes": limit_bytes}}
         )
 
+    async def remove_data_limit(self, key_id: str) -> None:
+        await self._request("remove_data_limit", "DELETE", f"/access-keys/{key_id}/data-limit")
+
+    async def delete_key(self, key_id: str) -> bool:
+        try:
+            await self._request("delete_key", "DELETE", f"/access-keys/{key_id}")
+        except aiohttp.ClientResponseError as exc:
+            if exc.status == 404:
+                return False
+            raise
+        return True
+
+
+class OutlineServerPool:
+    def __init__(self, configs: tuple[OutlineConfig, ...] | None = None, placement: str | None = None) -> None:
+        self._configs = configs
+        self._placement = placement
+        self._clients: dict[str, OutlineClient] | None = None
+        self.placement = placement or "keys"
+        self.active_keys: dict[str, int] = {}
+
+    @property
+    def clients(self) -> dict[str, OutlineClient]:
+        # Built on first use so importing this module needs no configuration and opens nothing.
+        if self._clients is None:
+            config = load_config()
+            configs = self._configs or config.outline_servers
+            self.placement = self._placement or config.outline_placement
+            self._clients = {cfg.server_id: OutlineClient(cfg) for cfg in configs}
+            self.active_keys = {server_id: self.active_keys.get(server_id, 0) for server_id in self._clients}
+        return self._clients
+
+    def __iter__(self):
+        return iter(self.clients.values())
+
+    def get(self, server_id: str) -> OutlineClient:
+        try:
+            return self.clients[server_id]
+        except KeyError:
+            raise OutlineError(f"Unknown Outline server {server_id!r}") from None
+
+    def set_active_keys(self, counts: dict[str, int]) -> None:
+        self.active_keys = {server_id: counts.get(server_id, 0) for server_id in self.clients}
+
+    def record_placement(self, server_id: str) -> None:
+        self.active_keys[server_id] = self.active_keys.get(server_id, 0) + 1
+
+    def _load(self, client: OutlineClient) -> float:
+        if self.placement == "latency":
+            tracker = client.latency.get("create_key")
+            p50 = tracker.percentile(0.5) if tracker else None
+            return p50 if p50 is not None else 0.0
+        return self.active_keys.get(client.server_id, 0)
+
+    def pick(self) -> OutlineClient:
+        healthy = [c for c in self.clients.values() if c.breaker.state != CircuitBreaker.OPEN]
+        candidates = healthy or list(self.clients.values())
+        best = math.inf
+        choice: list[OutlineClient] = []
+        for client in candidates:
+            load = self._load(client)
+            if load < best:
+                best, choice = load, [client]
+            elif load == best:
+                choice.append(client)
+        return random.choice(choice)
+
+    def stats(self) -> dict[str, dict]:
+        return {
+            server_id: {**client.stats(), "active_keys": self.active_keys.get(server_id, 0)}
+            for server_id, client in self.clients.items()
+        }
+
+    async def close(self) -> None:
+        if self._clients is not None:
+            await asyncio.gather(*(client.close() for client in self._clients.values()))
+
 
-outline_client = OutlineClient()
+outline_servers = OutlineServerPool()
+registry.register(
+    Gauge(
+        "quazar_outline_breaker_open",
+        "1 while the server's circuit breaker rejects calls.",
+        ("server",),
+        lambda: (
+            ((client.server_id,), int(client.breaker.state == CircuitBreaker.OPEN))
+            for client in outline_servers
+        ),
+    )
+)
@@ -0,0 +1,105 @@
+from __future__ import annotations
+
+import logging
+from collections.abc import Iterable, Mapping
+from dataclasses import dataclass
+from types import MappingProxyType
+from typing import TYPE_CHECKING
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .config import DEFAULT_PLANS, PaymentPlan
+from .database import Plan
+
+if TYPE_CHECKING:
+    from aiogram.types import InlineKeyboardMarkup
+
+logger = logging.getLogger(__name__)
+
+CALLBACK_PREFIX = "plan:"
+
+
+def months_label(months: int) -> str:
+    if months % 10 == 1 and months % 100 != 11:
+        return f"{months} месяц"
+    if months % 10 in (2, 3, 4) and months % 100 not in (12, 13, 14):
+        return f"{months} месяца"
+    return f"{months} месяцев"
+
+
+@dataclass(frozen=True)
+class PlanCatalog:
+    plans: tuple[PaymentPlan, ...]
+    by_months: Mapping[int, PaymentPlan]
+    by_payload_prefix: Mapping[str, PaymentPlan]
+    keyboard: InlineKeyboardMarkup
+    price_text: str
+
+    @classmethod
+    def build(cls, plans: Iterable[PaymentPlan]) -> PlanCatalog:
+        # aiogram.types costs ~2s to import; deferring it keeps CLI tools (reconcile, migrations) fast.
+        from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
+
+        plans = tuple(plans)
+        by_payload_prefix: dict[str, PaymentPlan] = {}
+        for plan in plans:
+            by_payload_prefix[f"{CALLBACK_PREFIX}{plan.months}"] = plan
+            by_payload_prefix[f"plan-{plan.months}m"] = plan
+
+        buttons = []
+        lines = ["🔥 Тарифы Quazar VPN:"]
+        for plan in plans:
+            discount = f" ({plan.discount_hint})" if plan.discount_hint else ""
+            buttons.append(
+                [
+                    InlineKeyboardButton(
+                        text=f"{plan.months} мес — {plan.price_rub}₽{discount}",
+                        callback_data=f"{CALLBACK_PREFIX}{plan.months}",
+                    )
+                ]
+            )
+            lines.append(f"{months_label(plan.months)} — {plan.price_rub}₽{discount}")
+        buttons.append([InlineKeyboardButton(text="Назад ⬅️", callback_data="back_main")])
+        lines += ["", "Оплата Stars. Мгновенный доступ после оплаты."]
+
+        return cls(
+            plans=plans,
+            by_months=MappingProxyType({plan.months: plan for plan in plans}),
+            by_payload_prefix=MappingProxyType(by_payload_prefix),
+            keyboard=InlineKeyboardMarkup(inline_keyboard=buttons),
+            price_text="\n".join(lines),
+        )
+
+    def by_callback(self, data: str) -> PaymentPlan | None:
+        return self.by_payload_prefix.get(data)
+
+    def by_legacy_payload(self, payload: str) -> PaymentPlan | None:
+        return self.by_payload_prefix.get("-".join(payload.split("-", 2)[:2]))
+
+
+_catalog: PlanCatalog | None = None
+
+
+def plan_catalog() -> PlanCatalog:
+    global _catalog
+    if _catalog is None:
+        _catalog = PlanCatalog.build(DEFAULT_PLANS)
+    return _catalog
+
+
+async def reload_plan_catalog(session: AsyncSession) -> PlanCatalog:
+    global _catalog
+    stmt = (
+        select(Plan.months, Plan.price_rub, Plan.price_stars, Plan.discount_hint)
+        .where(Plan.is_active.is_(True))
+        .order_by(Plan.position, Plan.months)
+    )
+    rows = (await session.execute(stmt)).tuples().all()
+    if not rows:
+        catalog = plan_catalog()
+        logger.warning("Plan catalog is empty in the database, keeping %s loaded plans", len(catalog.plans))
+        return catalog
+    _catalog = PlanCatalog.build(PaymentPlan(*row) for row in rows)
+    logger.info("Loaded %s plans", len(_catalog.plans))
+    return _catalog
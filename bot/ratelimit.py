@@ -0,0 +1,109 @@
+from __future__ import annotations
+
+import logging
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Protocol
+
+from .config import BotConfig
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimitBackend(Protocol):
+    async def hit(self, key: int, limit: int, window: float) -> bool: ...
+
+    async def close(self) -> None: ...
+
+
+@dataclass(slots=True)
+class _Window:
+    started: float
+    previous: int
+    current: int
+
+
+class MemoryRateLimitBackend:
+    def __init__(self, shards: int = 64, max_entries: int = 100_000) -> None:
+        self._shards: list[OrderedDict[int, _Window]] = [OrderedDict() for _ in range(shards)]
+        self._max_per_shard = max(1, max_entries // shards)
+
+    def __len__(self) -> int:
+        return sum(len(shard) for shard in self._shards)
+
+    async def hit(self, key: int, limit: int, window: float) -> bool:
+        now = time.monotonic()
+        shard = self._shards[key % len(self._shards)]
+        entry = shard.get(key)
+        if entry is None:
+            entry = shard[key] = _Window(started=now, previous=0, current=0)
+        else:
+            shard.move_to_end(key)
+            elapsed = now - entry.started
+            if elapsed >= 2 * window:
+                entry.started, entry.previous, entry.current = now, 0, 0
+            elif elapsed >= window:
+                entry.started, entry.previous, entry.current = entry.started + window, entry.current, 0
+        self._evict(shard, now, window)
+
+        weight = 1 - (now - entry.started) / window
+        if entry.previous * weight + entry.current >= limit:
+            return False
+        entry.current += 1
+        return True
+
+    def _evict(self, shard: OrderedDict[int, _Window], now: float, window: float) -> None:
+        while shard:
+            oldest = next(iter(shard.values()))
+            if len(shard) <= self._max_per_shard and now - oldest.started < 2 * window:
+                break
+            shard.popitem(last=False)
+
+    async def close(self) -> None:
+        for shard in self._shards:
+            shard.clear()
+
+
+_SLIDING_WINDOW_SCRIPT = """
+local current = tonumber(redis.call('GET', KEYS[1]) or '0')
+local previous = tonumber(redis.call('GET', KEYS[2]) or '0')
+if previous * tonumber(ARGV[2]) + current >= tonumber(ARGV[1]) then
+    return 0
+end
+redis.call('INCR', KEYS[1])
+redis.call('PEXPIRE', KEYS[1], ARGV[3])
+return 1
+"""
+
+
+class RedisRateLimitBackend:
+    def __init__(self, url: str, prefix: str = "quazar:rl") -> None:
+        try:
+            from redis.asyncio import Redis
+        except ImportError as exc:
+            raise RuntimeError("RATE_LIMIT_BACKEND=redis requires the 'redis' package") from exc
+        self._redis = Redis.from_url(url)
+        self._script = self._redis.register_script(_SLIDING_WINDOW_SCRIPT)
+        self._prefix = prefix
+
+    async def hit(self, key: int, limit: int, window: float) -> bool:
+        now = time.time()
+        index = int(now // window)
+        weight = 1 - (now - index * window) / window
+        keys = [f"{self._prefix}:{key}:{index}", f"{self._prefix}:{key}:{index - 1}"]
+        try:
+            allowed = await self._script(keys=keys, args=[limit, weight, int(window * 2000)])
+        except Exception as exc:  # noqa: BLE001
+            logger.warning("Rate limit backend unavailable, letting update through: %s", exc)
+            return True
+        return bool(allowed)
+
+    async def close(self) -> None:
+        await self._redis.aclose()
+
+
+def build_rate_limit_backend(config: BotConfig, scope: str = "message") -> RateLimitBackend:
+    if config.rate_limit_backend == "redis":
+        return RedisRateLimitBackend(config.redis_url, prefix=f"quazar:rl:{scope}")
+    return MemoryRateLimitBackend()
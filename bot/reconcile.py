@@ -0,0 +1,320 @@
+from __future__ import annotations
+
+import argparse
+import asyncio
+import datetime as dt
+import json
+import logging
+from collections.abc import AsyncIterator
+from dataclasses import asdict, dataclass, field
+from typing import TYPE_CHECKING
+
+from .config import load_config
+from .deps import db_session
+from .outline_client import OutlineClient, outline_servers
+from .services import (
+    delete_pooled_keys,
+    find_known_keys,
+    mark_subscriptions_revoked,
+    replace_subscription_key,
+    stream_reconcile_keys,
+)
+
+if TYPE_CHECKING:
+    from aiogram import Bot
+
+logger = logging.getLogger(__name__)
+
+SAMPLE_SIZE = 20
+
+
+def _new_key_text(access_url: str) -> str:
+    return (
+        "🔑 Твой ключ перестал работать на сервере, поэтому мы выпустили новый.\n"
+        f"Новый ключ:\n{access_url}\n\n"
+        "Удали старый ключ в Outline и вставь этот. Срок подписки не изменился."
+    )
+
+
+@dataclass
+class ReconcileReport:
+    server_id: str
+    outline_keys: int = 0
+    db_keys: int = 0
+    matched: int = 0
+    orphans: int = 0
+    missing_subscriptions: int = 0
+    missing_pooled: int = 0
+    orphans_deleted: int = 0
+    recent: int = 0
+    reappeared: int = 0
+    subscriptions_revoked: int = 0
+    subscriptions_rekeyed: int = 0
+    users_notified: int = 0
+    pooled_removed: int = 0
+    skipped_repairs: int = 0
+    orphan_sample: list[str] = field(default_factory=list)
+    missing_sample: list[str] = field(default_factory=list)
+
+
+class Reconciler:
+    def __init__(
+        self,
+        chunk_size: int = 1000,
+        repair: bool = False,
+        confirm_delay: float = 30.0,
+        max_repairs: int = 500,
+        concurrency: int = 8,
+        bot: Bot | None = None,
+    ) -> None:
+        self.chunk_size = chunk_size
+        self.repair = repair
+        self.confirm_delay = confirm_delay
+        self.max_repairs = max_repairs
+        self.concurrency = concurrency
+        self.bot = bot
+
+    async def _db_keys(
+        self, server_id: str
+    ) -> AsyncIterator[tuple[str, str, int, dt.datetime | None, dt.datetime | None]]:
+        after = None
+        while True:
+            async with db_session() as session:
+                rows = await stream_reconcile_keys(session, server_id, after, self.chunk_size)
+            for row in rows:
+                yield row
+            if len(rows) < self.chunk_size:
+                return
+            after = (rows[-1][0], rows[-1][1])
+
+    async def reconcile(self, client: OutlineClient) -> ReconcileReport:
+        report = ReconcileReport(server_id=client.server_id)
+        # Rows written around the listing may hold keys it could not contain yet (pool refills, inline
+        # provisioning, a concurrent re-key); they are left for the next run. A key is created before
+        # its row commits, so the window reaches back by confirm_delay as well.
+        settled_before = dt.datetime.now(dt.timezone.utc) - dt.timedelta(seconds=self.confirm_delay)
+        # The Management API returns every key in one response; only the ids are kept, sorted in place.
+        outline_ids = await client.list_key_ids()
+        outline_ids.sort()
+        report.outline_keys = len(outline_ids)
+
+        orphans: list[str] = []
+        missing_pooled: list[tuple[int, str]] = []
+        missing_subscriptions: list[tuple[int, str, dt.datetime]] = []
+        now = dt.datetime.now(dt.timezone.utc)
+
+        def orphan(key_id: str) -> None:
+            report.orphans += 1
+            if len(report.orphan_sample) < SAMPLE_SIZE:
+                report.orphan_sample.append(key_id)
+            if self.repair and len(orphans) < self.max_repairs:
+                orphans.append(key_id)
+
+        index, last_matched = 0, None
+        async for key_id, source, row_id, expires_at, changed_at in self._db_keys(client.server_id):
+            report.db_keys += 1
+            while index < len(outline_ids) and outline_ids[index] < key_id:
+                if outline_ids[index] != last_matched:
+                    orphan(outline_ids[index])
+                index += 1
+            if index < len(outline_ids) and outline_ids[index] == key_id:
+                last_matched = key_id
+                report.matched += 1
+                continue
+            if changed_at is not None and _aware(changed_at) > settled_before:
+                report.recent += 1
+                continue
+            if len(report.missing_sample) < SAMPLE_SIZE:
+                report.missing_sample.append(f"{source}:{row_id}:{key_id}")
+            if source == "pool":
+                report.missing_pooled += 1
+                if self.repair and len(missing_pooled) < self.max_repairs:
+                    missing_pooled.append((row_id, key_id))
+            else:
+                report.missing_subscriptions += 1
+                if self.repair and len(missing_subscriptions) < self.max_repairs:
+                    missing_subscriptions.append((row_id, key_id, expires_at))
+        for key_id in outline_ids[index:]:
+            if key_id != last_matched:
+                orphan(key_id)
+        del outline_ids
+
+        if self.repair:
+            report.skipped_repairs = (
+                report.orphans - len(orphans)
+                + report.missing_pooled - len(missing_pooled)
+                + report.missing_subscriptions - len(missing_subscriptions)
+            )
+            if orphans or missing_pooled or missing_subscriptions:
+                # Give in-flight provisioning time to land, then act only on what is confirmed.
+                await asyncio.sleep(self.confirm_delay)
+            await self._repair_missing(client, report, missing_pooled, missing_subscriptions, now)
+            await self._repair_orphans(client, report, orphans)
+        return report
+
+    async def _still_missing(self, client: OutlineClient, key_ids: list[str]) -> set[str]:
+        # A key absent from the first listing may have been created right after it; list again.
+        missing = set(key_ids)
+        if missing:
+            for key_id in await client.list_key_ids():
+                missing.discard(key_id)
+        return missing
+
+    async def _repair_missing(
+        self,
+        client: OutlineClient,
+        report: ReconcileReport,
+        pooled: list[tuple[int, str]],
+        subscriptions: list[tuple[int, str, dt.datetime]],
+        now: dt.datetime,
+    ) -> None:
+        missing = await self._still_missing(
+            client, [key_id for _, key_id in pooled] + [key_id for _, key_id, _ in subscriptions]
+        )
+        candidates = len(pooled) + len(subscriptions)
+        pooled_ids = [row_id for row_id, key_id in pooled if key_id in missing]
+        subscriptions = [row for row in subscriptions if row[1] in missing]
+        report.reappeared = candidates - len(pooled_ids) - len(subscriptions)
+
+        expired = [sub_id for sub_id, _, expires_at in subscriptions if _aware(expires_at) <= now]
+        active = [(sub_id, key_id) for sub_id, key_id, expires_at in subscriptions if _aware(expires_at) > now]
+        async with db_session() as session:
+            await delete_pooled_keys(session, pooled_ids)
+            await mark_subscriptions_revoked(session, expired)
+        report.pooled_removed = len(pooled_ids)
+        report.subscriptions_revoked = len(expired)
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+        notified: list[bool] = []
+
+        async def rekey(subscription_id: int, old_key_id: str) -> bool:
+            async with semaphore:
+                try:
+                    key = await client.create_key(label=f"sub-{subscription_id}")
+                except Exception as exc:  # noqa: BLE001
+                    logger.warning("Failed to re-issue key for subscription %s: %s", subscription_id, exc)
+                    return False
+            async with db_session() as session:
+                telegram_id = await replace_subscription_key(
+                    session, subscription_id, old_key_id, key.key_id, key.access_url
+                )
+            if telegram_id is None:
+                logger.info("Subscription %s changed during reconcile, dropping key %s", subscription_id, key.key_id)
+                try:
+                    await client.delete_key(key.key_id)
+                except Exception as exc:  # noqa: BLE001
+                    logger.warning("Failed to delete unused key %s on %s: %s", key.key_id, client.server_id, exc)
+                return False
+            logger.info("Re-issued Outline key %s for subscription %s", key.key_id, subscription_id)
+            if self.bot is not None:
+                notified.append(await self._notify(telegram_id, key.access_url))
+            return True
+
+        results = await asyncio.gather(*(rekey(sub_id, key_id) for sub_id, key_id in active))
+        report.subscriptions_rekeyed = sum(results)
+        report.users_notified = sum(notified)
+
+    async def _notify(self, telegram_id: int, access_url: str) -> bool:
+        # Imported here: the broadcast module pulls in aiogram, which the report-only run never needs.
+        from .broadcast import broadcaster, send_with_backoff
+
+        return await send_with_backoff(self.bot, broadcaster.bucket, telegram_id, _new_key_text(access_url))
+
+    async def _repair_orphans(self, client: OutlineClient, report: ReconcileReport, orphans: list[str]) -> None:
+        if not orphans:
+            return
+        # A key is created on Outline before its subscription commits; after the delay only keys that
+        # are still unknown are deleted.
+        confirmed: list[str] = []
+        for start in range(0, len(orphans), self.chunk_size):
+            chunk = orphans[start : start + self.chunk_size]
+            async with db_session() as session:
+                known = await find_known_keys(session, client.server_id, chunk)
+            confirmed.extend(key_id for key_id in chunk if key_id not in known)
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def remove(key_id: str) -> bool:
+            async with semaphore:
+                try:
+                    return await client.delete_key(key_id)
+                except Exception as exc:  # noqa: BLE001
+                    logger.warning("Failed to delete orphan key %s on %s: %s", key_id, client.server_id, exc)
+                    return False
+
+        results = await asyncio.gather(*(remove(key_id) for key_id in confirmed))
+        report.orphans_deleted = sum(results)
+
+
+def _aware(value: dt.datetime) -> dt.datetime:
+    return value if value.tzinfo is not None else value.replace(tzinfo=dt.timezone.utc)
+
+
+async def run(args: argparse.Namespace) -> list[ReconcileReport]:
+    bot = None
+    if args.repair and not args.no_notify:
+        from .main import create_bot
+
+        bot = create_bot(load_config())
+    reconciler = Reconciler(
+        chunk_size=args.chunk_size,
+        repair=args.repair,
+        confirm_delay=args.confirm_delay,
+        max_repairs=args.max_repairs,
+        concurrency=args.concurrency,
+        bot=bot,
+    )
+    clients = [outline_servers.get(args.server)] if args.server else list(outline_servers)
+    reports = []
+    try:
+        for client in clients:
+            report = await reconciler.reconcile(client)
+            logger.info(
+                "Reconciled %s: %s Outline keys, %s DB keys, %s orphans, %s missing",
+                report.server_id, report.outline_keys, report.db_keys,
+                report.orphans, report.missing_subscriptions + report.missing_pooled,
+            )
+            reports.append(report)
+    finally:
+        await outline_servers.close()
+        if bot is not None:
+            await bot.session.close()
+    return reports
+
+
+def main() -> None:
+    from .main import setup_logging
+
+    parser = argparse.ArgumentParser(description="Compare Outline access keys with the database and optionally repair drift.")
+    parser.add_argument("--server", help="Only reconcile this Outline server id.")
+    parser.add_argument("--repair", action="store_true", help="Delete orphan keys and fix rows whose keys are gone.")
+    parser.add_argument("--chunk-size", type=int, default=1000)
+    parser.add_argument("--confirm-delay", type=float, default=30.0, help="Seconds to wait before re-checking orphans.")
+    parser.add_argument("--max-repairs", type=int, default=500, help="Cap on repairs of each kind per server.")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--no-notify", action="store_true", help="Do not message users whose key was re-issued.")
+    parser.add_argument("--json", action="store_true", help="Print one JSON object per server.")
+    args = parser.parse_args()
+
+    setup_logging()
+    reports = asyncio.run(run(args))
+    for report in reports:
+        if args.json:
+            print(json.dumps(asdict(report), ensure_ascii=False))
+        else:
+            print(
+                f"{report.server_id}: outline={report.outline_keys} db={report.db_keys} matched={report.matched} "
+                f"orphans={report.orphans} missing_subscriptions={report.missing_subscriptions} "
+                f"missing_pooled={report.missing_pooled} recent={report.recent}"
+            )
+            if args.repair:
+                print(
+                    f"  deleted={report.orphans_deleted} revoked={report.subscriptions_revoked} "
+                    f"rekeyed={report.subscriptions_rekeyed} notified={report.users_notified} "
+                    f"pooled_removed={report.pooled_removed} reappeared={report.reappeared} "
+                    f"skipped={report.skipped_repairs}"
+                )
+
+
+if __name__ == "__main__":
+    main()
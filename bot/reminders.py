@@ -0,0 +1,107 @@
+from __future__ import annotations
+
+import asyncio
+import datetime as dt
+import logging
+from functools import cached_property
+
+from aiogram import Bot
+
+from .broadcast import broadcaster, send_with_backoff
+from .config import ReminderConfig, load_config
+from .deps import db_session
+from .keyboards import renew_keyboard
+from .services import fetch_reminder_batch, mark_reminders_sent
+
+logger = logging.getLogger(__name__)
+
+MSK = dt.timezone(dt.timedelta(hours=3))
+
+
+def _reminder_text(expires_at: dt.datetime) -> str:
+    if expires_at.tzinfo is None:
+        expires_at = expires_at.replace(tzinfo=dt.timezone.utc)
+    return (
+        "⏳ Подписка скоро закончится\n"
+        f"Истекает: {expires_at.astimezone(MSK):%d.%m.%Y %H:%M} (МСК)\n\n"
+        "Продли заранее — ключ останется прежним, а оставшиеся дни сохранятся."
+    )
+
+
+class ExpiryReminder:
+    def __init__(self) -> None:
+        self._task: asyncio.Task | None = None
+
+    @cached_property
+    def config(self) -> ReminderConfig:
+        return load_config().reminders
+
+    def start(self, bot: Bot) -> None:
+        if not self.config.offsets_days:
+            return
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run(bot), name="expiry-reminder")
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    async def _run(self, bot: Bot) -> None:
+        while True:
+            try:
+                await self.remind(bot)
+            except Exception:
+                logger.exception("Expiry reminder pass failed")
+            await asyncio.sleep(self.config.interval)
+
+    async def remind(self, bot: Bot) -> int:
+        now = dt.datetime.now(dt.timezone.utc)
+        sent = 0
+        # Windows are disjoint (3 days: (now+1d, now+3d], 1 day: (now, now+1d]), so a user
+        # is never sent two reminders in one pass.
+        bounds = (*self.config.offsets_days, 0)
+        for offset, next_offset in zip(bounds, bounds[1:]):
+            sent += await self._remind_window(
+                bot,
+                offset,
+                now + dt.timedelta(days=next_offset),
+                now + dt.timedelta(days=offset),
+            )
+        if sent:
+            logger.info("Sent %s expiry reminders", sent)
+        return sent
+
+    async def _remind_window(
+        self, bot: Bot, offset: int, window_start: dt.datetime, window_end: dt.datetime
+    ) -> int:
+        semaphore = asyncio.Semaphore(self.config.concurrency)
+        keyboard = renew_keyboard()
+
+        async def send(telegram_id: int, expires_at: dt.datetime) -> bool:
+            async with semaphore:
+                # The broadcaster's bucket is shared, so reminders and a running broadcast together stay
+                # under Telegram's per-bot limit.
+                return await send_with_backoff(
+                    bot, broadcaster.bucket, telegram_id, _reminder_text(expires_at), reply_markup=keyboard
+                )
+
+        sent = 0
+        after = None
+        while True:
+            async with db_session() as session:
+                batch = await fetch_reminder_batch(
+                    session, offset, window_start, window_end, after, self.config.batch_size
+                )
+                # Marked before sending: a crash mid-batch skips a reminder rather than repeating it.
+                await mark_reminders_sent(session, offset, [subscription_id for subscription_id, _, _ in batch])
+            if not batch:
+                return sent
+            results = await asyncio.gather(
+                *(send(telegram_id, expires_at) for _, expires_at, telegram_id in batch)
+            )
+            sent += sum(results)
+            after = (batch[-1][1], batch[-1][0])
+
+
+expiry_reminder = ExpiryReminder()
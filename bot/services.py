@@ -1,36 +1,168 @@
 from __future__ import annotations
 
 import datetime as dt
+import time
+import uuid
 from collections.abc import Sequence
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import TYPE_CHECKING
 
-from aiogram.types import User as TelegramUser
-from sqlalchemy import select
+from sqlalchemy import case, collate, delete, exists, func, insert, literal, or_, select, tuple_, union, union_all, update
+from sqlalchemy.orm import aliased
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from .config import load_config
-from .database import Payment, PaymentStatus, Subscription, User
+from .cache import LRUCache
+from .config import BotConfig, PaymentPlan, UsageConfig, load_config
+from .database import (
+    Broadcast,
+    BroadcastStatus,
+    FsmRecord,
+    Job,
+    JobStatus,
+    Payment,
+    PaymentStatus,
+    PooledKey,
+    RevenueDaily,
+    StatCounter,
+    StatCounterName,
+    Subscription,
+    SubscriptionReminder,
+    SubscriptionUsage,
+    UsageDaily,
+    UsageSample,
+    User,
+)
+from .invoices import build_invoice_payload, parse_invoice_payload, pending_invoices
+from .plans import plan_catalog
 
+if TYPE_CHECKING:
+    from aiogram.types import User as TelegramUser
+
+    from .outline_client import OutlineKey
+
+
+_stats_cache: tuple[float, dict[str, int | float]] | None = None
+_identity_cache: LRUCache[int, UserRef] = LRUCache(BotConfig.user_cache_size)
+_subscription_cache: LRUCache[int, SubscriptionView | None] = LRUCache(BotConfig.subscription_cache_size)
+_usage_cache: LRUCache[int, int | None] = LRUCache(BotConfig.subscription_cache_size, ttl=UsageConfig.interval)
+_MISSING = object()
+
+
+async def _bump_counter(session: AsyncSession, name: str, delta: int) -> None:
+    await session.execute(
+        update(StatCounter).where(StatCounter.name == name).values(value=StatCounter.value + delta)
+    )
+
+
+@dataclass(frozen=True, slots=True)
+class UserRef:
+    id: int
+    telegram_id: int
+    username: str | None
+    full_name: str | None
+
+
+def _as_utc(value: dt.datetime) -> dt.datetime:
+    if value.tzinfo is None:
+        return value.replace(tzinfo=dt.timezone.utc)
+    return value
+
+
+def _as_date(value) -> dt.date:
+    return value if isinstance(value, dt.date) else dt.date.fromisoformat(value)
 
-async def ensure_user(session: AsyncSession, tg_user: TelegramUser) -> User:
-    stmt = select(User).where(User.telegram_id == tg_user.id)
-    result = await session.execute(stmt)
-    user = result.scalar_one_or_none()
-    if user:
-        user.username = tg_user.username
-        user.full_name = tg_user.full_name
-        return user
 
-    user = User(
+def configure_caches(config: BotConfig) -> None:
+    _identity_cache.maxsize = config.user_cache_size
+    _subscription_cache.maxsize = config.subscription_cache_size
+    _usage_cache.maxsize = config.subscription_cache_size
+    _usage_cache.ttl = config.usage.interval
+    pending_invoices.maxsize = config.pending_invoice_cache_size
+
+
+def _dialect_insert(session: AsyncSession):
+    if session.get_bind().dialect.name == "postgresql":
+        return postgresql_insert
+    return sqlite_insert
+
+
+async def ensure_user(session: AsyncSession, tg_user: TelegramUser) -> UserRef:
+    cached = _identity_cache.get(tg_user.id)
+    if cached is not None and (cached.username, cached.full_name) == (tg_user.username, tg_user.full_name):
+        return cached
+
+    # created_at is only written on insert, so getting our own timestamp back means the row is new.
+    created_at = dt.datetime.now(dt.timezone.utc)
+    insert_stmt = _dialect_insert(session)(User).values(
         telegram_id=tg_user.id,
         username=tg_user.username,
         full_name=tg_user.full_name,
+        created_at=created_at,
     )
-    session.add(user)
-    await session.flush()
+    excluded = insert_stmt.excluded
+    stmt = insert_stmt.on_conflict_do_update(
+        index_elements=[User.telegram_id],
+        set_={"username": excluded.username, "full_name": excluded.full_name},
+        where=or_(
+            User.username.is_distinct_from(excluded.username),
+            User.full_name.is_distinct_from(excluded.full_name),
+        ),
+    ).returning(User.id, User.created_at)
+    row = (await session.execute(stmt)).first()
+    if row is None:
+        user_id = (await session.execute(select(User.id).where(User.telegram_id == tg_user.id))).scalar_one()
+    else:
+        user_id = row.id
+        if _as_utc(row.created_at) == created_at:
+            await _bump_counter(session, StatCounterName.USERS, 1)
+
+    user = UserRef(
+        id=user_id,
+        telegram_id=tg_user.id,
+        username=tg_user.username,
+        full_name=tg_user.full_name,
+    )
+    if row is None:
+        # Only rows confirmed unchanged are cached: a fresh insert or update could still be rolled back.
+        _identity_cache.set(tg_user.id, user)
     return user
 
 
-async def get_active_subscription(session: AsyncSession, user_id: int) -> Subscription | None:
+@dataclass(frozen=True, slots=True)
+class SubscriptionView:
+    id: int
+    user_id: int
+    server_id: str
+    outline_key_id: str
+    outline_access_url: str
+    months: int
+    expires_at: dt.datetime
+
+    @classmethod
+    def from_row(cls, subscription: Subscription) -> SubscriptionView:
+        return cls(
+            id=subscription.id,
+            user_id=subscription.user_id,
+            server_id=subscription.server_id,
+            outline_key_id=subscription.outline_key_id,
+            outline_access_url=subscription.outline_access_url,
+            months=subscription.months,
+            expires_at=_as_utc(subscription.expires_at),
+        )
+
+
+def invalidate_subscription_cache(user_id: int) -> None:
+    _subscription_cache.pop(user_id)
+
+
+async def get_active_subscription(session: AsyncSession, user_id: int) -> SubscriptionView | None:
+    cached = _subscription_cache.get(user_id, _MISSING)
+    if cached is not _MISSING:
+        return cached
+
     now = dt.datetime.now(dt.timezone.utc)
     stmt = (
         select(Subscription)
@@ -38,22 +170,30 @@ async def get_active_subscription(session: AsyncSession, user_id: int) -> Subscr
         .order_by(Subscription.expires_at.desc())
         .limit(1)
     )
-    result = await session.execute(stmt)
-    return result.scalar_one_or_none()
+    subscription = (await session.execute(stmt)).scalar_one_or_none()
+    if subscription is None:
+        _subscription_cache.set(user_id, None, ttl=load_config().subscription_cache_negative_ttl)
+        return None
+
+    view = SubscriptionView.from_row(subscription)
+    _subscription_cache.set(user_id, view, ttl=(view.expires_at - now).total_seconds())
+    return view
 
 
 async def create_subscription(
     session: AsyncSession,
-    user: User,
+    user: UserRef,
     outline_key_id: str,
     outline_access_url: str,
     months: int,
+    server_id: str = "default",
 ) -> Subscription:
     now = dt.datetime.now(dt.timezone.utc)
     expires_at = now + dt.timedelta(days=30 * months)
 
     subscription = Subscription(
         user_id=user.id,
+        server_id=server_id,
         outline_key_id=outline_key_id,
         outline_access_url=outline_access_url,
         months=months,
@@ -61,29 +201,409 @@ async def create_subscription(
     )
     session.add(subscription)
     await session.flush()
+    invalidate_subscription_cache(user.id)
     return subscription
 
 
+def _extended_expiry(session: AsyncSession, now: dt.datetime, days: int):
+    if session.get_bind().dialect.name == "postgresql":
+        return func.greatest(Subscription.expires_at, now) + dt.timedelta(days=days)
+    # SQLite stores datetimes as ISO text, so max() compares them correctly and datetime() adds the days.
+    return func.datetime(func.max(Subscription.expires_at, now), f"+{days} days", type_=Subscription.expires_at.type)
+
+
+async def renew_subscription(session: AsyncSession, user_id: int, months: int) -> Subscription | None:
+    now = dt.datetime.now(dt.timezone.utc)
+    current = (
+        select(Subscription.id)
+        .where(Subscription.user_id == user_id, Subscription.expires_at >= now, Subscription.revoked_at.is_(None))
+        .order_by(Subscription.expires_at.desc())
+        .limit(1)
+        .scalar_subquery()
+    )
+    stmt = (
+        update(Subscription)
+        .where(Subscription.id == current)
+        .values(expires_at=_extended_expiry(session, now, 30 * months), months=Subscription.months + months)
+        .returning(Subscription)
+        .execution_options(synchronize_session=False)
+    )
+    subscription = (await session.execute(stmt)).scalar_one_or_none()
+    if subscription is not None:
+        invalidate_subscription_cache(user_id)
+    return subscription
+
+
+async def reset_usage(session: AsyncSession, subscription_id: int) -> bool:
+    was_limited = await session.execute(
+        select(SubscriptionUsage.limited).where(SubscriptionUsage.subscription_id == subscription_id)
+    )
+    await session.execute(
+        update(SubscriptionUsage)
+        .where(SubscriptionUsage.subscription_id == subscription_id)
+        .values(bytes_used=0, limited=False)
+    )
+    _usage_cache.pop(subscription_id)
+    return bool(was_limited.scalar_one_or_none())
+
+
+async def fetch_expired_subscriptions(
+    session: AsyncSession,
+    expired_before: dt.datetime,
+    after: tuple[dt.datetime, int] | None,
+    limit: int,
+) -> Sequence[tuple[int, dt.datetime, str, str]]:
+    stmt = (
+        select(Subscription.id, Subscription.expires_at, Subscription.server_id, Subscription.outline_key_id)
+        .where(Subscription.expires_at < expired_before, Subscription.revoked_at.is_(None))
+        .order_by(Subscription.expires_at, Subscription.id)
+        .limit(limit)
+    )
+    if after is not None:
+        after_expires_at, after_id = after
+        stmt = stmt.where(
+            (Subscription.expires_at > after_expires_at)
+            | ((Subscription.expires_at == after_expires_at) & (Subscription.id > after_id))
+        )
+    result = await session.execute(stmt)
+    return result.tuples().all()
+
+
+async def fetch_reminder_batch(
+    session: AsyncSession,
+    offset_days: int,
+    window_start: dt.datetime,
+    window_end: dt.datetime,
+    after: tuple[dt.datetime, int] | None,
+    limit: int,
+) -> Sequence[tuple[int, dt.datetime, int]]:
+    later = aliased(Subscription)
+    sent = (
+        (SubscriptionReminder.subscription_id == Subscription.id)
+        & (SubscriptionReminder.offset_days == offset_days)
+        & (SubscriptionReminder.expires_at == Subscription.expires_at)
+    )
+    stmt = (
+        select(Subscription.id, Subscription.expires_at, User.telegram_id)
+        .join(User, User.id == Subscription.user_id)
+        .outerjoin(SubscriptionReminder, sent)
+        .where(
+            Subscription.expires_at > window_start,
+            Subscription.expires_at <= window_end,
+            Subscription.revoked_at.is_(None),
+            SubscriptionReminder.subscription_id.is_(None),
+            ~exists().where(
+                later.user_id == Subscription.user_id,
+                later.expires_at > Subscription.expires_at,
+                later.revoked_at.is_(None),
+            ),
+        )
+        .order_by(Subscription.expires_at, Subscription.id)
+        .limit(limit)
+    )
+    if after is not None:
+        after_expires_at, after_id = after
+        stmt = stmt.where(
+            (Subscription.expires_at > after_expires_at)
+            | ((Subscription.expires_at == after_expires_at) & (Subscription.id > after_id))
+        )
+    return (await session.execute(stmt)).tuples().all()
+
+
+async def mark_reminders_sent(session: AsyncSession, offset_days: int, subscription_ids: Sequence[int]) -> None:
+    if not subscription_ids:
+        return
+    # Copy expires_at inside the database so the stored value matches the subscription column exactly.
+    source = select(Subscription.id, literal(offset_days), Subscription.expires_at).where(
+        Subscription.id.in_(subscription_ids)
+    )
+    insert_stmt = _dialect_insert(session)(SubscriptionReminder).from_select(
+        ["subscription_id", "offset_days", "expires_at"], source
+    )
+    await session.execute(
+        insert_stmt.on_conflict_do_update(
+            index_elements=[SubscriptionReminder.subscription_id, SubscriptionReminder.offset_days],
+            set_={"expires_at": insert_stmt.excluded.expires_at, "sent_at": func.now()},
+        )
+    )
+
+
+async def mark_subscriptions_revoked(session: AsyncSession, subscription_ids: Sequence[int]) -> None:
+    if not subscription_ids:
+        return
+    await session.execute(
+        update(Subscription)
+        .where(Subscription.id.in_(subscription_ids))
+        .values(revoked_at=dt.datetime.now(dt.timezone.utc))
+    )
+
+
+async def stream_reconcile_keys(
+    session: AsyncSession, server_id: str, after: tuple[str, str] | None, limit: int
+) -> Sequence[tuple[str, str, int, dt.datetime | None, dt.datetime | None]]:
+    keys = union_all(
+        select(
+            Subscription.outline_key_id.label("key_id"),
+            literal("subscription").label("source"),
+            Subscription.id.label("row_id"),
+            Subscription.expires_at.label("expires_at"),
+            func.coalesce(Subscription.updated_at, Subscription.created_at).label("changed_at"),
+        ).where(Subscription.server_id == server_id, Subscription.revoked_at.is_(None)),
+        select(
+            PooledKey.key_id.label("key_id"),
+            literal("pool").label("source"),
+            PooledKey.id.label("row_id"),
+            literal(None, type_=Subscription.expires_at.type).label("expires_at"),
+            PooledKey.created_at.label("changed_at"),
+        ).where(PooledKey.server_id == server_id, PooledKey.claimed_at.is_(None)),
+    ).subquery()
+    key_id = keys.c.key_id
+    if session.get_bind().dialect.name == "postgresql":
+        # Byte order, so the stream sorts exactly like Python's sorted() on the Outline side.
+        key_id = collate(key_id, "C")
+    stmt = select(keys.c.key_id, keys.c.source, keys.c.row_id, keys.c.expires_at, keys.c.changed_at)
+    if after is not None:
+        stmt = stmt.where(tuple_(key_id, keys.c.source) > tuple_(*after))
+    stmt = stmt.order_by(key_id, keys.c.source).limit(limit)
+    return (await session.execute(stmt)).tuples().all()
+
+
+async def find_known_keys(session: AsyncSession, server_id: str, key_ids: Sequence[str]) -> set[str]:
+    if not key_ids:
+        return set()
+    subscriptions = select(Subscription.outline_key_id).where(
+        Subscription.server_id == server_id,
+        Subscription.revoked_at.is_(None),
+        Subscription.outline_key_id.in_(key_ids),
+    )
+    pooled = select(PooledKey.key_id).where(PooledKey.server_id == server_id, PooledKey.key_id.in_(key_ids))
+    return set((await session.execute(union_all(subscriptions, pooled))).scalars())
+
+
+async def delete_pooled_keys(session: AsyncSession, pooled_ids: Sequence[int]) -> None:
+    if pooled_ids:
+        await session.execute(
+            delete(PooledKey).where(PooledKey.id.in_(pooled_ids), PooledKey.claimed_at.is_(None))
+        )
+
+
+async def replace_subscription_key(
+    session: AsyncSession, subscription_id: int, old_key_id: str, key_id: str, access_url: str
+) -> int | None:
+    # Only the key that was found missing is replaced; None means the row moved on meanwhile.
+    stmt = (
+        update(Subscription)
+        .where(
+            Subscription.id == subscription_id,
+            Subscription.outline_key_id == old_key_id,
+            Subscription.revoked_at.is_(None),
+        )
+        .values(outline_key_id=key_id, outline_access_url=access_url)
+        .returning(Subscription.user_id)
+    )
+    user_id = (await session.execute(stmt)).scalar_one_or_none()
+    if user_id is None:
+        return None
+    invalidate_subscription_cache(user_id)
+    return (await session.execute(select(User.telegram_id).where(User.id == user_id))).scalar_one_or_none()
+
+
+async def evict_changed_subscriptions(session: AsyncSession, since: dt.datetime) -> int:
+    # Writes from other processes (renewals, reconcile repairs, the sweeper) only reach this
+    # process's caches through here.
+    rows = (
+        await session.execute(
+            select(Subscription.id, Subscription.user_id).where(Subscription.updated_at >= since)
+        )
+    ).all()
+    for subscription_id, user_id in rows:
+        _subscription_cache.pop(user_id)
+        _usage_cache.pop(subscription_id)
+    return len(rows)
+
+
+async def get_plan_catalog_version(session: AsyncSession) -> int:
+    stmt = select(StatCounter.value).where(StatCounter.name == StatCounterName.PLAN_CATALOG_VERSION)
+    return (await session.execute(stmt)).scalar_one_or_none() or 0
+
+
+async def bump_plan_catalog_version(session: AsyncSession) -> None:
+    await _bump_counter(session, StatCounterName.PLAN_CATALOG_VERSION, 1)
+
+
+async def fetch_usage_state(session: AsyncSession, server_id: str) -> Sequence[tuple]:
+    now = dt.datetime.now(dt.timezone.utc)
+    stmt = (
+        select(
+            Subscription.id,
+            Subscription.outline_key_id,
+            SubscriptionUsage.last_counter,
+            func.coalesce(SubscriptionUsage.bytes_used, 0),
+            func.coalesce(SubscriptionUsage.limited, False),
+        )
+        .outerjoin(SubscriptionUsage, SubscriptionUsage.subscription_id == Subscription.id)
+        .where(
+            Subscription.server_id == server_id,
+            Subscription.expires_at >= now,
+            Subscription.revoked_at.is_(None),
+        )
+    )
+    return (await session.execute(stmt)).tuples().all()
+
+
+async def save_usage(session: AsyncSession, states: Sequence[dict], samples: Sequence[dict]) -> None:
+    if samples:
+        await session.execute(insert(UsageSample), list(samples))
+    if not states:
+        return
+    insert_stmt = _dialect_insert(session)(SubscriptionUsage).values(list(states))
+    excluded = insert_stmt.excluded
+    await session.execute(
+        insert_stmt.on_conflict_do_update(
+            index_elements=[SubscriptionUsage.subscription_id],
+            set_={
+                "last_counter": excluded.last_counter,
+                "bytes_used": excluded.bytes_used,
+                "updated_at": excluded.updated_at,
+            },
+        )
+    )
+    for state in states:
+        _usage_cache.set(state["subscription_id"], state["bytes_used"])
+
+
+async def mark_usage_limited(session: AsyncSession, subscription_ids: Sequence[int]) -> None:
+    if subscription_ids:
+        await session.execute(
+            update(SubscriptionUsage)
+            .where(SubscriptionUsage.subscription_id.in_(subscription_ids))
+            .values(limited=True)
+        )
+
+
+async def rollup_usage(session: AsyncSession, before: dt.datetime) -> int:
+    day = func.date(UsageSample.collected_at)
+    stmt = (
+        select(UsageSample.subscription_id, day, func.sum(UsageSample.bytes))
+        .where(UsageSample.collected_at < before)
+        .group_by(UsageSample.subscription_id, day)
+    )
+    rows = [
+        {
+            "subscription_id": subscription_id,
+            "day": _as_date(value),
+            "bytes": total,
+        }
+        for subscription_id, value, total in (await session.execute(stmt)).tuples()
+    ]
+    if not rows:
+        return 0
+    insert_stmt = _dialect_insert(session)(UsageDaily).values(rows)
+    await session.execute(
+        insert_stmt.on_conflict_do_update(
+            index_elements=[UsageDaily.subscription_id, UsageDaily.day],
+            set_={"bytes": UsageDaily.bytes + insert_stmt.excluded.bytes},
+        )
+    )
+    await session.execute(delete(UsageSample).where(UsageSample.collected_at < before))
+    return len(rows)
+
+
+async def get_subscription_usage(session: AsyncSession, subscription_id: int) -> int | None:
+    cached = _usage_cache.get(subscription_id, _MISSING)
+    if cached is not _MISSING:
+        return cached
+    stmt = select(SubscriptionUsage.bytes_used).where(SubscriptionUsage.subscription_id == subscription_id)
+    used = (await session.execute(stmt)).scalar_one_or_none()
+    _usage_cache.set(subscription_id, used)
+    return used
+
+
+async def count_active_keys_by_server(session: AsyncSession) -> dict[str, int]:
+    now = dt.datetime.now(dt.timezone.utc)
+    stmt = (
+        select(Subscription.server_id, func.count())
+        .where(Subscription.expires_at >= now)
+        .group_by(Subscription.server_id)
+    )
+    return dict((await session.execute(stmt)).tuples().all())
+
+
+async def list_key_server_ids(session: AsyncSession) -> set[str]:
+    subscriptions = select(Subscription.server_id).where(Subscription.revoked_at.is_(None))
+    pooled = select(PooledKey.server_id).where(PooledKey.claimed_at.is_(None))
+    return set((await session.execute(union(subscriptions, pooled))).scalars())
+
+
+async def count_pooled_keys(session: AsyncSession, server_id: str) -> int:
+    stmt = (
+        select(func.count())
+        .select_from(PooledKey)
+        .where(PooledKey.server_id == server_id, PooledKey.claimed_at.is_(None))
+    )
+    return (await session.execute(stmt)).scalar_one()
+
+
+async def add_pooled_keys(session: AsyncSession, keys: Sequence[OutlineKey]) -> None:
+    session.add_all(
+        PooledKey(server_id=key.server_id, key_id=key.key_id, access_url=key.access_url)
+        for key in keys
+    )
+    await session.flush()
+
+
+async def claim_pooled_key(session: AsyncSession, user: UserRef, server_id: str) -> PooledKey | None:
+    candidate = (
+        select(PooledKey.id)
+        .where(PooledKey.server_id == server_id, PooledKey.claimed_at.is_(None))
+        .order_by(PooledKey.id)
+        .limit(1)
+        .with_for_update(skip_locked=True)
+        .scalar_subquery()
+    )
+    stmt = (
+        update(PooledKey)
+        .where(PooledKey.id == candidate, PooledKey.claimed_at.is_(None))
+        .values(claimed_at=dt.datetime.now(dt.timezone.utc), claimed_by_user_id=user.id)
+        .returning(PooledKey)
+    )
+    return (await session.execute(stmt)).scalar_one_or_none()
+
+
 async def register_payment(
     session: AsyncSession,
-    user: User,
-    payload: str,
+    user: UserRef,
+    months: int,
     stars_amount: int,
     fiat_amount: float,
 ) -> Payment:
     payment = Payment(
         user_id=user.id,
-        tg_invoice_payload=payload,
+        tg_invoice_payload=f"pending:{uuid.uuid4().hex}",
         stars_amount=stars_amount,
         fiat_amount=fiat_amount,
+        plan_months=months,
         status=PaymentStatus.PENDING,
     )
     session.add(payment)
     await session.flush()
+    payment.tg_invoice_payload = build_invoice_payload(payment.id, months)
+    await session.flush()
     return payment
 
 
+async def get_payment(session: AsyncSession, payment_id: int) -> Payment | None:
+    return await session.get(Payment, payment_id)
+
+
 async def get_payment_by_payload(session: AsyncSession, payload: str) -> Payment | None:
+    parsed = parse_invoice_payload(payload)
+    if parsed is not None:
+        payment = await session.get(Payment, parsed.payment_id)
+        if payment is None or payment.tg_invoice_payload != payload:
+            return None
+        return payment
+
     stmt = select(Payment).where(Payment.tg_invoice_payload == payload)
     result = await session.execute(stmt)
     return result.scalar_one_or_none()
@@ -91,48 +611,333 @@ async def get_payment_by_payload(session: AsyncSession, payload: str) -> Payment
 
 async def mark_payment_success(
     session: AsyncSession, payment: Payment, subscription: Subscription
-) -> None:
-    payment.status = PaymentStatus.SUCCESS
-    payment.subscription_id = subscription.id
-    await session.flush()
+) -> bool:
+    pending_invoices.pop(payment.tg_invoice_payload)
+    # Conditional UPDATE: of two transactions applying the same payment, only one matches a row.
+    claimed = await session.execute(
+        update(Payment)
+        .where(Payment.id == payment.id, Payment.status != PaymentStatus.SUCCESS)
+        .values(status=PaymentStatus.SUCCESS, subscription_id=subscription.id)
+        .execution_options(synchronize_session="fetch")
+    )
+    if claimed.rowcount != 1:
+        return False
+    await _bump_counter(session, StatCounterName.REVENUE_STARS, payment.stars_amount)
+    return True
+
+
+async def mark_payment_paid(session: AsyncSession, payment: Payment) -> bool:
+    pending_invoices.pop(payment.tg_invoice_payload)
+    claimed = await session.execute(
+        update(Payment)
+        .where(Payment.id == payment.id, Payment.status == PaymentStatus.PENDING)
+        .values(status=PaymentStatus.PAID)
+        .execution_options(synchronize_session="fetch")
+    )
+    return claimed.rowcount == 1
 
 
 async def mark_payment_failed(session: AsyncSession, payment: Payment) -> None:
+    pending_invoices.pop(payment.tg_invoice_payload)
     payment.status = PaymentStatus.FAILED
     await session.flush()
 
 
-async def list_users(session: AsyncSession) -> Sequence[User]:
-    result = await session.execute(select(User))
+async def count_users(session: AsyncSession) -> int:
+    return (await session.execute(select(func.count()).select_from(User))).scalar_one()
+
+
+async def fetch_user_chunk(
+    session: AsyncSession, after_id: int, limit: int
+) -> Sequence[tuple[int, int]]:
+    stmt = (
+        select(User.id, User.telegram_id)
+        .where(User.id > after_id)
+        .order_by(User.id)
+        .limit(limit)
+    )
+    result = await session.execute(stmt)
+    return result.tuples().all()
+
+
+async def create_broadcast(
+    session: AsyncSession,
+    admin_chat_id: int,
+    text: str,
+    total: int,
+    progress_message_id: int | None = None,
+) -> Broadcast:
+    broadcast = Broadcast(
+        admin_chat_id=admin_chat_id,
+        progress_message_id=progress_message_id,
+        text=text,
+        total=total,
+        status=BroadcastStatus.RUNNING,
+    )
+    session.add(broadcast)
+    await session.flush()
+    return broadcast
+
+
+async def get_broadcast(session: AsyncSession, broadcast_id: int) -> Broadcast | None:
+    return await session.get(Broadcast, broadcast_id)
+
+
+async def list_running_broadcasts(session: AsyncSession) -> Sequence[int]:
+    stmt = select(Broadcast.id).where(Broadcast.status == BroadcastStatus.RUNNING)
+    result = await session.execute(stmt)
     return result.scalars().all()
 
 
-async def compute_stats(session: AsyncSession) -> dict[str, int | float]:
-    total_users = len((await session.execute(select(User.id))).scalars().all())
-    payment_rows = await session.execute(
-        select(Payment.stars_amount, Payment.status)
+async def save_broadcast_checkpoint(
+    session: AsyncSession,
+    broadcast_id: int,
+    last_user_id: int,
+    sent: int,
+    failed: int,
+    status: str = BroadcastStatus.RUNNING,
+) -> None:
+    await session.execute(
+        update(Broadcast)
+        .where(Broadcast.id == broadcast_id)
+        .values(last_user_id=last_user_id, sent=sent, failed=failed, status=status)
     )
-    total_revenue = sum(
-        stars for stars, status in payment_rows.all() if status == PaymentStatus.SUCCESS
+
+
+async def enqueue_job(
+    session: AsyncSession,
+    kind: str,
+    payload: dict,
+    max_attempts: int,
+    dedupe_key: str | None = None,
+) -> None:
+    values = {
+        "kind": kind,
+        "payload": payload,
+        "dedupe_key": dedupe_key,
+        "status": JobStatus.PENDING,
+        "attempts": 0,
+        "max_attempts": max_attempts,
+        "run_at": dt.datetime.now(dt.timezone.utc),
+    }
+    stmt = _dialect_insert(session)(Job).values(**values)
+    if dedupe_key is not None:
+        stmt = stmt.on_conflict_do_nothing(index_elements=[Job.dedupe_key])
+    await session.execute(stmt)
+
+
+async def count_open_jobs(session: AsyncSession) -> int:
+    stmt = (
+        select(func.count())
+        .select_from(Job)
+        .where(Job.status.in_((JobStatus.PENDING, JobStatus.RUNNING)))
     )
-    return {"total_users": total_users, "total_revenue_stars": total_revenue}
+    return (await session.execute(stmt)).scalar_one()
 
 
-def format_subscription_message(subscription: Subscription) -> str:
+async def claim_jobs(session: AsyncSession, limit: int, lease: float) -> Sequence[Job]:
     now = dt.datetime.now(dt.timezone.utc)
-    days_left = max(0, (subscription.expires_at - now).days)
-    expires_at_str = subscription.expires_at.astimezone(dt.timezone(dt.timedelta(hours=3)))  # MSK hint
-    return (
+    candidates = (
+        select(Job.id)
+        .where(
+            ((Job.status == JobStatus.PENDING) & (Job.run_at <= now))
+            | ((Job.status == JobStatus.RUNNING) & (Job.locked_until < now))
+        )
+        .order_by(Job.run_at)
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+    )
+    stmt = (
+        update(Job)
+        .where(Job.id.in_(candidates))
+        .values(
+            status=JobStatus.RUNNING,
+            attempts=Job.attempts + 1,
+            locked_until=now + dt.timedelta(seconds=lease),
+        )
+        .returning(Job)
+    )
+    return (await session.execute(stmt)).scalars().all()
+
+
+async def complete_job(session: AsyncSession, job_id: int) -> None:
+    await session.execute(
+        update(Job).where(Job.id == job_id).values(status=JobStatus.DONE, locked_until=None)
+    )
+
+
+async def fail_job(session: AsyncSession, job_id: int, error: str, retry_at: dt.datetime | None) -> None:
+    values = {"last_error": error[:2000], "locked_until": None}
+    if retry_at is None:
+        values["status"] = JobStatus.FAILED
+    else:
+        values.update(status=JobStatus.PENDING, run_at=retry_at)
+    await session.execute(update(Job).where(Job.id == job_id).values(**values))
+
+
+async def load_fsm_record(session: AsyncSession, key: str) -> tuple[str | None, dict] | None:
+    stmt = select(FsmRecord.state, FsmRecord.data).where(
+        FsmRecord.key == key, FsmRecord.expires_at > dt.datetime.now(dt.timezone.utc)
+    )
+    row = (await session.execute(stmt)).first()
+    return None if row is None else (row.state, dict(row.data or {}))
+
+
+async def save_fsm_records(
+    session: AsyncSession,
+    records: dict[str, tuple[str | None, dict]],
+    expires_at: dt.datetime,
+) -> None:
+    if not records:
+        return
+    # Cleared states are kept as empty rows until they expire, so other processes see the change
+    # in fsm_keys_changed_since(); a deleted row would leave their caches stale.
+    now = dt.datetime.now(dt.timezone.utc)
+    insert_stmt = _dialect_insert(session)(FsmRecord).values(
+        [
+            {"key": key, "state": state, "data": data, "expires_at": expires_at, "updated_at": now}
+            for key, (state, data) in records.items()
+        ]
+    )
+    excluded = insert_stmt.excluded
+    await session.execute(
+        insert_stmt.on_conflict_do_update(
+            index_elements=[FsmRecord.key],
+            set_={
+                "state": excluded.state,
+                "data": excluded.data,
+                "expires_at": excluded.expires_at,
+                "updated_at": excluded.updated_at,
+            },
+        )
+    )
+
+
+async def fsm_keys_changed_since(session: AsyncSession, since: dt.datetime) -> list[str]:
+    return list((await session.execute(select(FsmRecord.key).where(FsmRecord.updated_at >= since))).scalars())
+
+
+async def purge_expired_fsm_records(session: AsyncSession) -> int:
+    result = await session.execute(
+        delete(FsmRecord).where(FsmRecord.expires_at <= dt.datetime.now(dt.timezone.utc))
+    )
+    return result.rowcount or 0
+
+
+async def compute_stats(session: AsyncSession) -> dict[str, int | float]:
+    global _stats_cache
+    now = time.monotonic()
+    if _stats_cache is not None and now - _stats_cache[0] < load_config().stats_cache_ttl:
+        return dict(_stats_cache[1])
+
+    rows = await session.execute(select(StatCounter.name, StatCounter.value))
+    counters = dict(rows.tuples().all())
+    stats = {
+        "total_users": counters.get(StatCounterName.USERS, 0),
+        "total_revenue_stars": counters.get(StatCounterName.REVENUE_STARS, 0),
+    }
+    _stats_cache = (now, stats)
+    return dict(stats)
+
+
+async def rollup_revenue(session: AsyncSession, lag: float) -> int:
+    started = dt.datetime.now(dt.timezone.utc)
+    watermark_row = StatCounter.name == StatCounterName.REVENUE_ROLLUP_WATERMARK
+    watermark = (await session.execute(select(StatCounter.value).where(watermark_row))).scalar_one_or_none() or 0
+    # Rows are re-read from slightly before the watermark so payments committed late are not missed;
+    # days are rebuilt from scratch, so overlapping passes are harmless.
+    since = dt.datetime.fromtimestamp(watermark, dt.timezone.utc) - dt.timedelta(seconds=lag)
+    day = func.date(Payment.created_at)
+    dirty = (await session.execute(select(day).where(Payment.updated_at > since).distinct())).scalars()
+    days = sorted({_as_date(value) for value in dirty if value is not None})
+
+    plan = func.coalesce(Payment.plan_months, 0)
+    success = Payment.status == PaymentStatus.SUCCESS
+    for current in days:
+        start = dt.datetime.combine(current, dt.time(), tzinfo=dt.timezone.utc)
+        stmt = (
+            select(
+                plan,
+                func.count(),
+                func.sum(case((success, 1), else_=0)),
+                func.sum(case((Payment.status == PaymentStatus.FAILED, 1), else_=0)),
+                func.sum(case((success, Payment.stars_amount), else_=0)),
+                func.sum(case((success, Payment.fiat_amount), else_=0)),
+            )
+            # The range keeps the scan on the created_at index; date() must match the grouping above.
+            .where(
+                Payment.created_at >= start - dt.timedelta(days=1),
+                Payment.created_at < start + dt.timedelta(days=2),
+                day == current,
+            )
+            .group_by(plan)
+        )
+        rows = [
+            {
+                "day": current,
+                "plan_months": plan_months,
+                "created": created,
+                "paid": paid,
+                "failed": failed,
+                "revenue_stars": stars,
+                "revenue_rub": rub,
+            }
+            for plan_months, created, paid, failed, stars, rub in (await session.execute(stmt)).tuples()
+        ]
+        await session.execute(delete(RevenueDaily).where(RevenueDaily.day == current))
+        if rows:
+            await session.execute(insert(RevenueDaily), rows)
+
+    await session.execute(update(StatCounter).where(watermark_row).values(value=int(started.timestamp())))
+    return len(days)
+
+
+async def revenue_report(session: AsyncSession, since: dt.date | None) -> Sequence[tuple]:
+    stmt = select(
+        RevenueDaily.plan_months,
+        func.sum(RevenueDaily.created),
+        func.sum(RevenueDaily.paid),
+        func.sum(RevenueDaily.failed),
+        func.sum(RevenueDaily.revenue_stars),
+        func.sum(RevenueDaily.revenue_rub),
+    ).group_by(RevenueDaily.plan_months).order_by(RevenueDaily.plan_months)
+    if since is not None:
+        stmt = stmt.where(RevenueDaily.day >= since)
+    return (await session.execute(stmt)).tuples().all()
+
+
+def format_subscription_message(
+    subscription: Subscription | SubscriptionView, used_bytes: int | None = None
+) -> str:
+    now = dt.datetime.now(dt.timezone.utc)
+    expires_at = _as_utc(subscription.expires_at)
+    days_left = max(0, (expires_at - now).days)
+    # Rounded to 0.1 GB so the rendered text stays cacheable between collector runs.
+    used_gb = None if used_bytes is None else round(used_bytes / 1024**3, 1)
+    return _render_subscription_message(subscription.outline_access_url, expires_at, days_left, used_gb)
+
+
+@lru_cache(maxsize=4096)
+def _render_subscription_message(
+    access_url: str, expires_at: dt.datetime, days_left: int, used_gb: float | None
+) -> str:
+    expires_at_str = expires_at.astimezone(dt.timezone(dt.timedelta(hours=3)))  # MSK hint
+    text = (
         "🔐 Твоя броня активна!\n"
-        f"Ключ: {subscription.outline_access_url}\n"
+        f"Ключ: {access_url}\n"
         f"Истекает: {expires_at_str:%d.%m.%Y %H:%M}\n"
         f"Осталось дней: {days_left}"
     )
+    if used_gb is not None:
+        quota_gb = load_config().usage.quota_gb
+        limit = f" из {quota_gb:g} ГБ" if quota_gb else ""
+        text += f"\nТрафик: {used_gb:.1f} ГБ{limit}"
+    return text
 
 
-def resolve_plan_by_payload(payload: str):
-    config = load_config()
-    for plan in config.plans:
-        if payload.startswith(f"plan-{plan.months}m"):
-            return plan
-    return None
+def resolve_plan_by_payload(payload: str) -> PaymentPlan | None:
+    catalog = plan_catalog()
+    parsed = parse_invoice_payload(payload)
+    if parsed is not None:
+        return catalog.by_months.get(parsed.months)
+    return catalog.by_legacy_payload(payload)
@@ -0,0 +1,75 @@
+from __future__ import annotations
+
+import asyncio
+import datetime as dt
+import logging
+from functools import cached_property
+
+from .config import SweeperConfig, load_config
+from .deps import db_session
+from .outline_client import outline_servers
+from .services import fetch_expired_subscriptions, mark_subscriptions_revoked
+
+logger = logging.getLogger(__name__)
+
+
+class ExpirySweeper:
+    def __init__(self) -> None:
+        self._task: asyncio.Task | None = None
+
+    @cached_property
+    def config(self) -> SweeperConfig:
+        return load_config().sweeper
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run(), name="expiry-sweeper")
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self.sweep()
+            except Exception:
+                logger.exception("Expiry sweep failed")
+            await asyncio.sleep(self.config.interval)
+
+    async def sweep(self) -> int:
+        expired_before = dt.datetime.now(dt.timezone.utc) - dt.timedelta(seconds=self.config.grace_period)
+        semaphore = asyncio.Semaphore(self.config.concurrency)
+        cursor: tuple[dt.datetime, int] | None = None
+        revoked = 0
+
+        async def revoke(subscription_id: int, server_id: str, key_id: str) -> int | None:
+            async with semaphore:
+                try:
+                    await outline_servers.get(server_id).delete_key(key_id)
+                except Exception as exc:  # noqa: BLE001
+                    logger.warning("Failed to delete key %s on %s: %s", key_id, server_id, exc)
+                    return None
+            return subscription_id
+
+        while True:
+            async with db_session() as session:
+                rows = await fetch_expired_subscriptions(session, expired_before, cursor, self.config.batch_size)
+            if not rows:
+                break
+            cursor = (rows[-1][1], rows[-1][0])
+            results = await asyncio.gather(
+                *(revoke(sub_id, server_id, key_id) for sub_id, _, server_id, key_id in rows)
+            )
+            done = [sub_id for sub_id in results if sub_id is not None]
+            async with db_session() as session:
+                await mark_subscriptions_revoked(session, done)
+            revoked += len(done)
+
+        if revoked:
+            logger.info("Expiry sweep revoked %s Outline keys", revoked)
+        return revoked
+
+
+sweeper = ExpirySweeper()
@@ -0,0 +1,110 @@
+from __future__ import annotations
+
+import asyncio
+import datetime as dt
+import logging
+from functools import cached_property
+
+from .config import UsageConfig, load_config
+from .deps import db_session
+from .outline_client import OutlineClient, outline_servers
+from .services import fetch_usage_state, mark_usage_limited, rollup_usage, save_usage
+
+logger = logging.getLogger(__name__)
+
+
+class UsageCollector:
+    def __init__(self) -> None:
+        self._task: asyncio.Task | None = None
+
+    @cached_property
+    def config(self) -> UsageConfig:
+        return load_config().usage
+
+    @property
+    def quota_bytes(self) -> int:
+        return int(self.config.quota_gb * 1024**3)
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run(), name="usage-collector")
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    async def _run(self) -> None:
+        while True:
+            for client in outline_servers:
+                try:
+                    await self.collect(client)
+                except Exception:
+                    logger.exception("Usage collection failed for %s", client.server_id)
+            try:
+                async with db_session() as session:
+                    await rollup_usage(session, dt.datetime.now(dt.timezone.utc) - dt.timedelta(hours=self.config.raw_retention_hours))
+            except Exception:
+                logger.exception("Usage rollup failed")
+            await asyncio.sleep(self.config.interval)
+
+    async def collect(self, client: OutlineClient) -> int:
+        counters = await client.get_transfer_metrics()
+        now = dt.datetime.now(dt.timezone.utc)
+        async with db_session() as session:
+            rows = await fetch_usage_state(session, client.server_id)
+
+        states, samples, over_quota = [], [], []
+        for subscription_id, key_id, last_counter, bytes_used, limited in rows:
+            current = counters.get(key_id)
+            if current is None:
+                continue
+            if last_counter is None:
+                delta = current
+            else:
+                # Outline reports a rolling window, so the counter can shrink; count only growth.
+                delta = max(0, current - last_counter)
+            if delta == 0 and last_counter == current:
+                continue
+            bytes_used += delta
+            states.append(
+                {
+                    "subscription_id": subscription_id,
+                    "last_counter": current,
+                    "bytes_used": bytes_used,
+                    "limited": limited,
+                    "updated_at": now,
+                }
+            )
+            if delta:
+                samples.append({"subscription_id": subscription_id, "collected_at": now, "bytes": delta})
+            if self.quota_bytes and bytes_used >= self.quota_bytes and not limited:
+                over_quota.append((subscription_id, key_id))
+
+        if states:
+            async with db_session() as session:
+                await save_usage(session, states, samples)
+        if over_quota:
+            await self.enforce(client, over_quota)
+        return len(samples)
+
+    async def enforce(self, client: OutlineClient, keys: list[tuple[int, str]]) -> None:
+        semaphore = asyncio.Semaphore(self.config.concurrency)
+
+        async def limit(subscription_id: int, key_id: str) -> int | None:
+            async with semaphore:
+                try:
+                    await client.set_data_limit(key_id, 0)
+                except Exception as exc:  # noqa: BLE001
+                    logger.warning("Failed to limit key %s on %s: %s", key_id, client.server_id, exc)
+                    return None
+            return subscription_id
+
+        results = await asyncio.gather(*(limit(sub_id, key_id) for sub_id, key_id in keys))
+        limited = [sub_id for sub_id in results if sub_id is not None]
+        async with db_session() as session:
+            await mark_usage_limited(session, limited)
+        logger.info("Applied data limit to %s keys on %s", len(limited), client.server_id)
+
+
+usage_collector = UsageCollector()
@@ -0,0 +1,107 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import multiprocessing
+
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
+
+from .config import load_config
+from .database import dispose_engine
+from .main import create_application, setup_logging
+from .metrics import start_metrics_server
+from .migrations import init_db
+
+logger = logging.getLogger(__name__)
+
+
+async def create_app(worker_index: int = 0) -> web.Application:
+    config = load_config()
+    bot, dp = create_application(config, is_leader=worker_index == 0)
+
+    app = web.Application()
+    SimpleRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        handle_in_background=True,
+        secret_token=config.webhook.secret or None,
+    ).register(app, path=config.webhook.path)
+    setup_application(app, dp, bot=bot)
+
+    if worker_index == 0:
+        async def set_webhook(_: web.Application) -> None:
+            await bot.set_webhook(
+                url=config.webhook.base_url.rstrip("/") + config.webhook.path,
+                secret_token=config.webhook.secret or None,
+                allowed_updates=dp.resolve_used_update_types(),
+                max_connections=config.webhook.max_connections,
+                # Updates queued during a deploy may include successful payments; they must be delivered.
+                drop_pending_updates=False,
+            )
+
+        app.on_startup.append(set_webhook)
+
+    if config.metrics.port:
+        # Every worker keeps its own registry, so each one is scraped on its own port.
+        async def metrics_context(_: web.Application):
+            runner = await start_metrics_server(config.metrics.host, config.metrics.port + worker_index)
+            yield
+            await runner.cleanup()
+
+        app.cleanup_ctx.append(metrics_context)
+    return app
+
+
+def _serve(worker_index: int) -> None:
+    setup_logging()
+    config = load_config()
+    logger.info("Webhook worker %s listening on %s:%s", worker_index, config.webhook.host, config.webhook.port)
+    web.run_app(
+        create_app(worker_index),
+        host=config.webhook.host,
+        port=config.webhook.port,
+        reuse_port=config.webhook.workers > 1,
+        print=None,
+    )
+
+
+async def _migrate() -> None:
+    # Workers are spawned fresh and open their own engines; drop the parent's before forking them.
+    try:
+        await init_db()
+    finally:
+        await dispose_engine()
+
+
+def run_webhook() -> None:
+    setup_logging()
+    config = load_config()
+    if not config.webhook.base_url:
+        raise RuntimeError("BOT_MODE=webhook requires WEBHOOK_BASE_URL")
+    if not config.webhook.secret:
+        logger.warning("WEBHOOK_SECRET is empty, incoming updates will not be authenticated")
+    asyncio.run(_migrate())
+
+    if config.webhook.workers <= 1:
+        _serve(0)
+        return
+
+    context = multiprocessing.get_context("spawn")
+    workers = [
+        context.Process(target=_serve, args=(index,), name=f"webhook-worker-{index}")
+        for index in range(config.webhook.workers)
+    ]
+    for worker in workers:
+        worker.start()
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+        for worker in workers:
+            worker.join()